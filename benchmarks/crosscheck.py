@@ -0,0 +1,152 @@
+# coding=utf-8
+"""The recovery state rebuilt from the file against the state followed line by line while printing.
+
+A GcodeState is fed every line of a synthetic print, as the live tracking
+does, and its state is recorded at random line ends and at every snapshot of
+an index built over several chunks. At those positions the state is rebuilt
+the three ways recovery can: reconstruct_state walking the file backwards,
+the index snapshots as resolved by the fix-up of the chunks, and
+GcodeIndex.state_at replaying from the closest snapshot. Any field that
+differs is a mismatch and fails the run:
+
+    python benchmarks/crosscheck.py
+    python benchmarks/crosscheck.py --lines 500000 --positions 5000 --chunks 8 --output check.json
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import octoprint_powerfailure  # noqa: E402
+from octoprint_powerfailure.gcode import GcodeState, reconstruct_state  # noqa: E402
+from octoprint_powerfailure.index import GcodeIndex  # noqa: E402
+
+import gcodegen  # noqa: E402
+
+#what recovery takes from the rebuilt state, E only under absolute extrusion
+FIELDS = ("x", "y", "z", "e", "feedrate", "absolute", "absolute_e", "extrusion", "fan", "linear_advance", "tool",
+          "retracted", "fw_retracted", "tool_e", "tool_retracted")
+
+
+def fields(state):
+    return dict((field, getattr(state, field)) for field in FIELDS)
+
+
+def same(a, b):
+    """a == b, floats (also in the per tool dicts) to within what summing them up again rounds differently"""
+    if isinstance(a, float) and isinstance(b, float):
+        return abs(a - b) <= 1e-6 * max(1.0, abs(a))
+    if isinstance(a, dict) and isinstance(b, dict):
+        return sorted(a) == sorted(b) and all(same(a[key], b[key]) for key in a)
+    return a == b
+
+
+def differences(expected, state):
+    """the fields of state that are not what the live state had, as {field: (expected, got)}"""
+    got = fields(state)
+    diff = {}
+    for field in FIELDS:
+        if field == "e" and not expected["absolute_e"]:
+            continue
+        a, b = expected[field], got[field]
+        if not same(a, b):
+            diff[field] = (a, b)
+    return diff
+
+
+def live_states(data, positions):
+    """{filepos: fields} of a GcodeState fed every line, for the positions that are line ends"""
+    wanted = set(positions)
+    state = GcodeState()
+    states = {}
+    if 0 in wanted:
+        states[0] = fields(state)
+    pos = 0
+    for line in data.splitlines(True):
+        state.process(line.decode("utf-8"))
+        pos += len(line)
+        if pos in wanted:
+            states[pos] = fields(state)
+    return states
+
+
+def check(name, expected, rebuild, report):
+    mismatches = []
+    start = time.time()
+    for pos in sorted(expected):
+        diff = differences(expected[pos], rebuild(pos))
+        if diff:
+            mismatches.append(dict(filepos=pos, fields=diff))
+    elapsed = time.time() - start
+    print("{0:<22} {1:>7} positions  {2:>5} mismatches  {3:.2f} s".format(
+        name, len(expected), len(mismatches), elapsed))
+    for mismatch in mismatches[:report]:
+        print("    at {0}: {1}".format(mismatch["filepos"], ", ".join(
+            "{0} {1!r} != {2!r}".format(field, a, b) for field, (a, b) in sorted(mismatch["fields"].items()))))
+    return dict(name=name, positions=len(expected), mismatches=len(mismatches), seconds=elapsed,
+                first=mismatches[:report])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=200000, help="length of the generated print")
+    parser.add_argument("--generator", default="modes", choices=sorted(gcodegen.GENERATORS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--positions", type=int, default=2000, help="random line ends checked")
+    parser.add_argument("--chunks", type=int, default=5, help="index worker processes, one chunk each")
+    parser.add_argument("--interval", type=int, default=64 * 1024, help="bytes between index snapshots")
+    parser.add_argument("--report", type=int, default=5, help="mismatches printed per check")
+    parser.add_argument("--output", default=None, help="write the results as JSON here")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="powerfailure-crosscheck-")
+    try:
+        source = os.path.join(workdir, "check.gcode")
+        gcodegen.write(source, args.generator, args.lines, seed=args.seed)
+        with open(source, "rb") as fh:
+            data = fh.read()
+        ends = [0]
+        for line in data.splitlines(True):
+            ends.append(ends[-1] + len(line))
+        rnd = random.Random(args.seed)
+        positions = rnd.sample(ends, min(args.positions, len(ends)))
+        index = GcodeIndex.build(source, workers=args.chunks, interval=args.interval)
+        snapshots = [index.snapshot(i) for i in range(len(index))]
+        live = live_states(data, positions + [offset for offset, _, _ in snapshots])
+        print("{0} bytes, {1} lines, {2} index snapshots".format(len(data), len(ends) - 1, len(snapshots)))
+
+        at_positions = dict((pos, live[pos]) for pos in positions)
+        by_offset = dict((offset, state) for offset, state, _ in snapshots)
+        results = [
+            check("reconstruct_state", at_positions, lambda pos: reconstruct_state(data, pos), args.report),
+            check("index snapshots", dict((offset, live[offset]) for offset in by_offset),
+                  by_offset.get, args.report),
+            check("GcodeIndex.state_at", at_positions, index.state_at, args.report),
+        ]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = dict(
+        meta=dict(plugin_version=octoprint_powerfailure.__plugin_version__,
+                  python=platform.python_version(), platform=platform.platform(),
+                  args=vars(args), time=time.strftime("%Y-%m-%dT%H:%M:%S")),
+        results=results,
+    )
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+    return 1 if any(result["mismatches"] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
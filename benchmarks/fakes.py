@@ -0,0 +1,153 @@
+# coding=utf-8
+"""Stand-ins for the OctoPrint objects the plugin talks to, enough to drive it without a printer."""
+from __future__ import absolute_import
+
+import logging
+import os
+import shutil
+
+#inside OctoPrint the server has imported it, and its util module, long before the plugin runs
+import octoprint.filemanager  # noqa: F401
+import octoprint_powerfailure
+
+
+class FakeSettings(object):
+    def __init__(self, defaults, overrides=None):
+        self._values = dict(defaults)
+        self._values.update(overrides or {})
+
+    def get(self, path, **kwargs):
+        return self._values.get(path[0])
+
+    def getFloat(self, path, **kwargs):
+        value = self.get(path)
+        return None if value is None else float(value)
+
+    def getInt(self, path, **kwargs):
+        value = self.get(path)
+        return None if value is None else int(value)
+
+    def getBoolean(self, path, **kwargs):
+        return bool(self.get(path))
+
+    def set(self, path, value, **kwargs):
+        self._values[path[0]] = value
+
+    def setBoolean(self, path, value, **kwargs):
+        self.set(path, bool(value))
+
+    def save(self, *args, **kwargs):
+        pass
+
+
+class FakePrinter(object):
+    """a printer that is always printing path at whatever filepos the benchmark sets"""
+
+    def __init__(self, path="bench.gcode"):
+        self.printing = True
+        self.ready = False
+        self.path = path
+        self.filepos = 0
+        self.z = 0.2
+        self.targets = {"bed": 60.0, "tool0": 210.0}
+        self.selected = []
+        self.sent = []
+
+    def is_printing(self):
+        return self.printing
+
+    def is_ready(self):
+        return self.ready
+
+    def get_current_data(self):
+        return {
+            "progress": {"filepos": self.filepos},
+            "job": {"file": {"path": self.path, "origin": "local"}},
+            "currentZ": self.z,
+        }
+
+    def get_current_temperatures(self):
+        return dict((name, {"actual": target, "target": target}) for name, target in self.targets.items())
+
+    def select_file(self, path, sd, printAfterSelect=False, **kwargs):
+        self.selected.append((path, printAfterSelect))
+
+    def start_print(self, pos=None, **kwargs):
+        self.selected.append((None, pos))
+
+    def commands(self, commands, **kwargs):
+        self.sent.extend(commands if isinstance(commands, list) else [commands])
+
+
+class FakeFileManager(object):
+    """local storage rooted at basedir"""
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.added = []
+        self.metadata = {}
+
+    def path_on_disk(self, origin, path):
+        if os.path.isabs(path):
+            return path
+        return os.path.join(self.basedir, path)
+
+    def add_file(self, destination, path, file_object, allow_overwrite=False, analysis=None, **kwargs):
+        target = self.path_on_disk(destination, path)
+        file_object.save(target)
+        self.added.append((target, analysis))
+        return path
+
+    def get_metadata(self, origin, path):
+        return self.metadata.get(path)
+
+    def set_additional_metadata(self, origin, path, key, data, overwrite=False, merge=False):
+        self.metadata.setdefault(path, {})[key] = data
+
+
+class FakePluginManager(object):
+    def __init__(self):
+        self.messages = []
+
+    def send_plugin_message(self, plugin, data):
+        self.messages.append((plugin, data))
+
+
+class FakeComm(object):
+    """what the sending hook reads off comm_instance"""
+
+    def __init__(self, printer):
+        self._printer = printer
+
+    def getFilePosition(self):
+        return {"origin": "local", "filename": self._printer.path, "pos": self._printer.filepos}
+
+
+def make_plugin(basedir, **overrides):
+    """a PowerFailurePlugin wired to fakes, with its data folder and uploads under basedir"""
+    uploads = os.path.join(basedir, "uploads")
+    data = os.path.join(basedir, "data")
+    for folder in (uploads, data):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+    plugin = octoprint_powerfailure.PowerFailurePlugin()
+    plugin._identifier = "powerfailure"
+    plugin._plugin_name = octoprint_powerfailure.__plugin_name__
+    plugin._plugin_version = octoprint_powerfailure.__plugin_version__
+    plugin._logger = logging.getLogger("benchmarks.powerfailure")
+    plugin._settings = FakeSettings(plugin.get_settings_defaults(), overrides)
+    plugin._printer = FakePrinter()
+    plugin._file_manager = FakeFileManager(uploads)
+    plugin._plugin_manager = FakePluginManager()
+    plugin.get_plugin_data_folder = lambda: data
+    plugin.initialize()
+    return plugin
+
+
+def install_gcode(plugin, source, name="bench.gcode"):
+    """copy source into the fake uploads folder and point the printer at it"""
+    target = plugin._file_manager.path_on_disk("local", name)
+    if os.path.abspath(source) != os.path.abspath(target):
+        shutil.copyfile(source, target)
+    plugin._printer.path = name
+    return target
@@ -0,0 +1,136 @@
+# coding=utf-8
+"""Synthetic gcode that looks enough like slicer output to exercise the plugin."""
+from __future__ import absolute_import
+
+import io
+import math
+import random
+
+START = ("M140 S60\nM104 S210\nM190 S60\nM109 S210\n"
+         "G21\nG90\nM82\nM900 K0.05\nG28\nG92 E0\nM106 S0\n")
+
+
+def dense_arcs(lines, seed=0):
+    """many tiny segments approximating small circles, the worst case for per-line cost"""
+    rnd = random.Random(seed)
+    yield START
+    e = 0.0
+    layer = 0
+    n = 0
+    while n < lines:
+        layer += 1
+        yield ";LAYER:{0}\nG1 Z{1:.2f} F600\n".format(layer, layer * 0.2)
+        n += 2
+        cx, cy = rnd.uniform(20, 180), rnd.uniform(20, 180)
+        for i in range(min(2000, lines - n)):
+            a = i * 2 * math.pi / 64
+            e += 0.0123
+            yield "G1 X{0:.3f} Y{1:.3f} E{2:.5f}\n".format(cx + 3 * math.cos(a), cy + 3 * math.sin(a), e)
+            n += 1
+
+
+def vase(lines, seed=0):
+    """spiral vase: Z changes on every line, relative extrusion"""
+    yield START.replace("M82", "M83")
+    z = 0.2
+    for i in range(lines):
+        a = i * 2 * math.pi / 200
+        z += 0.001
+        yield "G1 X{0:.3f} Y{1:.3f} Z{2:.3f} E0.0321\n".format(100 + 40 * math.cos(a), 100 + 40 * math.sin(a), z)
+
+
+def multi_tool(lines, seed=0, tools=2):
+    """tool changes every few hundred lines with their own temperatures and retractions"""
+    rnd = random.Random(seed)
+    yield START
+    e = 0.0
+    for i in range(lines):
+        if i % 400 == 0:
+            tool = (i // 400) % tools
+            yield "G1 E{0:.5f} F2400\nT{1}\nM104 T{1} S215\nG92 E0\n".format(e - 0.8, tool)
+            e = 0.0
+        if i % 2000 == 0:
+            yield ";LAYER_CHANGE\n;Z:{0:.2f}\nG1 Z{0:.2f} F600\n".format(0.2 + i // 2000 * 0.2)
+        e += 0.02
+        yield "G1 X{0:.3f} Y{1:.3f} E{2:.5f}\n".format(rnd.uniform(0, 200), rnd.uniform(0, 200), e)
+
+
+def modes(lines, seed=0):
+    """layers with G91 blocks, M82/M83 switches, G92 and G28 resets, fan, M900, tool, feedrate and G10/G11 changes"""
+    rnd = random.Random(seed)
+    yield START
+    e = 0.0
+    absolute_e = True
+    z = 0.2
+    yield "G1 Z0.2 F600\n"
+    for i in range(lines):
+        roll = rnd.random()
+        if roll < 0.002:
+            z += 0.2
+            yield ";LAYER_CHANGE\nG1 Z{0:.2f} F600\n".format(z)
+        elif roll < 0.01:
+            #a z hop and travel in relative coordinates, G90 makes E absolute again
+            yield "G91\nG1 Z0.4 F1200\nG1 X{0:.3f} Y{1:.3f} F9000\nG1 Z-0.4\nG90\n{2}".format(
+                rnd.uniform(-5, 5), rnd.uniform(-5, 5), "" if absolute_e else "M83\n")
+        elif roll < 0.015:
+            absolute_e = not absolute_e
+            if absolute_e:
+                e = 0.0
+            yield "M82\nG92 E0\n" if absolute_e else "M83\n"
+        elif roll < 0.02:
+            yield "M106 S{0}\n".format(rnd.randrange(256)) if rnd.random() < 0.8 else "M107\n"
+        elif roll < 0.022:
+            yield "M900 K{0:.2f}\n".format(rnd.uniform(0, 0.2))
+        elif roll < 0.025:
+            yield "T{0}\n".format(rnd.randrange(3))
+        elif roll < 0.03 and absolute_e:
+            e = 0.0
+            yield "G92 E0\n"
+        elif roll < 0.032:
+            yield "G28 X0 Y0\n"
+        elif roll < 0.034:
+            #firmware retraction around a travel, G10 with parameters sets standby temperatures instead
+            yield "G10\nG1 X{0:.3f} Y{1:.3f} F9000\nG10 P{2} S170\nG11\n".format(
+                rnd.uniform(0, 200), rnd.uniform(0, 200), rnd.randrange(3))
+        else:
+            extruded = rnd.uniform(-0.05, 0.2)
+            e += extruded
+            feedrate = " F{0}".format(rnd.choice((1200, 1800, 2400, 9000))) if rnd.random() < 0.1 else ""
+            yield "G1 X{0:.3f} Y{1:.3f} E{2:.5f}{3}\n".format(rnd.uniform(0, 200), rnd.uniform(0, 200),
+                                                             e if absolute_e else extruded, feedrate)
+
+
+GENERATORS = {
+    "dense_arcs": dense_arcs,
+    "vase": vase,
+    "multi_tool": multi_tool,
+    "modes": modes,
+}
+
+
+def write(path, generator, lines, seed=0):
+    """write lines of generator to path, returns the size in bytes"""
+    with io.open(path, "w", newline="\n") as fh:
+        buffer = []
+        for chunk in GENERATORS[generator](lines, seed=seed):
+            buffer.append(chunk)
+            if len(buffer) >= 10000:
+                fh.write(u"".join(buffer))
+                buffer = []
+        fh.write(u"".join(buffer))
+        return fh.tell()
+
+
+def write_size(path, size, seed=0):
+    """dense_arcs gcode of roughly size bytes"""
+    #dense_arcs lines are ~32 bytes
+    return write(path, "dense_arcs", size // 32 + 1, seed=seed)
+
+
+def sent_lines(path):
+    """the lines as OctoPrint would send them: comments and blank lines stripped"""
+    with io.open(path, "r") as fh:
+        for line in fh:
+            line = line.split(";")[0].strip()
+            if line:
+                yield line
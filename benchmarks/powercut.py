@@ -0,0 +1,294 @@
+# coding=utf-8
+"""Print, cut the power, recover: repeated on a simulated printer.
+
+A VirtualPrinter stands in for the serial link and the firmware. Lines go out
+one at a time as OctoPrint sends them, each one is acknowledged once it fits in
+the planner, the planner executes them at a random pace. Checkpoints are taken
+whenever the plugin's scheduler would wake up. The power is cut after a random
+line or in the middle of a checkpoint write, then a fresh plugin instance on
+the same data folder recovers, and the run is scored against the line the
+printer had really executed:
+
+    python benchmarks/powercut.py --runs 20
+    python benchmarks/powercut.py --cut mid-write --planner-depth 16 --output cuts.json
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import bisect
+import collections
+import json
+import os
+import platform
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import octoprint_powerfailure  # noqa: E402
+from octoprint_powerfailure.checkpoint import _HEADER, SLOT_SIZE  # noqa: E402
+
+import fakes  # noqa: E402
+import gcodegen  # noqa: E402
+
+SECTOR = 512
+
+
+def file_lines(path):
+    """(line, position after it) of every line OctoPrint would send"""
+    lines = []
+    pos = 0
+    with open(path, "rb") as fh:
+        for raw in fh:
+            pos += len(raw)
+            line = raw.split(b";")[0].strip()
+            if line:
+                lines.append((line.decode("utf-8"), pos))
+    return lines
+
+
+class VirtualPrinter(object):
+    """serial link, command buffer and planner of a firmware, on a simulated clock"""
+
+    def __init__(self, plugin, lines, planner_depth, rnd, baudrate=115200, move_time=(0.002, 0.03)):
+        self.plugin = plugin
+        self.lines = lines
+        self.planner_depth = planner_depth
+        self.rnd = rnd
+        self.baudrate = baudrate
+        self.move_time = move_time
+        self.comm = fakes.FakeComm(plugin._printer)
+        self.now = 0.0
+        self.sent = 0
+        #index of the last line the planner finished, -1 before the first
+        self.executed = -1
+        self.planner = collections.deque()
+        self.checkpoints = 0
+        self.powered = True
+
+    def _temperature(self, line):
+        words = line.split()
+        target = {"M104": "tool0", "M109": "tool0", "M140": "bed", "M190": "bed"}.get(words[0])
+        if target is None:
+            return
+        for word in words[1:]:
+            if word[0] == "S":
+                self.plugin._printer.targets[target] = float(word[1:])
+
+    def _execute_next(self):
+        index, done = self.planner.popleft()
+        self.now = max(self.now, done)
+        self.executed = index
+
+    def _checkpoint(self, on_write=None):
+        scheduler = self.plugin.checkpoints.scheduler
+        #what the scheduler thread would do when woken up by the byte budget
+        if scheduler._wake.is_set():
+            scheduler._wake.clear()
+            self.checkpoints += 1
+            if on_write is not None:
+                on_write(self.checkpoints)
+            self.plugin.backupState()
+            #on the simulated clock the write lands before the next line goes out
+            self.plugin.checkpoints.writer.flush()
+
+    def run(self, stop_after=None, on_write=None):
+        """send lines until stop_after lines are out, the file ends or the power goes"""
+        plugin = self.plugin
+        printer = plugin._printer
+        total = len(self.lines) if stop_after is None else min(stop_after, len(self.lines))
+        while self.sent < total and self.powered:
+            line, pos = self.lines[self.sent]
+            printer.filepos = pos
+            self.now += (len(line) + 1) * 10.0 / self.baudrate
+            plugin.hook_gcode_sending(self.comm, "sending", line, None, None, None)
+            self._temperature(line)
+            #the firmware only takes the line, and answers ok, when the planner has room
+            while len(self.planner) >= self.planner_depth:
+                self._execute_next()
+            start = self.planner[-1][1] if self.planner else self.now
+            self.planner.append((self.sent, max(start, self.now) + self.rnd.uniform(*self.move_time)))
+            plugin.hook_gcode_received(self.comm, "ok")
+            self.sent += 1
+            while self.planner and self.planner[0][1] <= self.now:
+                self._execute_next()
+            self._checkpoint(on_write)
+
+    def executed_pos(self):
+        return 0 if self.executed < 0 else self.lines[self.executed][1]
+
+
+def torn_write(store, printer, rnd):
+    """a write of the next checkpoint slot that only lands in some of its sectors, then the power goes"""
+    #pokes at the store's internals on purpose, it is the write in flight that gets torn
+    def write(payload):
+        offset = store._next_slot * SLOT_SIZE
+        seq = store._seq + 1
+        crc = zlib.crc32(struct.pack("<IQ", len(payload), seq) + payload) & 0xffffffff
+        new = bytearray(store._map[offset:offset + SLOT_SIZE])
+        record = _HEADER.pack(b"PFCK", len(payload), seq, crc) + payload
+        new[:len(record)] = record
+        for sector in range(0, SLOT_SIZE, SECTOR):
+            if rnd.random() < 0.5:
+                store._map[offset + sector:offset + sector + SECTOR] = bytes(new[sector:sector + SECTOR])
+        printer.powered = False
+    return write
+
+
+def lines_between(ends, a, b):
+    """number of lines ending in (a, b]"""
+    if a > b:
+        a, b = b, a
+    return bisect.bisect_right(ends, b) - bisect.bisect_right(ends, a)
+
+
+def one_run(workdir, source, lines, ends, args, seed):
+    rnd = random.Random(seed)
+    basedir = os.path.join(workdir, "run-{0}".format(seed))
+    overrides = dict(state_tracking=args.tracking, track_acks=not args.no_acks,
+                     planner_depth=args.planner_depth, resume_method=args.resume_method,
+                     #resuming from the original file is only done with auto_continue
+                     auto_continue=args.resume_method == "virtual")
+    plugin = fakes.make_plugin(basedir, **overrides)
+    fakes.install_gcode(plugin, source)
+    plugin.on_event("PrintStarted", {"origin": "local", "path": "bench.gcode", "name": "bench.gcode"})
+    #checkpoints are taken by the simulation, on its own clock
+    plugin.checkpoints.scheduler.stop()
+    printer = VirtualPrinter(plugin, lines, args.planner_depth, rnd)
+
+    cut = args.cut
+    if cut == "mid-write":
+        #low estimate of the checkpoints a whole print takes, so the cut comes before the end
+        expected_checkpoints = max(3, len(lines) * 25 // plugin.checkpoints.scheduler.min_bytes)
+        torn_at = rnd.randrange(2, expected_checkpoints)
+
+        def on_write(n):
+            if n == torn_at:
+                plugin.checkpoints.store.write = torn_write(plugin.checkpoints.store, printer, rnd)
+        printer.run(on_write=on_write)
+    else:
+        stop_after = int(cut) if cut != "random" else rnd.randrange(len(lines) // 20, len(lines))
+        printer.run(stop_after=stop_after)
+    before = plugin.checkpoints.read()
+    plugin.checkpoints.close()
+    executed_pos = printer.executed_pos()
+    sent_pos = lines[printer.sent - 1][1] if printer.sent else 0
+
+    #OctoPrint comes back up
+    survivor = fakes.make_plugin(basedir, **overrides)
+    survivor._printer.printing = False
+    resumed = {}
+    generate = survivor.generateContinuation
+
+    def capture():
+        recovery_fn = generate()
+        resumed.update(survivor.recovery_settings)
+        return recovery_fn
+    survivor.generateContinuation = capture
+    tracemalloc.start()
+    cpu = time.process_time()
+    start = time.time()
+    recovery_fn = survivor.check_recovery()
+    elapsed = time.time() - start
+    cpu = time.process_time() - cpu
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = dict(seed=seed, sent_lines=printer.sent, executed_lines=printer.executed + 1,
+                  checkpoints=printer.checkpoints, checkpoint_readable=before is not None,
+                  recovered=recovery_fn is not None)
+    if recovery_fn is not None:
+        resume_pos = resumed["filepos"]
+        result.update(
+            resume_pos=resume_pos,
+            executed_pos=executed_pos,
+            sent_pos=sent_pos,
+            #lines the printer had executed that will run again
+            reexecuted=lines_between(ends, resume_pos, executed_pos) if resume_pos < executed_pos else 0,
+            #lines that never ran and are not in the recovery job
+            lost=lines_between(ends, executed_pos, resume_pos) if resume_pos > executed_pos else 0,
+            recovery_seconds=elapsed,
+            recovery_cpu_seconds=cpu,
+            recovery_peak_alloc=peak,
+            recovery_file_ok=_check_recovery_file(survivor, recovery_fn, source, resume_pos),
+        )
+    survivor.checkpoints.close()
+    shutil.rmtree(basedir, ignore_errors=True)
+    return result
+
+
+def _check_recovery_file(plugin, recovery_fn, source, resume_pos):
+    """the recovery job ends with exactly the original from resume_pos on"""
+    if plugin.virtual_resume is not None:
+        return plugin.virtual_resume["pos"] == resume_pos
+    with open(source, "rb") as fh:
+        fh.seek(resume_pos)
+        tail = fh.read()
+    with open(plugin._file_manager.path_on_disk("local", recovery_fn), "rb") as fh:
+        return fh.read().endswith(tail)
+
+
+def summarize(runs):
+    recovered = [run for run in runs if run["recovered"]]
+    summary = dict(runs=len(runs), recovered=len(recovered),
+                   unreadable_checkpoints=sum(1 for run in runs if not run["checkpoint_readable"]),
+                   bad_recovery_files=sum(1 for run in recovered if not run["recovery_file_ok"]))
+    for key in ("lost", "reexecuted", "recovery_seconds", "recovery_cpu_seconds", "recovery_peak_alloc"):
+        values = sorted(run[key] for run in recovered)
+        if values:
+            summary[key] = dict(max=values[-1], mean=sum(values) / float(len(values)),
+                                p50=values[len(values) // 2])
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first run, run n uses seed + n")
+    parser.add_argument("--lines", type=int, default=50000, help="length of the generated print")
+    parser.add_argument("--generator", default="dense_arcs", choices=sorted(gcodegen.GENERATORS))
+    parser.add_argument("--cut", default="random", help="random, mid-write or the number of lines to send")
+    parser.add_argument("--planner-depth", type=int, default=16, help="planner depth of the virtual printer and the plugin")
+    parser.add_argument("--tracking", default="live", help="state_tracking setting")
+    parser.add_argument("--resume-method", default="copy", help="resume_method setting")
+    parser.add_argument("--no-acks", action="store_true", help="checkpoint the sent position (track_acks off)")
+    parser.add_argument("--output", default=None, help="write the results as JSON here")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="powerfailure-powercut-")
+    try:
+        source = os.path.join(workdir, "bench.gcode")
+        gcodegen.write(source, args.generator, args.lines, seed=args.seed)
+        lines = file_lines(source)
+        ends = [pos for _, pos in lines]
+        runs = []
+        for n in range(args.runs):
+            run = one_run(workdir, source, lines, ends, args, args.seed + n)
+            runs.append(run)
+            print(json.dumps(run, sort_keys=True))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = dict(
+        meta=dict(plugin_version=octoprint_powerfailure.__plugin_version__,
+                  python=platform.python_version(), platform=platform.platform(),
+                  args=vars(args), time=time.strftime("%Y-%m-%dT%H:%M:%S")),
+        summary=summarize(runs),
+        runs=runs,
+    )
+    print(json.dumps(report["summary"], indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+# coding=utf-8
+"""Checkpoint writes while printing, and power-fail notification to checkpoint on disk, per checkpoint mode.
+
+A feeder thread sends lines through the plugin's hooks at a steady pace for
+--seconds while the real scheduler thread takes checkpoints; the writes that
+reach the checkpoint file are counted. In the power_signal mode ONBATT is then
+sent to the notification socket (and SIGPWR to the process) again and again in
+the middle of the print, timing each one until the checkpoint write returns,
+and the checkpoint file is read back from a fresh store:
+
+    python benchmarks/powersignal.py
+    python benchmarks/powersignal.py --write-delay 0.02 --notifications 200 --output signal.json
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import octoprint_powerfailure  # noqa: E402
+from octoprint_powerfailure.checkpoint import CheckpointStore, unpack_recovery_settings  # noqa: E402
+from octoprint_powerfailure.metrics import clock  # noqa: E402
+
+import fakes  # noqa: E402
+import gcodegen  # noqa: E402
+
+PRINT = {"origin": "local", "path": "bench.gcode", "name": "bench.gcode"}
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q / 100.0 * len(samples)))]
+
+
+class Feeder(threading.Thread):
+    """sends the print's lines through the hooks at rate lines per second, over and over"""
+
+    def __init__(self, plugin, lines, rate):
+        super(Feeder, self).__init__()
+        self.daemon = True
+        self.plugin = plugin
+        self.lines = lines
+        self.rate = rate
+        self.sent = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        plugin = self.plugin
+        printer = plugin._printer
+        comm = fakes.FakeComm(printer)
+        start = time.time()
+        while not self.stopped.is_set():
+            line, pos = self.lines[self.sent % len(self.lines)]
+            printer.filepos = pos
+            plugin.hook_gcode_sending(comm, "sending", line, None, None, None)
+            plugin.hook_gcode_received(comm, "ok")
+            self.sent += 1
+            delay = start + self.sent / float(self.rate) - time.time()
+            if delay > 0:
+                self.stopped.wait(delay)
+
+
+class CountingWrite(object):
+    """wraps the store's write, counts the writes and records when each one returned"""
+
+    def __init__(self, store, delay):
+        self.write = store.write
+        self.delay = delay
+        self.count = 0
+        self.done = threading.Condition()
+
+    def __call__(self, payload):
+        if self.delay:
+            time.sleep(self.delay)
+        self.write(payload)
+        with self.done:
+            self.count += 1
+            self.done.notify_all()
+
+    def wait_past(self, count, timeout=5.0):
+        deadline = clock() + timeout
+        with self.done:
+            while self.count <= count and clock() < deadline:
+                self.done.wait(deadline - clock())
+            return self.count > count, clock()
+
+
+def start_print(workdir, source, lines, args, mode):
+    plugin = fakes.make_plugin(os.path.join(workdir, mode), checkpoint_mode=mode,
+                               safety_frequency=args.safety, power_signal_signal="SIGPWR")
+    fakes.install_gcode(plugin, source)
+    counter = CountingWrite(plugin.checkpoints.store, args.write_delay)
+    plugin.checkpoints.store.write = counter
+    plugin.on_event("PrintStarted", dict(PRINT))
+    feeder = Feeder(plugin, lines, args.rate)
+    feeder.start()
+    return plugin, counter, feeder
+
+
+def bench_writes(results, workdir, source, lines, args):
+    """checkpoint file writes in --seconds of printing"""
+    for mode in ("periodic", "power_signal"):
+        plugin, counter, feeder = start_print(workdir, source, lines, args, mode)
+        time.sleep(args.seconds)
+        feeder.stopped.set()
+        feeder.join()
+        written = counter.count
+        captures = plugin.metrics.counters["checkpoints_written"]
+        plugin.on_event("PrintDone", {})
+        plugin.on_shutdown()
+        results.append(dict(name="checkpoint_file_writes", mode=mode, seconds=args.seconds, value=written,
+                            captures=captures, lines=feeder.sent))
+        print("{0:<14} {1:>6} writes to the checkpoint file, {2} checkpoints taken, {3} lines in {4:.0f} s".format(
+            mode, written, captures, feeder.sent, args.seconds))
+
+
+def bench_latency(results, workdir, source, lines, args):
+    """from sending ONBATT (or SIGPWR) to the checkpoint write returning, while printing"""
+    plugin, counter, feeder = start_print(workdir, source, lines, args, "power_signal")
+    listener = plugin.power_signal
+    sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    by_source = {}
+    stale = []
+    #until the printer has executed a line there is nothing to checkpoint
+    time.sleep(1.0)
+    for n in range(args.notifications):
+        #let the print move on and the scheduler hold a few checkpoints in memory
+        time.sleep(0.05 + (n % 5) * 0.03)
+        via = "signal" if n % 2 and hasattr(signal, "SIGPWR") else "socket"
+        before = counter.count
+        received = listener.received
+        start = clock()
+        if via == "signal":
+            os.kill(os.getpid(), signal.SIGPWR)
+        else:
+            sender.sendto(b"ONBATT", listener.path)
+        ok, end = counter.wait_past(before)
+        if not ok:
+            print("no checkpoint written after notification {0}".format(n))
+            continue
+        by_source.setdefault(via, []).append(end - start)
+        #what the printer had been sent when the notification went out against what is on disk
+        store = CheckpointStore(plugin.checkpoints.path).open()
+        try:
+            on_disk = unpack_recovery_settings(store.read())["filepos"]
+        finally:
+            store.close()
+        stale.append(plugin._printer.filepos - on_disk)
+        while listener.received == received:
+            time.sleep(0.001)
+        sender.sendto(b"ONLINE", listener.path)
+        while listener.received == received + 1:
+            time.sleep(0.001)
+    sender.close()
+    feeder.stopped.set()
+    feeder.join()
+    histogram = plugin.metrics.histograms["power_signal_flush_seconds"]
+    plugin.on_event("PrintDone", {})
+    plugin.on_shutdown()
+    for via, samples in sorted(by_source.items()):
+        entry = dict(name="notification_to_disk", via=via, count=len(samples), write_delay=args.write_delay,
+                     p50_ms=percentile(samples, 50) * 1e3, p99_ms=percentile(samples, 99) * 1e3,
+                     max_ms=max(samples) * 1e3)
+        results.append(entry)
+        print("{0:<14} notification to disk p50 {1:.3f} ms  p99 {2:.3f} ms  max {3:.3f} ms  ({4} samples)".format(
+            via, entry["p50_ms"], entry["p99_ms"], entry["max_ms"], entry["count"]))
+    results.append(dict(name="plugin_flush_histogram", count=histogram.count,
+                        mean_ms=histogram.sum / max(1, histogram.count) * 1e3))
+    results.append(dict(name="bytes_behind_sent", max=max(stale), mean=sum(stale) / float(len(stale))))
+    print("checkpoint on disk behind the last line sent: max {0} bytes, mean {1:.0f}".format(
+        max(stale), sum(stale) / float(len(stale))))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=10.0, help="printing time for the write count")
+    parser.add_argument("--rate", type=int, default=300, help="lines sent per second")
+    parser.add_argument("--safety", type=float, default=300.0, help="safety_frequency in the power_signal mode")
+    parser.add_argument("--notifications", type=int, default=100)
+    parser.add_argument("--write-delay", type=float, default=0.0, help="seconds added to every checkpoint write")
+    parser.add_argument("--lines", type=int, default=20000, help="length of the generated print")
+    parser.add_argument("--output", default=None, help="write the results as JSON here")
+    args = parser.parse_args(argv)
+    #one line per notification otherwise
+    logging.getLogger("benchmarks.powerfailure").setLevel(logging.ERROR)
+
+    workdir = tempfile.mkdtemp(prefix="powerfailure-signal-")
+    results = []
+    try:
+        source = os.path.join(workdir, "bench.gcode")
+        gcodegen.write(source, "dense_arcs", args.lines)
+        lines = []
+        pos = 0
+        with open(source, "rb") as fh:
+            for raw in fh:
+                pos += len(raw)
+                line = raw.split(b";")[0].strip()
+                if line:
+                    lines.append((line.decode("utf-8"), pos))
+        bench_writes(results, workdir, source, lines, args)
+        bench_latency(results, workdir, source, lines, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = dict(
+        meta=dict(plugin_version=octoprint_powerfailure.__plugin_version__,
+                  python=platform.python_version(), platform=platform.platform(),
+                  args=vars(args), time=time.strftime("%Y-%m-%dT%H:%M:%S")),
+        results=results,
+    )
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
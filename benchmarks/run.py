@@ -0,0 +1,318 @@
+# coding=utf-8
+"""Microbenchmarks for the plugin's hot paths.
+
+Needs OctoPrint importable (the plugin module imports it) but no printer:
+the printer, file manager and settings are the fakes in fakes.py. Results are
+written as JSON so runs of different releases can be diffed:
+
+    python benchmarks/run.py --output before.json
+    python benchmarks/run.py --quick
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import gc
+import io
+import json
+import mmap
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import octoprint_powerfailure  # noqa: E402
+from octoprint_powerfailure.checkpoint import pack_recovery_settings  # noqa: E402
+from octoprint_powerfailure.gcode import GcodeState, reconstruct_state  # noqa: E402
+from octoprint_powerfailure.misc import reverse_readlines  # noqa: E402
+from octoprint_powerfailure.scheduler import CheckpointScheduler  # noqa: E402
+
+import fakes  # noqa: E402
+import gcodegen  # noqa: E402
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q / 100.0 * len(samples)))]
+
+
+class Results(object):
+    def __init__(self):
+        self.results = []
+
+    def add(self, name, value, unit, **params):
+        self.results.append(dict(name=name, params=params, value=value, unit=unit))
+        print("{0:<28} {1:<40} {2:>12.3f} {3}".format(
+            name, " ".join("{0}={1}".format(k, v) for k, v in sorted(params.items())), value, unit))
+
+
+def bench_hook(results, workdir, lines):
+    """hook_gcode_sending per line for every generator and tracking mode that does work in the hook"""
+    for generator in sorted(gcodegen.GENERATORS):
+        source = os.path.join(workdir, generator + ".gcode")
+        gcodegen.write(source, generator, lines)
+        sent = list(gcodegen.sent_lines(source))
+        for tracking in ("live", "async", "scan"):
+            plugin = fakes.make_plugin(os.path.join(workdir, "hook-" + tracking), state_tracking=tracking)
+            fakes.install_gcode(plugin, source)
+            plugin.on_event("PrintStarted", {"origin": "local", "path": "bench.gcode", "name": "bench.gcode"})
+            #the scheduler thread would take checkpoints during the run, only its bookkeeping is wanted here
+            plugin.checkpoints.scheduler.stop()
+            comm = fakes.FakeComm(plugin._printer)
+            hook = plugin.hook_gcode_sending
+            printer = plugin._printer
+            samples = []
+            clock = time.perf_counter if hasattr(time, "perf_counter") else time.time
+            gc.disable()
+            try:
+                for line in sent:
+                    printer.filepos += len(line) + 1
+                    start = clock()
+                    hook(comm, "sending", line, None, None, None)
+                    samples.append(clock() - start)
+            finally:
+                gc.enable()
+                plugin.on_event("PrintDone", {})
+            total = sum(samples)
+            results.add("hook_per_line", total / len(samples) * 1e6, "us",
+                        generator=generator, tracking=tracking, stat="mean")
+            for q in (50, 99):
+                results.add("hook_per_line", percentile(samples, q) * 1e6, "us",
+                            generator=generator, tracking=tracking, stat="p{0}".format(q))
+
+
+class RegexParser(object):
+    """the regexes hook_gcode_sending ran on every line before GcodeState, kept as the baseline"""
+
+    def __init__(self):
+        self.recovery_settings = {}
+        self.X_COORD_RE = re.compile(r".*\s+X([-]*\d*\.*\d*)")
+        self.Y_COORD_RE = re.compile(r".*\s+Y([-]*\d*\.*\d*)")
+        self.E_COORD_RE = re.compile(r".*\s+E([-]*\d*\.*\d*)")
+        self.SPEED_VAL_RE = re.compile(r".*\s+F(\d*\.*\d*)")
+
+    def process(self, cmd):
+        if (cmd.startswith("G1 ") or cmd.startswith("G92 ")) and ("E" in cmd):
+            m = self.E_COORD_RE.match(cmd)
+            if m:
+                self.recovery_settings["extruder"] = float(m.groups()[0])
+        if (cmd.startswith("G0 ") or cmd.startswith("G1 ")):
+            m = self.SPEED_VAL_RE.match(cmd)
+            if m:
+                self.recovery_settings["feedrate"] = float(m.groups()[0])
+            m = self.X_COORD_RE.match(cmd)
+            if m:
+                self.recovery_settings["last_X"] = float(m.groups()[0])
+            m = self.Y_COORD_RE.match(cmd)
+            if m:
+                self.recovery_settings["last_Y"] = float(m.groups()[0])
+        if cmd == "M82":
+            self.recovery_settings["extrusion"] = "M82"
+        if cmd == "M83":
+            self.recovery_settings["extrusion"] = "M83"
+        if cmd.startswith("M106") or cmd.startswith("M107"):
+            self.recovery_settings["last_fan"] = cmd
+        if cmd.startswith("M900"):
+            self.recovery_settings["linear_advance"] = cmd
+
+
+def bench_parser(results, workdir, lines):
+    """the regex parser against GcodeState, per line over every generator, without the rest of the hook"""
+    for generator in sorted(gcodegen.GENERATORS):
+        source = os.path.join(workdir, "parser-" + generator + ".gcode")
+        gcodegen.write(source, generator, lines)
+        sent = list(gcodegen.sent_lines(source))
+        os.remove(source)
+        for name, parser in (("regex", RegexParser()), ("gcode_state", GcodeState())):
+            process = parser.process
+            gc.disable()
+            try:
+                start = time.time()
+                for line in sent:
+                    process(line)
+                elapsed = time.time() - start
+            finally:
+                gc.enable()
+            results.add("parse_per_line", elapsed / len(sent) * 1e6, "us", generator=generator, parser=name)
+
+
+def bench_checkpoint(results, workdir, count):
+    """backupState with a changed key every call, so every call writes a checkpoint"""
+    plugin = fakes.make_plugin(os.path.join(workdir, "checkpoint"))
+    plugin.checkpoints.scheduler = CheckpointScheduler(plugin.backupState, 1.0)
+    printer = plugin._printer
+    start = time.time()
+    for i in range(count):
+        printer.filepos = i + 1
+        plugin.backupState()
+    elapsed = time.time() - start
+    results.add("backup_state", elapsed / count * 1e6, "us", checkpoints=count)
+
+    payload = pack_recovery_settings(plugin.recovery_settings)
+    start = time.time()
+    for _ in range(count):
+        plugin.checkpoints.store.write(payload)
+    elapsed = time.time() - start
+    results.add("write_recovery_settings", elapsed / count * 1e6, "us", checkpoints=count)
+
+    start = time.time()
+    for _ in range(count):
+        pack_recovery_settings(plugin.recovery_settings)
+    elapsed = time.time() - start
+    results.add("pack_recovery_settings", elapsed / count * 1e6, "us", checkpoints=count)
+    plugin.checkpoints.close()
+
+
+def bench_slow_writes(results, workdir, captures, write_delay=0.05, period=0.01):
+    """captures every period against a store whose writes take write_delay, like fsync on a slow SD card
+
+    inline: every capture waits for its write, as the checkpoint did on the timer thread before
+    the writer thread. queued: the capture hands the checkpoint over and returns.
+    """
+    for mode in ("inline", "queued"):
+        plugin = fakes.make_plugin(os.path.join(workdir, "slow-" + mode))
+        plugin.checkpoints.scheduler = CheckpointScheduler(plugin.backupState, 1.0)
+        writer = plugin.checkpoints.writer
+        store_write = plugin.checkpoints.store.write
+
+        def slow_write(payload):
+            time.sleep(write_delay)
+            store_write(payload)
+        plugin.checkpoints.store.write = slow_write
+        printer = plugin._printer
+        samples = []
+        lags = []
+        start = time.time()
+        for i in range(captures):
+            printer.filepos = i + 1
+            begin = time.time()
+            plugin.backupState()
+            if mode == "inline":
+                writer.flush()
+            samples.append(time.time() - begin)
+            lags.append(writer.lag())
+            #the timer fires every period, or as soon as it can when a capture overran it
+            time.sleep(max(0.0, start + (i + 1) * period - time.time()))
+        drift = time.time() - start - captures * period
+        plugin.checkpoints.close()
+        results.add("capture_latency", percentile(samples, 99) * 1e3, "ms", mode=mode, stat="p99")
+        results.add("capture_timer_drift", drift * 1e3, "ms", mode=mode, captures=captures)
+        results.add("checkpoint_write_lag", max(lags) * 1e3, "ms", mode=mode, stat="max")
+        results.add("checkpoints_coalesced", writer.coalesced, "count", mode=mode)
+        results.add("checkpoints_written", writer.written, "count", mode=mode)
+
+
+def bench_continuation(results, workdir, sizes):
+    """generateContinuation resuming from the middle of files of increasing size"""
+    for size in sizes:
+        for tracking in ("live", "scan"):
+            folder = os.path.join(workdir, "continuation-{0}-{1}".format(size, tracking))
+            plugin = fakes.make_plugin(folder, state_tracking=tracking)
+            source = plugin._file_manager.path_on_disk("local", "bench.gcode")
+            actual = gcodegen.write_size(source, size)
+            rs = plugin.recovery_settings
+            rs.update(filename="bench.gcode", filepos=actual // 2, currentZ=1.0, bedT=60, tool0T=210,
+                      last_X=10.0, last_Y=10.0, extrusion="M82", extruder=12.5, feedrate=1800.0)
+            start = time.time()
+            plugin.generateContinuation()
+            elapsed = time.time() - start
+            results.add("generate_continuation", elapsed * 1e3, "ms",
+                        size_mb=round(actual / 1e6, 1), tracking=tracking)
+            plugin.checkpoints.close()
+            shutil.rmtree(folder)
+
+
+def bench_scan_distance(results, workdir, size, fractions=(0.0, 0.1, 0.5, 0.9, 0.99)):
+    """reconstruct_state against the distance of filepos from the end of the file
+
+    The start gcode is at the top, so every rfind for a command that is never
+    repeated runs back to the start of the file: the closer filepos is to the
+    end, the longer the scan.
+    """
+    source = os.path.join(workdir, "scan.gcode")
+    actual = gcodegen.write_size(source, size)
+    with io.open(source, "rb") as fh:
+        data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for fraction in fractions:
+                #the start of the line the checkpoint would point at
+                filepos = data.rfind(b"\n", 0, int(actual * (1 - fraction))) + 1
+                start = time.time()
+                reconstruct_state(data, filepos)
+                elapsed = time.time() - start
+                results.add("reconstruct_state", elapsed * 1e3, "ms", size_mb=round(actual / 1e6, 1),
+                            from_end_mb=round((actual - filepos) / 1e6, 1))
+        finally:
+            data.close()
+    os.remove(source)
+
+
+def bench_reverse_readlines(results, workdir, size):
+    source = os.path.join(workdir, "reverse.gcode")
+    actual = gcodegen.write_size(source, size)
+    start = time.time()
+    count = 0
+    for _ in reverse_readlines(source, actual):
+        count += 1
+    elapsed = time.time() - start
+    results.add("reverse_readlines", actual / 1e6 / elapsed, "MB/s", size_mb=round(actual / 1e6, 1))
+    results.add("reverse_readlines", count / elapsed / 1e6, "Mlines/s", size_mb=round(actual / 1e6, 1))
+    os.remove(source)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="small inputs, for a smoke test")
+    parser.add_argument("--lines", type=int, default=None,
+                        help="lines per generated file for the hook benchmark (default 200000, 10000000 for a full run)")
+    parser.add_argument("--output", default=None, help="write the results as JSON here")
+    parser.add_argument("--keep", action="store_true", help="keep the generated files")
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        lines, checkpoints, sizes, reverse_size = 20000, 2000, [1 << 20, 16 << 20], 16 << 20
+    else:
+        lines, checkpoints, sizes, reverse_size = 200000, 20000, [1 << 20, 64 << 20, 512 << 20], 256 << 20
+    if args.lines:
+        lines = args.lines
+
+    workdir = tempfile.mkdtemp(prefix="powerfailure-bench-")
+    results = Results()
+    try:
+        bench_hook(results, workdir, lines)
+        bench_parser(results, workdir, lines)
+        bench_checkpoint(results, workdir, checkpoints)
+        bench_slow_writes(results, workdir, 50 if args.quick else 200)
+        bench_continuation(results, workdir, sizes)
+        bench_scan_distance(results, workdir, sizes[-1])
+        bench_reverse_readlines(results, workdir, reverse_size)
+    finally:
+        if args.keep:
+            print("generated files kept in " + workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = dict(
+        meta=dict(
+            plugin_version=octoprint_powerfailure.__plugin_version__,
+            python=platform.python_version(),
+            platform=platform.platform(),
+            cpus=os.cpu_count() if hasattr(os, "cpu_count") else None,
+            quick=args.quick,
+            time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        ),
+        results=results.results,
+    )
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+# coding=utf-8
+"""Thousands of prints started and ended every way OctoPrint can end them, on one plugin instance.
+
+Each cycle starts a print, sends a few lines through the hooks, takes a
+checkpoint or two and ends the print with PrintDone, PrintCancelled,
+PrintFailed, an Error event or another PrintStarted without any end, picked
+at random. Threads, open file descriptors and RSS are sampled after a warm-up
+and again at the end, a leak in any of them fails the run:
+
+    python benchmarks/soak.py --cycles 5000
+    python benchmarks/soak.py --tracking async --output soak.json
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import octoprint_powerfailure  # noqa: E402
+
+import fakes  # noqa: E402
+import gcodegen  # noqa: E402
+
+ENDINGS = ("PrintDone", "PrintCancelled", "PrintFailed", "Error", "restart")
+PRINT = {"origin": "local", "path": "bench.gcode", "name": "bench.gcode"}
+
+
+def open_fds():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def rss():
+    """resident set size in bytes, None where /proc is not there"""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError):
+        return None
+
+
+def sample():
+    return dict(threads=threading.active_count(), fds=open_fds(), rss=rss())
+
+
+def wait_threads(count, timeout=2.0):
+    """give threads that were told to stop a moment to be gone"""
+    deadline = time.time() + timeout
+    while threading.active_count() > count and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def cycle(plugin, comm, lines, rnd, counts):
+    printer = plugin._printer
+    printer.printing = True
+    printer.filepos = 0
+    plugin.on_event("PrintStarted", dict(PRINT))
+    for line, pos in lines[:rnd.randrange(1, len(lines))]:
+        printer.filepos = pos
+        plugin.hook_gcode_sending(comm, "sending", line, None, None, None)
+        plugin.hook_gcode_received(comm, "ok")
+    plugin.on_event("ZChange", {})
+    for _ in range(rnd.randrange(3)):
+        plugin.backupState()
+    ending = rnd.choice(ENDINGS)
+    counts[ending] = counts.get(ending, 0) + 1
+    if ending == "restart":
+        #the next cycle starts over a print that never ended
+        return
+    printer.printing = False
+    if ending == "PrintFailed":
+        plugin.on_event(ending, {"reason": "error"})
+    elif ending == "Error":
+        plugin.on_event(ending, {"error": "soak"})
+    else:
+        plugin.on_event(ending, {})
+    if rnd.random() < 0.1:
+        #handlers may run twice, OctoPrint sends Error and then PrintFailed
+        plugin.on_event("PrintFailed", {"reason": "error"})
+
+
+def soak(workdir, source, lines, args, tracking):
+    rnd = random.Random(args.seed)
+    before = sample()
+    plugin = fakes.make_plugin(os.path.join(workdir, tracking), state_tracking=tracking,
+                               track_acks=tracking != "async")
+    fakes.install_gcode(plugin, source)
+    comm = fakes.FakeComm(plugin._printer)
+    counts = {}
+    for _ in range(args.warmup):
+        cycle(plugin, comm, lines, rnd, counts)
+    plugin._end_print()
+    wait_threads(before["threads"] + 1)
+    warm = sample()
+    start = time.time()
+    for _ in range(args.cycles):
+        cycle(plugin, comm, lines, rnd, counts)
+    elapsed = time.time() - start
+    plugin._end_print()
+    wait_threads(warm["threads"])
+    end = sample()
+    #shutdown, twice, has to leave nothing of the plugin running
+    plugin.on_shutdown()
+    plugin.on_shutdown()
+    wait_threads(before["threads"])
+    closed = sample()
+
+    problems = []
+    if end["threads"] != warm["threads"]:
+        problems.append("threads went from {0} to {1}".format(warm["threads"], end["threads"]))
+    if end["fds"] != warm["fds"]:
+        problems.append("open fds went from {0} to {1}".format(warm["fds"], end["fds"]))
+    if end["rss"] is not None and end["rss"] - warm["rss"] > args.rss_slack * (1 << 20):
+        problems.append("rss grew by {0:.1f} MB".format((end["rss"] - warm["rss"]) / float(1 << 20)))
+    if closed["threads"] != before["threads"]:
+        problems.append("{0} threads left after shutdown".format(closed["threads"] - before["threads"]))
+    if closed["fds"] != before["fds"]:
+        problems.append("{0} fds left open after shutdown".format(closed["fds"] - before["fds"]))
+    return dict(tracking=tracking, cycles=args.cycles, endings=counts, seconds=elapsed,
+                before=before, warm=warm, end=end, closed=closed, problems=problems)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cycles", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=100, help="cycles run before the first sample")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--lines", type=int, default=2000, help="length of the generated print")
+    parser.add_argument("--tracking", action="append", default=None,
+                        help="state_tracking setting, can be repeated (default live and async)")
+    parser.add_argument("--rss-slack", type=float, default=4.0, help="RSS growth in MB still counted as flat")
+    parser.add_argument("--output", default=None, help="write the results as JSON here")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="powerfailure-soak-")
+    try:
+        source = os.path.join(workdir, "bench.gcode")
+        gcodegen.write(source, "dense_arcs", args.lines, seed=args.seed)
+        lines = []
+        pos = 0
+        with open(source, "rb") as fh:
+            for raw in fh:
+                pos += len(raw)
+                line = raw.split(b";")[0].strip()
+                if line:
+                    lines.append((line.decode("utf-8"), pos))
+        runs = [soak(workdir, source, lines, args, tracking) for tracking in args.tracking or ("live", "async")]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for run in runs:
+        print(json.dumps(run, sort_keys=True))
+    report = dict(
+        meta=dict(plugin_version=octoprint_powerfailure.__plugin_version__,
+                  python=platform.python_version(), platform=platform.platform(),
+                  args=vars(args), time=time.strftime("%Y-%m-%dT%H:%M:%S")),
+        runs=runs,
+    )
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+    problems = [run["tracking"] + ": " + problem for run in runs for problem in run["problems"]]
+    for problem in problems:
+        print("LEAK " + problem)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,57 +2,96 @@
 from __future__ import absolute_import
 
 import octoprint.plugin
-from octoprint.util import RepeatedTimer
+from octoprint.access.permissions import Permissions
+import copy
+import flask
 import io
+import mmap
 import os
-import re
 import json
-from .misc import reverse_readlines, sanitize_number
+import signal
+import threading
+from . import compressed, power
+from .checkpoint import SLOT_SIZE, FieldTooLong, RecoveryState, pack_recovery_settings, unpack_recovery_settings
+from .config import TEMPLATE_KEYS, SettingsSnapshot, compile_templates
+from .fingerprint import compare as compare_fingerprint, file_fingerprint, region_crc
+from .gcode import GcodeState, reconstruct_state
+from .index import IndexStore
+from .inflight import InflightRing
+from .metrics import HOOK_SAMPLE_MASK, Metrics, clock, peak_allocated
+from .service import CheckpointService
+from .tracking import AsyncTracker
+from .power import PowerSignalListener
+from .misc import copy_from_offset, reverse_readlines, sanitize_number
+
+
+#mm/min for the retraction put back at the recovery point
+RETRACT_FEEDRATE = 1800
+#mm/min for lowering the nozzle to the layer a resume from a layer start continues with
+LAYER_Z_FEEDRATE = 200
 
 
 class PowerFailurePlugin(octoprint.plugin.TemplatePlugin,
+                         octoprint.plugin.AssetPlugin,
                          octoprint.plugin.EventHandlerPlugin,
                          octoprint.plugin.StartupPlugin,
+                         octoprint.plugin.ShutdownPlugin,
                          octoprint.plugin.WizardPlugin,
                          octoprint.plugin.SettingsPlugin,
+                         octoprint.plugin.SimpleApiPlugin,
                          octoprint.plugin.RestartNeedingPlugin):
 
     def __init__(self):
         super(PowerFailurePlugin, self).__init__()
         self.will_print = ""
+        #recovery is prepared on a worker thread and offered once the printer is connected
+        self.prepared_recovery = None
+        self._recovery_lock = threading.Lock()
+        self._preparing = False
+        self._connected = False
+        #last recovery state sent to the UI, see _send_recovery_state
+        self._recovery_message = None
         self.datafolder = None
         self.datafile = "powerfailure_recovery.json"
         self.recovery_path = None
+        self.checkpointfile = "powerfailure_recovery.ckpt"
+        #settings as of the last save, replaced as a whole and never modified, see SettingsSnapshot
+        self.config = None
+        #checkpoint store, writer thread and the scheduler of the current print
+        self.checkpoints = None
+        #power-fail notifications, only listened to in the power_signal checkpoint mode
+        self.powersocket = "power.sock"
+        self.power_signal = None
+        self.on_battery = False
+        self._signal_handler = None
+        self._power_signal_config = None
+        #the scheduler and a power-fail notification can both take a checkpoint
+        self._capture_lock = threading.Lock()
+        #why checkpoints were refused or cut short, each logged once per print
+        self._capture_problems = set()
+        self.index_store = None
+        #header and position of a resume that streams from the original file, see resume_method
+        self.virtualfile = "virtual_resume.json"
+        self.virtual_resume = None
+        #recovery header of a virtual resume being started, handed to the beforePrintStarted script hook
+        self._virtual_header = None
         #various things we can track while watching the queue
         self.extrusion = None
         self.last_fan = None
         self.linear_advance = None
-        self.last_tool = None
+        self.gcode_state = GcodeState()
+        self.track_live = True
+        self.tracker = None
+        #fingerprint of the file being printed and the file itself, open for the region crc of each checkpoint
+        self._print_fingerprint = None
+        self._print_file = None
+        #lines sent but not executed yet, see track_acks
+        self.inflight = None
+        self.metrics = Metrics()
         #increment this value with each release
         self.wizardVersion = 2
 
-        self.recovery_settings = {
-            "bedT": 0,
-            "tool0T": 0,
-            "filepos": 0,
-            "filename": None,
-            "currentZ": 0,
-            "last_X": 0,
-            "last_Y": 0,
-            "recovery": False,
-            "powerloss": False,
-            "extruder": None,
-            "extrusion": None,
-            "feedrate": None,
-            "last_fan": None,
-            "linear_advance": None
-        }
-
-        self.MOVE_RE = re.compile("^G0\s+|^G1\s+")
-        self.X_COORD_RE = re.compile(r".*\s+X([-]*\d*\.*\d*)")
-        self.Y_COORD_RE = re.compile(r".*\s+Y([-]*\d*\.*\d*)")
-        self.E_COORD_RE = re.compile(r".*\s+E([-]*\d*\.*\d*)")
-        self.SPEED_VAL_RE = re.compile(r".*\s+F(\d*\.*\d*)")
+        self.recovery_settings = RecoveryState()
 
 
     def get_settings_defaults(self):
@@ -60,6 +99,36 @@ class PowerFailurePlugin(octoprint.plugin.TemplatePlugin,
             auto_continue=False,
             z_homing_height=0,
             save_frequency=1.0,
+            checkpoint_bytes=4096,
+            checkpoint_max_rate=5.0,
+            #periodic: write every checkpoint, power_signal: hold them in memory and write the newest
+            #on a power-fail notification and every safety_frequency seconds
+            checkpoint_mode="periodic",
+            safety_frequency=300.0,
+            #Unix datagram socket for the notifications, empty for power.sock in the data folder
+            power_signal_socket="",
+            #signal that counts as a power-fail notification, empty for none
+            power_signal_signal="SIGPWR",
+            #live: parse every sent line, scan: rebuild the state from the file at recovery time,
+            #index: look the state up in an index built when the file is uploaded
+            #async: like live, but parsed on a worker thread instead of the printer thread
+            state_tracking="live",
+            async_queue=4096,
+            #block: the printer thread waits for the worker, resync: drop the backlog and rescan the file
+            async_overflow="block",
+            #processes used to build the index, 0 is one per core
+            index_workers=0,
+            #position: resume where the checkpoint was taken, layer: from the start of that layer
+            resume_mode="position",
+            resume_layers_back=0,
+            #checkpoint the last line the printer executed instead of the last one sent
+            track_acks=True,
+            #commands the firmware may hold after acknowledging them, Marlin's BLOCK_BUFFER_SIZE
+            planner_depth=16,
+            #copy: write recovery_<name> with the rest of the file, virtual: print the original from filepos
+            resume_method="copy",
+            #refuse: do not recover into a file that changed since the print started, warn: log and recover
+            fingerprint_mismatch="refuse",
             klipper_z=False,
             z_sag=0.0,
             xy_feed=3000,
@@ -78,9 +147,10 @@ class PowerFailurePlugin(octoprint.plugin.TemplatePlugin,
             #4 extrusion/priming
             gcode_temp = (";M80 ; power on printer\n"
                     "M140 S{bedT}\n"
-                    "M104 S{tool0T}\n"
+                    "{chamber_heat}\n"
+                    "{tool_heat}\n"
                     "M190 S{bedT}\n"
-                    "M109 S{tool0T}\n"),
+                    "{tool_wait}\n"),
             gcode_xy = ("G21 ;metric values\n"
                     "{klipper_z}\n"
                     "{enable_z}\n"
@@ -103,115 +173,565 @@ class PowerFailurePlugin(octoprint.plugin.TemplatePlugin,
         )
 
     def initialize(self):
+        self._load_config()
         self.datafolder = self.get_plugin_data_folder()
         self.recovery_path = os.path.join(self.datafolder, self.datafile)
+        self.checkpoints = CheckpointService(os.path.join(self.datafolder, self.checkpointfile), self._logger,
+                                             on_written=self._observe_checkpoint_write).open()
+        self.index_store = IndexStore(os.path.join(self.datafolder, "index"))
+        self._load_virtual_resume()
+        self._start_power_signal()
+
+    def _load_config(self):
+        config = SettingsSnapshot.from_settings(self._settings)
+        for problem in config.template_errors.values():
+            self._logger.error("Invalid recovery gcode, recovery will fail until it is fixed: {0}".format(problem))
+        self.config = config
+
+    def on_settings_save(self, data):
+        #a block that does not compile is not saved, the previous one stays in place
+        for key in TEMPLATE_KEYS:
+            if key in data:
+                try:
+                    compile_templates({key: data[key]})
+                except ValueError as e:
+                    self._logger.error("Not saving {0}: {1}".format(key, e))
+                    self._plugin_manager.send_plugin_message(self._identifier,
+                                                             dict(type="settings", state="invalid", key=key, error=str(e)))
+                    del data[key]
+        saved = octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        self._load_config()
+        self._start_power_signal()
+        self.checkpoints.safety_interval = self._safety_interval()
+        return saved
 
     def _get_recovery_settings(self):
+        payload = self.checkpoints.read()
+        if payload is not None:
+            self.recovery_settings = unpack_recovery_settings(payload)
+            return
+        #no valid checkpoint slot, fall back to a json file from older versions
         try:
             with open (self.recovery_path, 'r') as recovery_settings:
-                self.recovery_settings = json.load(recovery_settings)
+                self.recovery_settings = RecoveryState.from_dict(json.load(recovery_settings))
         except:
-            print("Raise some exception here")
+            self._logger.debug("No valid checkpoint found")
+
+    def _write_recovery_settings(self, flush=True):
+        #packed here, the writer thread only ever sees bytes
+        if self.checkpoints.submit(self._pack_recovery_settings(), flush=flush):
+            self.metrics.counters["checkpoints_coalesced"] += 1
+
+    def _pack_recovery_settings(self):
+        rs = self.recovery_settings
+        while True:
+            try:
+                return pack_recovery_settings(rs)
+            except FieldTooLong as e:
+                #recovery needs the exact path, a fan or M900 line is only restored if it is there
+                if e.field not in ("last_fan", "linear_advance"):
+                    raise
+                self._capture_problem("{0}, left out of the checkpoint".format(e), self._logger.warning)
+                rs[e.field] = None
+
+    def _capture_problem(self, message, log, exc_info=False):
+        """log why a checkpoint was refused or cut short, once per print"""
+        if message not in self._capture_problems:
+            self._capture_problems.add(message)
+            log(message, exc_info=exc_info)
 
-    def _write_recovery_settings(self):
-        settings_json = json.dumps(self.recovery_settings, indent=4)
+    def _observe_checkpoint_write(self, seconds, lag):
+        metrics = self.metrics
+        metrics.histograms["checkpoint_write_seconds"].observe(seconds)
+        metrics.histograms["checkpoint_lag_seconds"].observe(lag)
+        #the msync writes back the whole slot
+        metrics.counters["checkpoint_bytes_written"] += SLOT_SIZE
+
+    def _export_recovery_settings(self):
+        #human readable copy of the checkpoint, never written on the checkpoint path
+        settings_json = json.dumps(self.recovery_settings.as_dict(), indent=4)
         with open(self.recovery_path, "w") as settings_file:
             settings_file.write(settings_json)
             settings_file.flush()
             os.fsync(settings_file.fileno())
         settings_file.close()
 
+    def _safety_interval(self):
+        """how long the service may hold checkpoints in memory, None to write every one"""
+        config = self.config
+        if config.checkpoint_mode != "power_signal" or self.on_battery or self.power_signal is None:
+            return None
+        return config.safety_frequency
+
+    def _start_power_signal(self):
+        """listen for power-fail notifications in the power_signal mode, stop listening otherwise"""
+        config = self.config
+        path = config.power_signal_socket or os.path.join(self.datafolder, self.powersocket)
+        wanted = (path, config.power_signal_signal) if config.checkpoint_mode == "power_signal" else None
+        if self.power_signal is not None and wanted == self._power_signal_config:
+            return
+        self._stop_power_signal()
+        self._power_signal_config = wanted
+        if wanted is None:
+            return
+        if not power.supported():
+            self._logger.error("The power_signal checkpoint mode needs Unix sockets, writing every checkpoint")
+            return
+        try:
+            listener = PowerSignalListener(path, self._on_power_signal).open()
+        except Exception:
+            self._logger.exception("Could not listen for power notifications on {0}, "
+                                   "writing every checkpoint".format(path))
+            return
+        listener.start()
+        self.power_signal = listener
+        self._logger.info("Listening for power notifications on {0}".format(path))
+        name = config.power_signal_signal
+        if not name:
+            return
+        signum = getattr(signal, name, None)
+        if not isinstance(signum, int):
+            self._logger.warning("Unknown signal {0}, power notifications only come in on {1}".format(name, path))
+            return
+        try:
+            previous = signal.signal(signum, self._on_power_signal_signal)
+        except ValueError:
+            #only the main thread can set handlers
+            self._logger.warning("Could not handle {0}, power notifications only come in on {1}".format(name, path))
+            return
+        self._signal_handler = (signum, previous)
+
+    def _stop_power_signal(self):
+        if self._signal_handler is not None:
+            signum, previous = self._signal_handler
+            self._signal_handler = None
+            try:
+                signal.signal(signum, previous if previous is not None else signal.SIG_DFL)
+            except ValueError:
+                pass
+        listener, self.power_signal = self.power_signal, None
+        if listener is not None:
+            listener.stop()
+
+    def _on_power_signal_signal(self, signum, frame):
+        #next to nothing can be done safely in a signal handler, the listener thread does the rest
+        listener = self.power_signal
+        if listener is not None:
+            listener.notify("POWERFAIL")
+
+    def _on_power_signal(self, state, word, received):
+        """called on the listener thread for every power notification"""
+        if state == "restored":
+            self.on_battery = False
+            self.checkpoints.safety_interval = self._safety_interval()
+            self._logger.info("Power restored ({0}), checkpoints are held in memory again".format(word))
+            return
+        #the power can go at any moment from now on, every checkpoint goes to disk
+        self.on_battery = True
+        self.checkpoints.safety_interval = None
+        try:
+            written = self.backupState()
+            #the newest checkpoint held in memory before the notification goes to disk as well
+            written = self.checkpoints.release() or written
+            persisted = self.checkpoints.persist(timeout=5.0)
+        except Exception:
+            self._logger.exception("Could not write the checkpoint on power failure ({0})".format(word))
+            return
+        if not written:
+            #not printing, or the checkpoint on disk is still current
+            self._logger.warning("Power failure ({0}), no new checkpoint to write".format(word))
+            return
+        elapsed = clock() - received
+        self.metrics.counters["power_signals"] += 1
+        self.metrics.histograms["power_signal_flush_seconds"].observe(elapsed)
+        if persisted:
+            self._logger.warning("Power failure ({0}), checkpoint on disk {1:.1f} ms later".format(word, elapsed * 1e3))
+        else:
+            self._logger.error("Power failure ({0}), checkpoint still not on disk after {1:.1f} s".format(word, elapsed))
+
+    def on_after_startup(self):
+        #have the recovery job ready before the printer connects
+        self._start_preparation()
+
+    def _send_recovery_state(self, state, **data):
+        data.update(type="recovery", state=state)
+        #kept for browsers that connect later, preparation usually runs before any is open
+        self._recovery_message = data
+        self._plugin_manager.send_plugin_message(self._identifier, data)
+
+    def _start_preparation(self):
+        with self._recovery_lock:
+            if self._preparing or self.prepared_recovery is not None:
+                return
+            self._preparing = True
+        thread = threading.Thread(target=self._prepare_recovery)
+        thread.daemon = True
+        thread.start()
+
+    def _prepare_recovery(self):
+        recovery_fn = None
+        try:
+            recovery_fn = self.check_recovery()
+        except Exception as e:
+            self._logger.exception("Could not prepare the recovery")
+            self._send_recovery_state("failed", error=str(e))
+        with self._recovery_lock:
+            self._preparing = False
+            self.prepared_recovery = recovery_fn
+            connected = self._connected
+        if connected:
+            self._offer_recovery()
+
+    def _validate_recovery(self):
+        """reason the checkpoint cannot be resumed, None if it can"""
+        rs = self.recovery_settings
+        if not rs["filename"]:
+            return "the checkpoint has no file name"
+        original_fn = self._file_manager.path_on_disk("local", rs["filename"])
+        if not os.path.isfile(original_fn):
+            return "{0} does not exist anymore".format(rs["filename"])
+        if not compressed.is_gzip(original_fn) and rs["filepos"] > os.path.getsize(original_fn):
+            return "{0} is shorter than the recovery position {1}".format(rs["filename"], rs["filepos"])
+        fingerprint = rs.get("fingerprint")
+        if fingerprint is not None:
+            problem, warning = compare_fingerprint(original_fn, fingerprint, rs["filepos"])
+            if warning is not None:
+                self._logger.warning("{0}: {1}".format(rs["filename"], warning))
+            if problem is not None:
+                problem = "{0} is not the file that was printed, {1}".format(rs["filename"], problem)
+                if self.config.fingerprint_mismatch == "refuse":
+                    return problem
+                self._logger.warning("Recovering anyway: {0}".format(problem))
+        return None
+
     def check_recovery(self):
+        """generate the recovery job if the last print failed, returns its path or None"""
         self._logger.debug("Checking recovery")
         self._get_recovery_settings()
         rs = self.recovery_settings
-        if rs["recovery"]:
-            self._logger.info("Recovering from a print failure")
-            recovery_fn = self.generateContinuation()
+        if not rs["recovery"]:
+            self._logger.debug("There was no print failure.")
+            return None
+        self._logger.info("Recovering from a print failure")
+        self._export_recovery_settings()
+        problem = self._validate_recovery()
+        if problem is not None:
+            #the exported json keeps what the checkpoint said
+            self._logger.error("Cannot recover: {0}".format(problem))
+            self._send_recovery_state("failed", error=problem)
             self.clean()
-            if self._settings.getBoolean(["auto_continue"]):
-                self.will_print = recovery_fn
+            return None
+        self._send_recovery_state("preparing", path=rs["filename"], filepos=rs["filepos"])
+        start = clock()
+        recovery_fn, peak = peak_allocated(self.generateContinuation)
+        self._observe_continuation(clock() - start, recovery_fn, peak)
+        #the checkpoint stays until the next print replaces it, a restart before the printer has
+        #taken the job prepares and offers it again; generating moved filepos and rebuilt the state
+        #in memory, an Error or PrintFailed event writing that back would move it further each time
+        self._get_recovery_settings()
+        self._send_recovery_state("ready", path=recovery_fn, seconds=clock() - start)
+        return recovery_fn
 
-            self._printer.select_file(
-                recovery_fn, False, printAfterSelect=False)  # selecciona directo
+    def _offer_recovery(self):
+        """select the prepared job, and start it with auto_continue"""
+        with self._recovery_lock:
+            recovery_fn, self.prepared_recovery = self.prepared_recovery, None
+        if recovery_fn is None:
+            return
+        if self.config.auto_continue:
+            self.will_print = recovery_fn
+        if self.virtual_resume is not None:
+            #never selected, Print would start the original from its beginning; _start_recovery selects it
+            if not self.config.auto_continue:
+                self._logger.info("Virtual resume of {0} ready, start it with the resume API command".format(recovery_fn))
+            self._send_recovery_state("waiting", path=recovery_fn, auto=self.config.auto_continue)
+            return
+
+        self._printer.select_file(
+            recovery_fn, False, printAfterSelect=False)  # selecciona directo
+        self._send_recovery_state("selected", path=recovery_fn, auto=self.config.auto_continue)
+
+    def _start_recovery(self, path):
+        resume = self.virtual_resume
+        if resume is not None and resume["path"] == path:
+            #the header goes in through the beforePrintStarted script hook, which may run before or after
+            #PrintStarted reaches on_event, so it gets its own copy rather than reading virtual_resume
+            self._printer.select_file(path, False, printAfterSelect=False)
+            self._virtual_header = resume["header"]
+            try:
+                self._printer.start_print(pos=resume["pos"])
+            except Exception:
+                self._virtual_header = None
+                raise
         else:
-            self._logger.debug("There was no print failure.")
+            self._printer.select_file(path, False, printAfterSelect=True)
 
-    def generateContinuation(self):
-        #establish all locals
+    def _load_virtual_resume(self):
+        try:
+            with io.open(os.path.join(self.datafolder, self.virtualfile), "r") as fh:
+                self.virtual_resume = json.load(fh)
+        except (IOError, OSError, ValueError):
+            self.virtual_resume = None
+
+    def _save_virtual_resume(self, path, pos, header):
+        self.virtual_resume = dict(path=path, pos=pos, header=header)
+        virtual_fn = os.path.join(self.datafolder, self.virtualfile)
+        with io.open(virtual_fn + ".tmp", "w") as fh:
+            fh.write(json.dumps(self.virtual_resume))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(virtual_fn + ".tmp", virtual_fn)
+
+    def _drop_virtual_resume(self):
+        self.virtual_resume = None
+        try:
+            os.remove(os.path.join(self.datafolder, self.virtualfile))
+        except OSError:
+            pass
+
+    def _observe_continuation(self, seconds, recovery_fn, peak):
+        metrics = self.metrics
+        metrics.counters["continuations"] += 1
+        metrics.histograms["continuation_seconds"].observe(seconds)
+        if peak is not None:
+            metrics.gauges["continuation_peak_alloc_bytes"] = peak
+        if self.virtual_resume is not None:
+            metrics.gauges["continuation_bytes"] = len(self.virtual_resume["header"])
+        else:
+            try:
+                metrics.gauges["continuation_bytes"] = os.path.getsize(
+                    self._file_manager.path_on_disk("local", recovery_fn))
+            except OSError:
+                pass
+        self._logger.debug("Recovery file generated in {0:.3f}s".format(seconds))
+
+    def _reconstruct_recovery_settings(self):
+        """rebuild the modal state by scanning the original file backwards from filepos"""
         rs = self.recovery_settings
-        filename = rs["filename"]
-        filepos = rs["filepos"]
+        original_fn = self._file_manager.path_on_disk("local", rs["filename"])
+        with io.open(original_fn, "rb") as original:
+            data = mmap.mmap(original.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                state = reconstruct_state(data, rs["filepos"])
+            finally:
+                data.close()
+        rs.update(state.as_recovery_settings())
+
+    def _index_recovery_settings(self):
+        """look the modal state up in the file's index, scan the file if there is no valid index"""
+        rs = self.recovery_settings
+        original_fn = self._file_manager.path_on_disk("local", rs["filename"])
+        index = self.index_store.get(original_fn)
+        if index is None:
+            self._logger.info("No up to date index for {0}, scanning the file instead".format(rs["filename"]))
+            self._reconstruct_recovery_settings()
+            return
+        rs.update(index.state_at(rs["filepos"]).as_recovery_settings())
+
+    def _build_index(self, path):
+        workers = self.config.index_workers or None
+        try:
+            self.index_store.build(path, workers=workers)
+            self._logger.debug("Indexed {0}".format(path))
+        except Exception:
+            self._logger.exception("Could not index {0}".format(path))
+
+    def _recovery_analysis(self, original_fn, filepos):
+        """the original's analysis scaled down to what is left after filepos, None if it has none"""
+        try:
+            metadata = self._file_manager.get_metadata("local", self.recovery_settings["filename"])
+        except Exception:
+            metadata = None
+        analysis = (metadata or {}).get("analysis")
+        if not analysis:
+            return None
+        analysis = copy.deepcopy(analysis)
+        index = self.index_store.get(original_fn)
+        if index is not None and index.total_time:
+            seconds, filament = index.remaining(filepos)
+            time_left = seconds / index.total_time
+            filament_left = dict((tool, filament[tool] / total)
+                                 for tool, total in index.total_filament.items() if total)
+        else:
+            #without an index time and filament are taken to be spread evenly over the file
+            size = os.path.getsize(original_fn)
+            time_left = float(size - filepos) / size if size else 0.0
+            filament_left = {}
+        #the printed area can only shrink, the original's dimensions stay a valid bound
+        if analysis.get("estimatedPrintTime"):
+            analysis["estimatedPrintTime"] *= time_left
+        for name, tool in (analysis.get("filament") or {}).items():
+            number = int(name[4:]) if name.startswith("tool") and name[4:].isdigit() else None
+            left = filament_left.get(number, time_left)
+            for key in ("length", "volume"):
+                if tool.get(key):
+                    tool[key] *= left
+        return analysis
+
+    def _build_gzip_index(self, path):
+        try:
+            if compressed.is_gzip(path):
+                self.index_store.gzip_index(path)
+                self._logger.debug("Indexed compressed file {0}".format(path))
+        except Exception:
+            self._logger.exception("Could not index {0}".format(path))
+
+    def _move_to_layer_start(self):
+        """move filepos back to the start of its layer (or resume_layers_back before it)
+
+        Returns the height of that layer, None if filepos did not move.
+        """
+        rs = self.recovery_settings
+        original_fn = self._file_manager.path_on_disk("local", rs["filename"])
+        table = self.index_store.layers(original_fn)
+        start = table.layer_start(rs["filepos"], self.config.resume_layers_back)
+        if start is None:
+            self._logger.info("No layer start found before {0}, resuming from there".format(rs["filepos"]))
+            return None
+        self._logger.info("Resuming from the layer starting at {0} (Z{1})".format(*start))
+        rs["filepos"] = start[0]
+        return start[1]
+
+    def _template_values(self, rs, config):
+        """what the recovery gcode blocks can refer to, for the checkpoint rs"""
         currentZ = rs["currentZ"]
-        last_X = rs["last_X"]
-        last_Y = rs["last_Y"]
-        bedT = rs["bedT"]
-        tool0T = rs["tool0T"]
-        extruder = rs["extruder"]
-        extrusion = rs["extrusion"]
-        feedrate = rs["feedrate"]
-        linear_advance = rs["linear_advance"]
-        last_fan = rs["last_fan"]
-
-        z_homing_height = self._settings.getFloat(["z_homing_height"])
-        prime_len = self._settings.getFloat(["prime_len"])
-        z_sag = self._settings.getFloat(["z_sag"])
-        xy_feed = self._settings.getFloat(["xy_feed"])
+        z_homing_height = config.z_homing_height
         enable_z = "; Z enable is not checked\n"
         klipper_z = "; Klipper Z is not checked"
-
-        #Create any locals that are referenced in gcode blocks
         #handle klipper which will just move to Z=z_hop if below, so find the difference 
-        if (self._settings.getBoolean(["klipper_z"])):
+        if config.klipper_z:
             if (currentZ >= z_homing_height):
                 z_homing_height = 0
             else:
                 z_homing_height = z_homing_height - currentZ
             klipper_z = "SET_KINEMATIC_POSITION x=50 y=50 z={};\n".format(currentZ)
-
-        if self._settings.getBoolean(["enable_z"]):
+        if config.enable_z:
             enable_z = "G91\nG1 Z0.2 F200\nG1 Z-0.2\n"
+        values = dict((key, rs[key]) for key in ("filename", "filepos", "currentZ", "last_X", "last_Y", "bedT",
+                                                 "tool0T", "extruder", "extrusion", "feedrate",
+                                                 "linear_advance", "last_fan"))
+        values.update(z_homing_height=z_homing_height, prime_len=config.prime_len, z_sag=config.z_sag,
+                      xy_feed=config.xy_feed, enable_z=enable_z, klipper_z=klipper_z,
+                      adjustedZ=currentZ + z_homing_height)
+        #every heater is switched on before waiting for any of them, so they heat up together
+        heated = [(tool, rs.tool_temps[tool]) for tool in rs.tools_in_use() if rs.tool_temps.get(tool)]
+        values.update(
+            tool=rs.tool, chamberT=rs.chamberT, retracted=rs.retracted,
+            tool_heat="\n".join("M104 T{0} S{1}".format(*heater) for heater in heated) or "; no tool temperature",
+            tool_wait="\n".join("M109 T{0} S{1}".format(*heater) for heater in heated) or "; no tool temperature",
+            chamber_heat="M141 S{0}".format(rs.chamberT) if rs.chamberT else "; no chamber temperature",
+            chamber_wait="M191 S{0}".format(rs.chamberT) if rs.chamberT else "; no chamber temperature",
+        )
+        return values
 
-        adjustedZ = currentZ + z_homing_height
+    def _render_header(self, rs, config, templates=None, layer_z=None):
+        """the recovery gcode sent before the rest of the file, templates overrides the saved blocks
 
-        #Establish gcode blocks
-        gcode_temp = self._settings.get(["gcode_temp"]).format(**locals())
-        gcode_xy = self._settings.get(["gcode_xy"]).format(**locals())
-        gcode_z = self._settings.get(["gcode_z"]).format(**locals())
-        gcode_prime = self._settings.get(["gcode_prime"]).format(**locals())
+        layer_z is the height of the layer the file continues with when it does not continue
+        at the checkpoint, the nozzle goes down there once it is over the print.
+        """
+        if templates:
+            #only for previews of blocks that are not saved yet
+            config = config._replace(templates=dict(config.templates, **templates),
+                                     template_errors=dict((key, error) for key, error in config.template_errors.items()
+                                                          if key not in templates))
+        gcode_temp, gcode_xy, gcode_z, gcode_prime = config.render(self._template_values(rs, config))
 
         #Append modifications to our various gcodes blocks based on settings here
         #Could make these all locals, but then would have to handle None assignments.
-        if last_fan:
-            gcode_prime += last_fan + "\n" 
-        if feedrate:
-            gcode_prime += "G0 F" + str(feedrate) + "\n"
-        if extrusion == "M82":
-            gcode_prime += "G92 E" + str(extruder) + "\n"
-        if linear_advance:
-            gcode_prime += linear_advance + "\n"
-        if z_sag:
-            sag = "G91\nG1 Z" + str(z_sag) + " ; z_sag value\nG90\n"
+        if rs.tool or len(rs.tools_in_use()) > 1:
+            #prime the tool that was printing, not whichever the firmware selects after a reset
+            gcode_prime = "T{0}\n".format(rs.tool) + gcode_prime
+        if rs.fw_retracted:
+            #the file continues with the G11 that matches it
+            gcode_prime += "G10\n"
+        elif rs.retracted:
+            #the file continues with the move that undoes it
+            gcode_prime += "M83\nG1 E-{0} F{1}\n".format(round(rs.retracted, 5), RETRACT_FEEDRATE)
+            if rs.extrusion == "M82":
+                gcode_prime += "M82\n"
+        if layer_z is not None:
+            #G92 Z took the height the nozzle stopped at, layers back the print continues lower
+            gcode_prime += "G1 Z{0} F{1}\n".format(layer_z, LAYER_Z_FEEDRATE)
+        if rs["last_fan"]:
+            gcode_prime += rs["last_fan"] + "\n" 
+        if rs["feedrate"]:
+            gcode_prime += "G0 F" + str(rs["feedrate"]) + "\n"
+        if rs["extrusion"] == "M82":
+            gcode_prime += "G92 E" + str(rs["extruder"]) + "\n"
+        if rs["linear_advance"]:
+            gcode_prime += rs["linear_advance"] + "\n"
+        if config.z_sag:
+            sag = "G91\nG1 Z" + str(config.z_sag) + " ; z_sag value\nG90\n"
             gcode_z = sag + gcode_z
- 
-        original_fn = self._file_manager.path_on_disk("local", filename)
+        return gcode_temp + gcode_xy + gcode_z + gcode_prime
+
+    def generateContinuation(self):
+        config = self.config
+        tracking = config.state_tracking
+        original_fn = self._file_manager.path_on_disk("local", self.recovery_settings["filename"])
+        gzipped = compressed.is_gzip(original_fn)
+        layer_z = None
+        if gzipped:
+            #filepos is an offset into the uncompressed gcode, only the copy can get there
+            if tracking in ("scan", "index") or config.resume_mode == "layer":
+                self._logger.warning("Compressed original, resuming from the checkpoint with the state captured while printing")
+            tracking = "live"
+        elif config.resume_mode == "layer":
+            layer_z = self._move_to_layer_start()
+            if layer_z is not None:
+                #whatever was captured belongs to the old position, the index falls back to a scan
+                tracking = "index"
+        if tracking == "scan":
+            self._reconstruct_recovery_settings()
+        elif tracking == "index":
+            self._index_recovery_settings()
+
+        rs = self.recovery_settings
+        filename = rs["filename"]
+        filepos = rs["filepos"]
+        header = self._render_header(rs, config, layer_z=layer_z)
+        if config.resume_method == "virtual" and not config.auto_continue:
+            #selecting the original would leave Print one click away from reprinting it from the start
+            self._logger.info("Resuming from the original file needs Auto Continue, writing a recovery file")
+        elif config.resume_method == "virtual" and not gzipped:
+            #nothing is copied, the original is printed from filepos with the header in front
+            self._save_virtual_resume(filename, filepos, header)
+            return filename
+        self._drop_virtual_resume()
+
         path, filename = os.path.split(original_fn)
+        if gzipped and filename.lower().endswith(".gz"):
+            #the recovery file is plain gcode
+            filename = filename[:-3]
         recovery_fn = self._file_manager.path_on_disk(
             "local", os.path.join(path, "recovery_" + filename))
 
-        original = open(original_fn, 'r')
-        original.seek(filepos)
-        data = gcode_temp + gcode_xy + gcode_z + gcode_prime + original.read()
-        data = data.encode()
-        original.close()
+        #stream header + rest of the original into a scratch file, memory use does not depend on file size
+        scratch_fn = os.path.join(self.datafolder, "recovery.gcode.tmp")
+        with io.open(scratch_fn, "wb") as recovery:
+            recovery.write(header.encode("utf-8"))
+            recovery.flush()
+            if gzipped:
+                #decompresses from the closest access point before filepos only
+                compressed.copy_from_offset(self.index_store.gzip_index(original_fn), recovery.fileno(), filepos)
+            else:
+                with io.open(original_fn, "rb") as original:
+                    copy_from_offset(original.fileno(), recovery.fileno(), filepos)
 
-        stream = octoprint.filemanager.util.StreamWrapper(
-            recovery_fn, io.BytesIO(data))
+        #moved (not copied) into the storage, with an analysis OctoPrint does not have to redo
+        analysis = None if gzipped else self._recovery_analysis(original_fn, filepos)
+        wrapper = octoprint.filemanager.util.DiskFileWrapper(
+            "recovery_" + filename, scratch_fn)
         self._file_manager.add_file(
-            octoprint.filemanager.FileDestinations.LOCAL, recovery_fn, stream, allow_overwrite=True)
+            octoprint.filemanager.FileDestinations.LOCAL, recovery_fn, wrapper, allow_overwrite=True,
+            analysis=analysis)
 
         return os.path.join(path, "recovery_" + filename)
 
+    def get_assets(self):
+        return dict(js=["js/powerfailure.js"])
+
     def get_template_configs(self):
         return [
             {
@@ -228,8 +748,13 @@ class PowerFailurePlugin(octoprint.plugin.TemplatePlugin,
         ]
 
     def backupState(self):
+        """write a checkpoint if anything changed since the last one, returns True if it did"""
+        with self._capture_lock:
+            return self._backup_state()
+
+    def _backup_state(self):
         if not self._printer.is_printing():
-            return
+            return False
 
         currentData = self._printer.get_current_data()
         '''
@@ -238,132 +763,316 @@ class PowerFailurePlugin(octoprint.plugin.TemplatePlugin,
             self._logger.debug(
                 "SD printing does not support power failure recovery")
             self._settings.setBoolean(["recovery"], False)
-            self.timer.cancel()
+            self.checkpoints.stop()
             return
         '''
         currentTemp = self._printer.get_current_temperatures()
 
         try:
+            filepos = currentData["progress"]["filepos"]
+            currentZ = currentData["currentZ"]
+            tracker = self.tracker
+            if tracker is not None:
+                #one tuple published by the worker, position and state from the same moment,
+                #self.gcode_state is not fed in this mode
+                tracked_pos, tracked_state = tracker.snapshot
+                tool = tracked_state["tool"]
+            else:
+                tool = self.gcode_state.tool
+            ring = self.inflight
+            if ring is not None:
+                executed = ring.executed()
+                if executed is None:
+                    #the printer has not executed anything of this job yet
+                    return False
+                filepos = ring.filepos[executed]
+                if ring.has_state:
+                    currentZ = ring.z[executed]
+                    tool = ring.tool[executed]
+            targets = tuple(sorted((name, heater.get("target")) for name, heater in currentTemp.items()))
+            key = (filepos, currentZ, targets, tool)
+            scheduler = self.checkpoints.scheduler
+            if scheduler.unchanged(key):
+                self.metrics.counters["checkpoints_skipped"] += 1
+                return False
             rs = self.recovery_settings
-            rs["bedT"] = currentTemp["bed"]["target"]
-            rs["tool0T"] = currentTemp["tool0"]["target"]
-            rs["filepos"] = currentData["progress"]["filepos"]
+            #how far the stream got past the previous checkpoint, what a power cut just now would replay
+            self.metrics.histograms["checkpoint_filepos_lag_bytes"].observe(
+                max(0, currentData["progress"]["filepos"] - rs["filepos"]))
+            rs["bedT"] = currentTemp.get("bed", {}).get("target")
+            rs["chamberT"] = currentTemp.get("chamber", {}).get("target")
+            rs["tool_temps"] = dict((int(name[4:]), heater.get("target")) for name, heater in currentTemp.items()
+                                    if name.startswith("tool") and name[4:].isdigit())
+            rs["tool"] = tool
+            rs["filepos"] = filepos
             rs["filename"] = currentData["job"]["file"]["path"]
-            rs["currentZ"] = currentData["currentZ"]
+            rs["currentZ"] = currentZ
+            if tracker is not None:
+                rs["filepos"] = tracked_pos
+                rs.update(tracked_state)
+            elif ring is not None and ring.has_state:
+                rs.update(ring.recovery_settings_at(executed))
+            elif self.track_live:
+                rs.update(self.gcode_state.as_recovery_settings())
+            rs["fingerprint"] = self._checkpoint_fingerprint(rs["filepos"])
             rs["recovery"] = True
             rs["powerloss"] = True
-            self._write_recovery_settings()
-        except:
-            self._logger.debug("Keys missing exception")
+            #queued for the writer thread, a slow msync does not hold up the next capture, or only held
+            #in memory until a power-fail notification in the power_signal mode
+            self._write_recovery_settings(flush=False)
+            scheduler.mark_written(key)
+            self.metrics.counters["checkpoints_written"] += 1
+            return True
+        except Exception as e:
+            self._capture_problem("Could not take a checkpoint: {0}".format(e), self._logger.error, exc_info=True)
+            return False
 
     def clean(self):
-        self.recovery_settings = {
-            "bedT": 0,
-            "tool0T": 0,
-            "filepos": 0,
-            "filename": None,
-            "currentZ": 0,
-            "last_X": 0,
-            "last_Y": 0,
-            "recovery": False,
-            "powerloss": False,
-            "extruder": None,
-            "extrusion": None,
-            "feedrate": None,
-            "last_fan": None,
-            "linear_advance": None
-        }
+        self.recovery_settings = RecoveryState()
         self._write_recovery_settings()
 
-    #Timer diagnostic stuff, remove later
-    def _timer_cancel(self):
-         self._logger.debug("Timer cancelled")
+    def _start_tracker(self, payload):
+        self._stop_tracker()
+        config = self.config
+        if config.state_tracking != "async" or payload.get("origin") != "local":
+            return
+        self.tracker = AsyncTracker(path=self._file_manager.path_on_disk("local", payload["path"]),
+                                    max_pending=config.async_queue,
+                                    overflow=config.async_overflow)
+        self.tracker.start()
+
+    def _start_fingerprint(self, payload):
+        """fingerprint the file being printed, taken from its metadata if the file did not change since"""
+        self._stop_fingerprint()
+        if payload.get("origin") != "local":
+            return
+        path = self._file_manager.path_on_disk("local", payload["path"])
+        try:
+            stat = os.stat(path)
+            metadata = self._file_manager.get_metadata("local", payload["path"]) or {}
+            fingerprint = metadata.get("powerfailure_fingerprint")
+            if not fingerprint or fingerprint.get("size") != stat.st_size or fingerprint.get("mtime") != stat.st_mtime:
+                fingerprint = file_fingerprint(path)
+                self._file_manager.set_additional_metadata("local", payload["path"], "powerfailure_fingerprint",
+                                                           fingerprint, overwrite=True)
+            #offsets into a compressed file are not offsets into the gcode, no region crc for those
+            self._print_file = None if compressed.is_gzip(path) else io.open(path, "rb")
+        except Exception:
+            self._logger.exception("Could not fingerprint {0}".format(path))
+            return
+        self._print_fingerprint = fingerprint
+
+    def _stop_fingerprint(self):
+        #a capture on the power notification thread may be reading the file
+        with self._capture_lock:
+            self._print_fingerprint = None
+            fh, self._print_file = self._print_file, None
+            if fh is not None:
+                fh.close()
 
-    def _timer_finish(self):
-        self._logger.debug("Timer finished")
+    def _checkpoint_fingerprint(self, filepos):
+        fingerprint = self._print_fingerprint
+        if fingerprint is None:
+            return None
+        fh = self._print_file
+        return dict(fingerprint, region=region_crc(fh, filepos) if fh is not None else None)
 
-    def _timer_condition(self):
-        self._logger.debug("Timer condition met")
+    def _stop_tracker(self):
+        tracker, self.tracker = self.tracker, None
+        if tracker is not None:
+            tracker.stop()
+            tracker.join()
+
+    def _end_print(self):
+        """release what a print started, whatever state it got to, any number of times"""
+        self.checkpoints.stop()
+        self._stop_tracker()
+        self._stop_fingerprint()
+        self.inflight = None
 
     def on_event(self, event, payload):
         if self.will_print and self._printer.is_ready():
             will_print, self.will_print = self.will_print, ""
             # larga imprimiendo directamente
-            self._printer.select_file(will_print, False, printAfterSelect=True)
+            self._start_recovery(will_print)
+            self._send_recovery_state("started", path=will_print)
 
         if event.startswith("Connected"):
             self._logger.debug("Connected Event. Check Recovery")
-            self.check_recovery()
+            with self._recovery_lock:
+                self._connected = True
+            #nothing waiting: the printer may have lost power while OctoPrint kept running
+            self._start_preparation()
+            self._offer_recovery()
+        elif event.startswith("Disconnected"):
+            with self._recovery_lock:
+                self._connected = False
+        elif event == "ClientOpened" and self._recovery_message is not None:
+            self._plugin_manager.send_plugin_message(self._identifier, self._recovery_message)
+
+        #keep the indexes in step with the local storage
+        if event in {"FileAdded", "FileRemoved"} and payload.get("storage") == "local":
+            path = self._file_manager.path_on_disk("local", payload["path"])
+            self.index_store.remove(path)
+            if event == "FileAdded" and payload["name"].lower().endswith(".gz"):
+                thread = threading.Thread(target=self._build_gzip_index, args=(path,))
+                thread.daemon = True
+                thread.start()
+            if (event == "FileAdded" and "gcode" in payload.get("type", [])
+                    and not payload["name"].startswith("recovery_")
+                    and self.config.state_tracking == "index"):
+                thread = threading.Thread(target=self._build_index, args=(path,))
+                thread.daemon = True
+                thread.start()
 
         if event.startswith("Print"):
             if event in {"PrintStarted"}:  # empiezo a revisar
-                # empiezo a chequear
-                self.timer = RepeatedTimer(self._settings.getFloat(["save_frequency"]), PowerFailurePlugin.backupState,
-                                           args=[self],
-                                           on_condition_false=PowerFailurePlugin._timer_condition(self),
-                                           on_cancelled=PowerFailurePlugin._timer_cancel(self),
-                                           on_finish=PowerFailurePlugin._timer_finish(self),
-                                           run_first=False,
-                                           daemon=True)
-                self.timer.start()
-                self._logger.debug("Timer started")
+                #nothing left to tell a browser that connects from now on
+                self._recovery_message = None
+                self._capture_problems = set()
+                #while the header is waiting for the script hook this is the resume itself starting,
+                #the hook drops the resume before it lets go of the header
+                resume = self.virtual_resume if self._virtual_header is None else None
+                if resume is not None and payload.get("path") == resume["path"]:
+                    self._logger.warning("{0} was started without the recovery header, "
+                                         "dropping the pending resume".format(payload.get("path")))
+                    self._drop_virtual_resume()
+                config = self.config
+                self.gcode_state = GcodeState()
+                self.track_live = config.state_tracking == "live"
+                self._start_tracker(payload)
+                self._start_fingerprint(payload)
+                #the async tracker keeps its own position, acks are only followed without it
+                self.inflight = None
+                if config.track_acks and self.tracker is None:
+                    self.inflight = InflightRing(planner_depth=config.planner_depth)
+                # empiezo a chequear, the scheduler of a print that never ended is stopped first
+                self.checkpoints.start(self.backupState, config.save_frequency,
+                                       min_bytes=config.checkpoint_bytes, max_rate=config.checkpoint_max_rate,
+                                       safety_interval=self._safety_interval())
+                self._logger.debug("Checkpoint scheduler started")
             # casos en que dejo de revisar y borro
             elif event in {"PrintDone", "PrintCancelled"}:
                 # cancelo el chequeo
-                self.timer.cancel()
+                self._end_print()
                 self.clean()
             elif event in {"PrintFailed"}:
-                self.timer.cancel()
+                self._end_print()
                 self._logger.info("PowerFailure: Print failed with {0}".format(payload["reason"]))
                 self.recovery_settings["powerloss"] = False
                 self._write_recovery_settings()
+                self._export_recovery_settings()
                 
             else:
                 # casos pause y resume
                 pass
+        #progress that is worth a checkpoint right away, still subject to the rate budget
+        scheduler = self.checkpoints.scheduler
+        if event in {"ZChange", "ToolChange"} and scheduler is not None:
+            scheduler.request()
         #Printer disconnects throws error event, this is not working as expected yet
         if event.startswith("Error"):
-            self.timer.cancel()
+            self._end_print()
             self.recovery_settings["powerloss"] = False
             self._write_recovery_settings()
+            self._export_recovery_settings()
 
     def hook_gcode_sending(self, comm_instance, phase, cmd, cmd_type, gcode, tags, *args, **kwargs):
         if not self._printer.is_printing():
             return cmd
-        
-        #Parse gcode to find any important things that will be needed
-        if (cmd.startswith("G1 ") or cmd.startswith("G92 ")) and ("E" in cmd):
-            m = self.E_COORD_RE.match(cmd)
-            if m:
-                self.recovery_settings["extruder"] = float(m.groups()[0])
-        
-        if (cmd.startswith("G0 ") or cmd.startswith("G1 ")):
-            m = self.SPEED_VAL_RE.match(cmd)
-            if m:
-                self.recovery_settings["feedrate"] = float(m.groups()[0])
-            
-            m = self.X_COORD_RE.match(cmd)
-            if m:
-                self.recovery_settings["last_X"] = float(m.groups()[0])
-
-            m = self.Y_COORD_RE.match(cmd)
-            if m:
-                self.recovery_settings["last_Y"] = float(m.groups()[0])
-        
-        if cmd == "M82":
-            self.recovery_settings["extrusion"] = "M82"
-           
-        if cmd == "M83":
-            self.recovery_settings["extrusion"] = "M83"
-            
-        if cmd.startswith("M106") or cmd.startswith("M107"):
-            self.recovery_settings["last_fan"] = cmd
- 
-        if cmd.startswith("M900"):
-            self.recovery_settings["linear_advance"] = cmd
+        metrics = self.metrics
+        metrics.hook_lines += 1
+        #only one line in HOOK_SAMPLE is timed, the clock costs more than most lines
+        timed = not metrics.hook_lines & HOOK_SAMPLE_MASK
+        if timed:
+            start = clock()
+
+        #Single pass over the line, keeps XY/E correct under G91/M83 as well
+        tracker = self.tracker
+        if tracker is not None:
+            position = comm_instance.getFilePosition()
+            tracker.push(position["pos"] if position else None, cmd)
+        elif self.track_live:
+            self.gcode_state.process(cmd)
+        ring = self.inflight
+        if ring is not None:
+            position = comm_instance.getFilePosition()
+            ring.push(position["pos"] if position else 0, self.gcode_state if self.track_live else None)
+        scheduler = self.checkpoints.scheduler
+        if scheduler is not None:
+            scheduler.progress(len(cmd) + 1)
+        if timed:
+            metrics.histograms["hook_line_seconds"].observe(clock() - start)
 
         return cmd
         
+    def hook_gcode_received(self, comm_instance, line, *args, **kwargs):
+        ring = self.inflight
+        if ring is not None and line[:2] == "ok":
+            ring.ack()
+        return line
+
+    def hook_gcode_scripts(self, comm_instance, script_type, script_name, *args, **kwargs):
+        if script_type != "gcode" or script_name != "beforePrintStarted":
+            return None
+        header = self._virtual_header
+        if header is None:
+            return None
+        self._drop_virtual_resume()
+        self._virtual_header = None
+        #comments would be sent to the printer as they are, unlike those in the file
+        lines = [line.split(";")[0].strip() for line in header.splitlines()]
+        return [line for line in lines if line], None
+
+    def is_api_protected(self):
+        return True
+
+    def get_api_commands(self):
+        return dict(resume=[], preview=[])
+
+    def on_api_command(self, command, data):
+        if command == "resume":
+            if not Permissions.PRINT.can():
+                return flask.make_response("Insufficient rights", 403)
+            resume = self.virtual_resume
+            if resume is None:
+                return flask.make_response("No virtual resume pending", 409)
+            if not self._printer.is_ready():
+                return flask.make_response("Printer is not ready", 409)
+            self._start_recovery(resume["path"])
+            return flask.jsonify(path=resume["path"], pos=resume["pos"])
+        if command == "preview":
+            if not Permissions.SETTINGS.can():
+                return flask.make_response("Insufficient rights", 403)
+            #the recovery gcode the newest checkpoint would get, with unsaved blocks from data if given
+            try:
+                templates = compile_templates(dict((key, data[key]) for key in TEMPLATE_KEYS if key in data))
+            except ValueError as e:
+                return flask.make_response(str(e), 400)
+            payload = self.checkpoints.read()
+            rs = unpack_recovery_settings(payload) if payload is not None else self.recovery_settings.copy()
+            try:
+                header = self._render_header(rs, self.config, templates)
+            except (ValueError, TypeError, KeyError, IndexError, AttributeError) as e:
+                return flask.make_response("Cannot render the recovery gcode: {0}".format(e), 400)
+            return flask.jsonify(filename=rs["filename"], filepos=rs["filepos"], gcode=header)
+
+    def on_api_get(self, request):
+        if not Permissions.STATUS.can():
+            return flask.make_response("Insufficient rights", 403)
+        self.metrics.gauges["checkpoint_write_lag_seconds"] = self.checkpoints.lag()
+        #?format=prometheus for scrapers, JSON otherwise
+        if request.values.get("format") == "prometheus":
+            return flask.Response(self.metrics.prometheus(), mimetype="text/plain; version=0.0.4")
+        return flask.jsonify(self.metrics.as_dict())
+
+    def on_shutdown(self):
+        #whatever was captured last goes to disk before OctoPrint exits
+        self._end_print()
+        self._stop_power_signal()
+        if not self.checkpoints.close(timeout=5.0):
+            self._logger.warning("Checkpoint writer did not finish before shutdown")
+
     def on_wizard_finish(self, handled):
         #self._logger.debug("__init__: on_wizard_finish handled=[{}]".format(handled))
         if handled:
@@ -402,12 +1111,14 @@ class PowerFailurePlugin(octoprint.plugin.TemplatePlugin,
 
 __plugin_name__ = "Power Failure Recovery"
 __plugin_identifier = "powerfailure"
-__plugin_pythoncompat__ = ">=2.7,<4"
+__plugin_pythoncompat__ = ">=3,<4"
 __plugin_version__ = "1.2.1"
 __plugin_description__ = "Recovers a print after a power failure."
 __plugin_implementation__ = PowerFailurePlugin()
 
 __plugin_hooks__ = {
     "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
-    "octoprint.comm.protocol.gcode.sending": __plugin_implementation__.hook_gcode_sending
+    "octoprint.comm.protocol.gcode.sending": __plugin_implementation__.hook_gcode_sending,
+    "octoprint.comm.protocol.gcode.received": __plugin_implementation__.hook_gcode_received,
+    "octoprint.comm.protocol.scripts": __plugin_implementation__.hook_gcode_scripts
 }
@@ -0,0 +1,324 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import binascii
+import mmap
+import os
+import struct
+import zlib
+
+#every slot starts on its own page so msync can flush exactly one slot
+SLOT_SIZE = mmap.PAGESIZE
+SLOT_COUNT = 2
+
+_MAGIC = b"PFCK"
+#magic, payload length, sequence number, crc32 of everything after the crc
+_HEADER = struct.Struct("<4sIQI")
+
+#recovery settings as a fixed size record, None floats are stored as NaN
+_RECORD = struct.Struct("<ddqdddddBBB512s64s64s")
+#fingerprint of the file being printed, appended to _RECORD: flags, size, mtime, sample sha1, region crc
+#records written before it are shorter and read back without one
+_FINGERPRINT = struct.Struct("<Bqd20sI")
+_HAS_FINGERPRINT = 1
+_HAS_REGION = 2
+#tools a checkpoint has room for
+MAX_TOOLS = 8
+#appended after _FINGERPRINT: chamber target, active tool, flags, then per tool target, E and retracted length
+_TOOLS = struct.Struct("<dBB{0}d{0}d{0}d".format(MAX_TOOLS))
+_FW_RETRACTED = 1
+_EXTRUSION_CODES = {None: 0, "M82": 1, "M83": 2}
+_EXTRUSION_NAMES = dict((code, name) for name, code in _EXTRUSION_CODES.items())
+
+
+def _float(value):
+    return float("nan") if value is None else float(value)
+
+
+def _optional(value):
+    return None if value != value else value
+
+
+class FieldTooLong(ValueError):
+    """a text field longer than its slot in the record, field is its key"""
+
+    def __init__(self, field, value, size):
+        super(FieldTooLong, self).__init__("{0} {1!r} is longer than the {2} bytes a checkpoint has for it".format(
+            field, value, size))
+        self.field = field
+
+
+def _text(rs, field, size):
+    value = rs[field]
+    data = b"" if value is None else value.encode("utf-8")
+    if len(data) > size:
+        raise FieldTooLong(field, value, size)
+    return data
+
+
+def _untext(data):
+    data = data.rstrip(b"\0")
+    return data.decode("utf-8") if data else None
+
+
+class RecoveryState(object):
+    """what a checkpoint records, one slot per field
+
+    Reads and writes like the dict it replaces (rs["bedT"], rs.update(...)) so
+    the templates, the trackers and the json export see the same keys. The per
+    tool fields are dicts keyed by tool number, tool0T is tool_temps[0].
+    """
+    __slots__ = ("bedT", "chamberT", "filepos", "filename", "currentZ", "last_X", "last_Y",
+                 "recovery", "powerloss", "extruder", "extrusion", "feedrate", "last_fan",
+                 "linear_advance", "fingerprint", "tool", "retracted", "fw_retracted",
+                 "tool_temps", "tool_e", "tool_retracted")
+
+    def __init__(self, **values):
+        self.bedT = 0
+        self.chamberT = None
+        self.filepos = 0
+        self.filename = None
+        self.currentZ = 0
+        self.last_X = 0
+        self.last_Y = 0
+        self.recovery = False
+        self.powerloss = False
+        self.extruder = None
+        self.extrusion = None
+        self.feedrate = None
+        self.last_fan = None
+        self.linear_advance = None
+        self.fingerprint = None
+        #active tool, and how far its filament is pulled back by the slicer or by G10
+        self.tool = 0
+        self.retracted = 0.0
+        self.fw_retracted = False
+        self.tool_temps = {0: 0}
+        self.tool_e = {}
+        self.tool_retracted = {}
+        self.update(values)
+
+    @property
+    def tool0T(self):
+        return self.tool_temps.get(0)
+
+    @tool0T.setter
+    def tool0T(self, value):
+        self.tool_temps[0] = value
+
+    def keys(self):
+        return ("tool0T",) + self.__slots__
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__ and key != "tool0T":
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key == "tool0T" or key in self.__slots__
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self else default
+
+    def update(self, values=None, **kwargs):
+        for key, value in (values or {}).items():
+            self[key] = value
+        for key, value in kwargs.items():
+            self[key] = value
+
+    def copy(self):
+        return RecoveryState(**self.as_dict())
+
+    def as_dict(self):
+        values = dict((key, getattr(self, key)) for key in self.__slots__)
+        for key in ("tool_temps", "tool_e", "tool_retracted", "fingerprint"):
+            if values[key] is not None:
+                values[key] = dict(values[key])
+        values["tool0T"] = self.tool0T
+        return values
+
+    @classmethod
+    def from_dict(cls, values):
+        """from the json of older versions, unknown keys are dropped and tool keys come back as strings"""
+        state = cls()
+        for key, value in values.items():
+            if key in ("tool_temps", "tool_e", "tool_retracted"):
+                value = dict((int(tool), number) for tool, number in (value or {}).items())
+            if key in state:
+                state[key] = value
+        return state
+
+    def tools_in_use(self):
+        """the active tool and every tool with a target temperature, in order"""
+        return sorted(set(tool for tool, target in self.tool_temps.items() if target) | set([self.tool]))
+
+
+def _pack_fingerprint(fingerprint):
+    if not fingerprint:
+        return _FINGERPRINT.pack(0, 0, 0.0, b"", 0)
+    region = fingerprint.get("region")
+    flags = _HAS_FINGERPRINT | (_HAS_REGION if region is not None else 0)
+    return _FINGERPRINT.pack(flags, fingerprint["size"], fingerprint["mtime"],
+                             binascii.unhexlify(fingerprint["sample"]), region or 0)
+
+
+def _unpack_fingerprint(data):
+    if len(data) < _RECORD.size + _FINGERPRINT.size:
+        return None
+    flags, size, mtime, sample, region = _FINGERPRINT.unpack_from(data, _RECORD.size)
+    if not flags & _HAS_FINGERPRINT:
+        return None
+    return dict(size=size, mtime=mtime, sample=binascii.hexlify(sample).decode("ascii"),
+                region=region if flags & _HAS_REGION else None)
+
+
+def _pack_tools(rs):
+    temps = [float("nan")] * MAX_TOOLS
+    e = [float("nan")] * MAX_TOOLS
+    retracted = [0.0] * MAX_TOOLS
+    for column, values in ((temps, rs.tool_temps), (e, rs.tool_e), (retracted, rs.tool_retracted)):
+        for tool, value in values.items():
+            if 0 <= tool < MAX_TOOLS and value is not None:
+                column[tool] = value
+    return _TOOLS.pack(_float(rs.chamberT), min(max(rs.tool, 0), 255),
+                       _FW_RETRACTED if rs.fw_retracted else 0, *(temps + e + retracted))
+
+
+def _unpack_tools(rs, data):
+    offset = _RECORD.size + _FINGERPRINT.size
+    if len(data) < offset + _TOOLS.size:
+        return
+    values = _TOOLS.unpack_from(data, offset)
+    chamberT, rs.tool, flags = values[:3]
+    rs.chamberT = _optional(chamberT)
+    rs.fw_retracted = bool(flags & _FW_RETRACTED)
+    temps, e, retracted = (values[3 + i * MAX_TOOLS:3 + (i + 1) * MAX_TOOLS] for i in range(3))
+    rs.tool_temps = dict((tool, value) for tool, value in enumerate(temps) if value == value)
+    rs.tool_e = dict((tool, value) for tool, value in enumerate(e) if value == value)
+    rs.tool_retracted = dict((tool, value) for tool, value in enumerate(retracted) if value)
+    rs.retracted = rs.tool_retracted.get(rs.tool, 0.0)
+
+
+def pack_recovery_settings(rs):
+    """pack a RecoveryState into a fixed size record, raises FieldTooLong for text that does not fit"""
+    return _RECORD.pack(_float(rs["bedT"]),
+                        _float(rs["tool0T"]),
+                        int(rs["filepos"] or 0),
+                        _float(rs["currentZ"]),
+                        _float(rs["last_X"]),
+                        _float(rs["last_Y"]),
+                        _float(rs["extruder"]),
+                        _float(rs["feedrate"]),
+                        _EXTRUSION_CODES.get(rs["extrusion"], 0),
+                        bool(rs["recovery"]),
+                        bool(rs["powerloss"]),
+                        _text(rs, "filename", 512),
+                        _text(rs, "last_fan", 64),
+                        _text(rs, "linear_advance", 64)) + _pack_fingerprint(rs.fingerprint) + _pack_tools(rs)
+
+
+def unpack_recovery_settings(data):
+    """inverse of pack_recovery_settings"""
+    (bedT, tool0T, filepos, currentZ, last_X, last_Y, extruder, feedrate,
+     extrusion, recovery, powerloss, filename, last_fan, linear_advance) = _RECORD.unpack(data[:_RECORD.size])
+    rs = RecoveryState(
+        bedT=_optional(bedT),
+        tool0T=_optional(tool0T),
+        filepos=filepos,
+        filename=_untext(filename),
+        currentZ=_optional(currentZ),
+        last_X=_optional(last_X),
+        last_Y=_optional(last_Y),
+        recovery=bool(recovery),
+        powerloss=bool(powerloss),
+        extruder=_optional(extruder),
+        extrusion=_EXTRUSION_NAMES.get(extrusion),
+        feedrate=_optional(feedrate),
+        last_fan=_untext(last_fan),
+        linear_advance=_untext(linear_advance),
+        fingerprint=_unpack_fingerprint(data),
+    )
+    #records from before multi tool support keep what they had, tool 0 and its target
+    _unpack_tools(rs, data)
+    return rs
+
+
+class CheckpointStore(object):
+    """two preallocated, memory mapped slots written alternately
+
+    Each slot carries a sequence number and a crc, a write only ever touches the
+    older slot so a power cut in the middle of it leaves the newer one intact.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._map = None
+        self._seq = 0
+        self._next_slot = 0
+
+    def open(self):
+        size = SLOT_SIZE * SLOT_COUNT
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size != size:
+            os.ftruncate(self._fd, size)
+            os.fsync(self._fd)
+        self._map = mmap.mmap(self._fd, size)
+        newest = self._newest_slot()
+        if newest is not None:
+            self._seq = newest[1]
+            self._next_slot = (newest[0] + 1) % SLOT_COUNT
+        return self
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _read_slot(self, slot):
+        offset = slot * SLOT_SIZE
+        magic, length, seq, crc = _HEADER.unpack_from(self._map, offset)
+        if magic != _MAGIC or length > SLOT_SIZE - _HEADER.size:
+            return None
+        start = offset + _HEADER.size
+        payload = self._map[start:start + length]
+        if zlib.crc32(struct.pack("<IQ", length, seq) + payload) & 0xffffffff != crc:
+            return None
+        return seq, payload
+
+    def _newest_slot(self):
+        newest = None
+        for slot in range(SLOT_COUNT):
+            found = self._read_slot(slot)
+            if found is not None and (newest is None or found[0] > newest[1]):
+                newest = (slot, found[0], found[1])
+        return newest
+
+    def write(self, payload):
+        """write payload into the older slot and msync just that slot"""
+        length = len(payload)
+        if length > SLOT_SIZE - _HEADER.size:
+            raise ValueError("Checkpoint payload of {0} bytes does not fit in a slot".format(length))
+        seq = self._seq + 1
+        crc = zlib.crc32(struct.pack("<IQ", length, seq) + payload) & 0xffffffff
+        offset = self._next_slot * SLOT_SIZE
+        start = offset + _HEADER.size
+        self._map[start:start + length] = payload
+        _HEADER.pack_into(self._map, offset, _MAGIC, length, seq, crc)
+        self._map.flush(offset, SLOT_SIZE)
+        self._seq = seq
+        self._next_slot = (self._next_slot + 1) % SLOT_COUNT
+
+    def read(self):
+        """payload of the newest slot with a valid crc, None if there is none"""
+        newest = self._newest_slot()
+        return None if newest is None else newest[2]
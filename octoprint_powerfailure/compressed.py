@@ -0,0 +1,211 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import array
+import bisect
+import io
+import os
+import sys
+import zlib
+
+from .sidecar import Sidecar
+
+#one access point every INTERVAL uncompressed bytes, at most
+INTERVAL = 4 * 1024 * 1024
+WINDOW = 32 * 1024
+#uncompressed bytes a candidate has to reproduce before it becomes an access point
+_VERIFY = 16 * 1024
+_CHUNK = 256 * 1024
+#LEN/NLEN of the empty stored block a full or sync flush ends with, the next block starts byte aligned
+_SYNC_MARKER = b"\x00\x00\xff\xff"
+_GZIP_MAGIC = b"\x1f\x8b"
+#points in the middle of a member need zdict
+_SYNC_POINTS = sys.version_info >= (3, 3)
+
+#kinds of access points
+MEMBER = 0
+SYNC = 1
+
+
+def is_gzip(path):
+    with io.open(path, "rb") as fh:
+        return fh.read(2) == _GZIP_MAGIC
+
+
+class _Candidate(object):
+    """a sync marker that may be an access point, checked against the sequential decompressor"""
+
+    def __init__(self, compressed, uncompressed, window):
+        self.compressed = compressed
+        self.uncompressed = uncompressed
+        self.window = window
+        self.inflate = zlib.decompressobj(-15, zdict=window)
+        self.expected = b""
+        self.got = b""
+
+    def feed(self, piece, out):
+        """True once verified, False if it is not an access point, None while undecided"""
+        try:
+            self.got += self.inflate.decompress(piece)
+        except zlib.error:
+            return False
+        self.expected += out
+        common = min(len(self.got), len(self.expected))
+        if self.got[:common] != self.expected[:common]:
+            return False
+        if common >= _VERIFY:
+            return True
+        return None
+
+
+class GzipIndex(Sidecar):
+    """zran style access points into a gzip file
+
+    Python's zlib cannot start inflating at an arbitrary bit, so points are only
+    taken where a stream can be restarted on a byte boundary: the start of every
+    gzip member and the end of every sync or full flush (what pigz writes between
+    its blocks), with the 32 KiB of output before it as the dictionary. A file
+    written by plain gzip has a single point at 0 and is decompressed from there.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, size, mtime):
+        super(GzipIndex, self).__init__(path, size, mtime)
+        self.compressed = array.array("q")
+        self.uncompressed = array.array("q")
+        self.kinds = array.array("b")
+        self.windows = []
+
+    def __len__(self):
+        return len(self.compressed)
+
+    def _add(self, compressed, uncompressed, kind, window=b""):
+        self.compressed.append(compressed)
+        self.uncompressed.append(uncompressed)
+        self.kinds.append(kind)
+        self.windows.append(window)
+
+    @classmethod
+    def build(cls, path, interval=INTERVAL):
+        stat = os.stat(path)
+        index = cls(path, stat.st_size, stat.st_mtime)
+        total = 0
+        window = b""
+        candidate = None
+        inflate = None
+        consumed = 0
+        pending = b""
+        with io.open(path, "rb") as fh:
+            while True:
+                chunk = fh.read(_CHUNK)
+                pending += chunk
+                while pending:
+                    if inflate is None:
+                        if not pending.startswith(_GZIP_MAGIC):
+                            #trailing zeros or garbage, gzip ignores it as well
+                            pending = b""
+                            break
+                        inflate = zlib.decompressobj(31)
+                        candidate = None
+                        if not len(index) or total - index.uncompressed[-1] >= interval:
+                            index._add(consumed, total, MEMBER)
+                    #feed up to the next sync marker so its offset in the output is known
+                    piece = pending
+                    marker = pending.find(_SYNC_MARKER) if _SYNC_POINTS else -1
+                    if marker >= 0:
+                        piece = pending[:marker + len(_SYNC_MARKER)]
+                    elif chunk:
+                        #keep what could be the start of a marker for the next read
+                        piece = pending[:max(0, len(pending) - len(_SYNC_MARKER) + 1)]
+                        if not piece:
+                            break
+                    out = inflate.decompress(piece)
+                    fed = len(piece)
+                    if inflate.eof:
+                        fed -= len(inflate.unused_data)
+                    if candidate is not None:
+                        verdict = candidate.feed(piece[:fed], out)
+                        if verdict is not None:
+                            if verdict:
+                                index._add(candidate.compressed, candidate.uncompressed, SYNC,
+                                           zlib.compress(candidate.window))
+                            candidate = None
+                    total += len(out)
+                    window = (window + out)[-WINDOW:]
+                    consumed += fed
+                    pending = pending[fed:]
+                    if inflate.eof:
+                        inflate = None
+                    elif (marker >= 0 and fed == marker + len(_SYNC_MARKER) and candidate is None
+                          and total - index.uncompressed[-1] >= interval):
+                        candidate = _Candidate(consumed, total, window)
+                if not chunk:
+                    break
+        return index
+
+    def read_from(self, offset, chunk=_CHUNK):
+        """yield the uncompressed data from offset to the end, starting at the closest access point"""
+        i = max(0, bisect.bisect_right(self.uncompressed, offset) - 1)
+        skip = offset - self.uncompressed[i]
+        if self.kinds[i] == SYNC:
+            inflate = zlib.decompressobj(-15, zdict=zlib.decompress(self.windows[i]))
+        else:
+            inflate = zlib.decompressobj(31)
+        raw = self.kinds[i] == SYNC
+        with io.open(self.path, "rb") as fh:
+            fh.seek(self.compressed[i])
+            pending = b""
+            while True:
+                data = fh.read(chunk)
+                pending += data
+                while pending:
+                    if inflate is None:
+                        if raw:
+                            #the rest of the member cut short by the access point: crc and size
+                            if len(pending) < 8 and data:
+                                break
+                            pending = pending[8:]
+                            raw = False
+                        if not pending.startswith(_GZIP_MAGIC):
+                            if data and len(pending) < 2:
+                                break
+                            return
+                        inflate = zlib.decompressobj(31)
+                    out = inflate.decompress(pending, chunk)
+                    pending = inflate.unconsumed_tail
+                    if inflate.eof:
+                        pending = inflate.unused_data
+                        inflate = None
+                    if skip:
+                        dropped = min(skip, len(out))
+                        out = out[dropped:]
+                        skip -= dropped
+                    if out:
+                        yield out
+                    elif inflate is not None and not pending:
+                        break
+                if not data:
+                    return
+
+    def _write(self, fh):
+        lengths = array.array("i", [len(window) for window in self.windows])
+        for column in (self.compressed, self.uncompressed, self.kinds, lengths):
+            column.tofile(fh)
+        for window in self.windows:
+            fh.write(window)
+
+    def _read(self, fh, header):
+        lengths = array.array("i")
+        for column in (self.compressed, self.uncompressed, self.kinds, lengths):
+            column.fromfile(fh, header["count"])
+        self.windows = [fh.read(length) for length in lengths]
+
+
+def copy_from_offset(index, dst_fd, offset):
+    """write the uncompressed data of the indexed file from offset on to dst_fd"""
+    for data in index.read_from(offset):
+        view = memoryview(data)
+        while view:
+            written = os.write(dst_fd, view)
+            view = view[written:]
@@ -0,0 +1,162 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import collections
+import string
+
+#the recovery gcode blocks, in the order they are sent
+TEMPLATE_KEYS = ("gcode_temp", "gcode_xy", "gcode_z", "gcode_prime")
+
+#what the blocks can refer to in curly braces
+PLACEHOLDERS = frozenset((
+    "filename", "filepos", "currentZ", "last_X", "last_Y", "bedT", "tool0T",
+    "extruder", "extrusion", "feedrate", "linear_advance", "last_fan",
+    "z_homing_height", "prime_len", "z_sag", "xy_feed", "enable_z", "klipper_z", "adjustedZ",
+    "tool", "chamberT", "retracted", "tool_heat", "tool_wait", "chamber_heat", "chamber_wait",
+))
+
+#settings read on the printer, timer and recovery paths, with the getter that reads each
+_FIELDS = (
+    ("auto_continue", "getBoolean"),
+    ("z_homing_height", "getFloat"),
+    ("save_frequency", "getFloat"),
+    ("checkpoint_bytes", "getInt"),
+    ("checkpoint_max_rate", "getFloat"),
+    ("checkpoint_mode", "get"),
+    ("safety_frequency", "getFloat"),
+    ("power_signal_socket", "get"),
+    ("power_signal_signal", "get"),
+    ("state_tracking", "get"),
+    ("async_queue", "getInt"),
+    ("async_overflow", "get"),
+    ("index_workers", "getInt"),
+    ("resume_mode", "get"),
+    ("resume_layers_back", "getInt"),
+    ("track_acks", "getBoolean"),
+    ("planner_depth", "getInt"),
+    ("resume_method", "get"),
+    ("fingerprint_mismatch", "get"),
+    ("klipper_z", "getBoolean"),
+    ("z_sag", "getFloat"),
+    ("xy_feed", "getFloat"),
+    ("enable_z", "getBoolean"),
+    ("prime_len", "getFloat"),
+)
+
+_formatter = string.Formatter()
+#marks where a None value went while rendering, the gcode itself never has a NUL
+_MISSING = "\0"
+
+
+class Template(object):
+    """a recovery gcode block parsed once, with every placeholder checked against PLACEHOLDERS
+
+    Renders exactly like str.format(**values) restricted to PLACEHOLDERS. Plain
+    {name} fields are looked up directly, anything with a format spec, a
+    conversion, an attribute or an index goes through string.Formatter. A line
+    that needs a value that is None, a heater the printer does not have or an
+    M82/M83 the file never sent, is commented out instead.
+    """
+
+    def __init__(self, name, source):
+        self.name = name
+        self.source = source
+        self.fields = set()
+        self._parts = []
+        try:
+            parsed = list(_formatter.parse(source))
+        except ValueError as e:
+            raise ValueError("{0}: {1}".format(name, e))
+        for literal, field, spec, conversion in parsed:
+            if field is None:
+                self._parts.append((literal, None, None, None))
+                continue
+            root = field
+            for separator in ".[":
+                root = root.split(separator)[0]
+            if not root or root.isdigit():
+                raise ValueError("{0}: positional field {{{1}}}, use one of the named placeholders".format(name, field))
+            if root not in PLACEHOLDERS:
+                raise ValueError("{0}: unknown placeholder {{{1}}}".format(name, field))
+            if conversion not in (None, "r", "s", "a"):
+                raise ValueError("{0}: unknown conversion !{1} in {{{2}}}".format(name, conversion, field))
+            for _, nested, _, _ in _formatter.parse(spec or ""):
+                if nested is not None and nested not in PLACEHOLDERS:
+                    raise ValueError("{0}: unknown placeholder {{{1}}} in the format of {{{2}}}".format(name, nested, field))
+            self.fields.add(root)
+            simple = root == field and not spec and conversion is None
+            self._parts.append((literal, field, None if simple else (spec, conversion), simple))
+
+    def render(self, values):
+        """the block filled in with values, a line that needs a value that is None is commented out"""
+        out = []
+        missing = False
+        for literal, field, extra, simple in self._parts:
+            out.append(literal)
+            if field is None:
+                continue
+            value = values[field] if simple else _formatter.get_field(field, (), values)[0]
+            if value is None:
+                #M140 SNone is a parse error in Klipper and S0 in Marlin, a bed that was not heated stays cold
+                out.append(_MISSING + field + _MISSING)
+                missing = True
+                continue
+            if simple:
+                out.append(format(value))
+                continue
+            spec, conversion = extra
+            value = _formatter.convert_field(value, conversion)
+            if spec and "{" in spec:
+                spec = _formatter.vformat(spec, (), values)
+            out.append(format(value, spec or ""))
+        text = "".join(out)
+        if missing:
+            text = "\n".join(_comment_missing(line) for line in text.split("\n"))
+        return text
+
+
+def _comment_missing(line):
+    if _MISSING not in line:
+        return line
+    pieces = line.split(_MISSING)
+    #every odd piece is the name of a field that was None
+    fields = pieces[1::2]
+    source = "".join(piece if i % 2 == 0 else "{" + piece + "}" for i, piece in enumerate(pieces))
+    return "; no {0}: {1}".format(", ".join(fields), source)
+
+
+def compile_templates(sources):
+    """{key: Template} for the blocks in sources, ValueError naming the first bad one"""
+    return dict((key, Template(key, sources[key])) for key in TEMPLATE_KEYS if key in sources)
+
+
+_SnapshotBase = collections.namedtuple("_SnapshotBase", [name for name, _ in _FIELDS] + ["templates", "template_errors"])
+
+
+class SettingsSnapshot(_SnapshotBase):
+    """the settings as of the last save, immutable so any thread can read it without a lock
+
+    A block that does not compile is left out of templates, with the reason in
+    template_errors, so a bad block saved by an older version only fails the
+    recovery that needs it.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_settings(cls, settings):
+        values = dict((name, getattr(settings, getter)([name])) for name, getter in _FIELDS)
+        templates = {}
+        errors = {}
+        for key in TEMPLATE_KEYS:
+            try:
+                templates[key] = Template(key, settings.get([key]) or "")
+            except ValueError as e:
+                errors[key] = str(e)
+        return cls(templates=templates, template_errors=errors, **values)
+
+    def render(self, values):
+        """the rendered blocks as a tuple in TEMPLATE_KEYS order"""
+        for key in TEMPLATE_KEYS:
+            if key in self.template_errors:
+                raise ValueError(self.template_errors[key])
+        return tuple(self.templates[key].render(values) for key in TEMPLATE_KEYS)
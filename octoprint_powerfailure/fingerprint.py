@@ -0,0 +1,63 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import hashlib
+import io
+import os
+import struct
+import zlib
+
+#blocks hashed out of the whole file, evenly spread and including both ends
+SAMPLES = 16
+BLOCK = 4096
+#bytes just before the checkpoint covered by its crc
+REGION = 4096
+
+
+def file_fingerprint(path):
+    """size, mtime and a sha1 of SAMPLES blocks of path, a few reads whatever the size of the file"""
+    stat = os.stat(path)
+    size = stat.st_size
+    digest = hashlib.sha1(struct.pack("<q", size))
+    with io.open(path, "rb") as fh:
+        if size <= SAMPLES * BLOCK:
+            digest.update(fh.read())
+        else:
+            for i in range(SAMPLES):
+                fh.seek(i * (size - BLOCK) // (SAMPLES - 1))
+                digest.update(fh.read(BLOCK))
+    return dict(size=size, mtime=stat.st_mtime, sample=digest.hexdigest())
+
+
+def region_crc(fh, filepos):
+    """crc32 of the REGION bytes before filepos in the open file fh"""
+    start = max(0, filepos - REGION)
+    fh.seek(start)
+    return zlib.crc32(fh.read(filepos - start)) & 0xffffffff
+
+
+def compare(path, fingerprint, filepos):
+    """what differs between path and the fingerprint taken while printing it
+
+    Returns (problem, warning). problem is set when the content is not the one
+    printed, warning when only the modification time changed, as a copy or a
+    restore from a backup does.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        return "cannot read {0}: {1}".format(path, e), None
+    if stat.st_size != fingerprint["size"]:
+        return "its size changed from {0} to {1} bytes".format(fingerprint["size"], stat.st_size), None
+    warning = None
+    if stat.st_mtime != fingerprint["mtime"]:
+        #same size, the sampled blocks tell a re-slice from a touch
+        if file_fingerprint(path)["sample"] != fingerprint["sample"]:
+            return "its content changed", None
+        warning = "it was modified but the sampled content is the same"
+    region = fingerprint.get("region")
+    if region is not None:
+        with io.open(path, "rb") as fh:
+            if region_crc(fh, filepos) != region:
+                return "the content before the recovery position changed", None
+    return None, warning
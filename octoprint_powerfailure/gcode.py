@@ -0,0 +1,494 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+from .misc import reverse_lines
+
+
+class GcodeState(object):
+    """modal state machine fed with every gcode line that goes to the printer"""
+
+    def __init__(self):
+        self.x = 0.0
+        self.y = 0.0
+        self.z = 0.0
+        self.e = 0.0
+        self.feedrate = None
+        #G90/G91 and M82/M83
+        self.absolute = True
+        self.absolute_e = True
+        #None until the gcode tells us, the recovery templates rely on that
+        self.extrusion = None
+        self.fan = None
+        self.linear_advance = None
+        self.tool = 0
+        #filament pulled back by the slicer (E moves) and by firmware retraction (G10/G11)
+        self.retracted = 0.0
+        self.fw_retracted = False
+        #E and retracted length of the tools not active, as they were left; replaced, never changed in place
+        self.tool_e = {}
+        self.tool_retracted = {}
+
+        self._dispatch = {
+            "G0": self._move,
+            "G1": self._move,
+            "G2": self._move,
+            "G3": self._move,
+            "G10": self._retract,
+            "G11": self._unretract,
+            "G28": self._home,
+            "G90": self._absolute,
+            "G91": self._relative,
+            "G92": self._set_position,
+            "M82": self._absolute_extrusion,
+            "M83": self._relative_extrusion,
+            "M106": self._fan,
+            "M107": self._fan,
+            "M900": self._linear_advance,
+        }
+        for alias, code in (("G00", "G0"), ("G01", "G1"), ("G02", "G2"), ("G03", "G3")):
+            self._dispatch[alias] = self._dispatch[code]
+
+    def process(self, line):
+        """update the modal state with one line, returns the command word or None"""
+        if ";" in line:
+            line = line[:line.index(";")]
+        words = line.split()
+        if not words:
+            return None
+        code = words[0]
+        handler = self._dispatch.get(code)
+        if handler is None:
+            code = code.upper()
+            handler = self._dispatch.get(code)
+        if handler is not None:
+            handler(words)
+        elif code[0] == "T" and code[1:].isdigit():
+            self.select_tool(int(code[1:]))
+        return code
+
+    def select_tool(self, tool):
+        if tool == self.tool:
+            return
+        tool_e = dict(self.tool_e)
+        #under M83 E is a running total nothing resumes from, 0 as reconstruct_state leaves it
+        tool_e[self.tool] = self.e if self.absolute_e else 0.0
+        tool_retracted = dict(self.tool_retracted)
+        tool_retracted[self.tool] = self.retracted
+        self.retracted = tool_retracted.pop(tool, 0.0)
+        tool_e.pop(tool, None)
+        self.tool_e = tool_e
+        self.tool_retracted = tool_retracted
+        self.tool = tool
+
+    def _move(self, words):
+        #hot path: parse the words in place
+        for word in words[1:]:
+            axis = word[0]
+            try:
+                value = float(word[1:])
+            except ValueError:
+                continue
+            if axis == "X" or axis == "x":
+                self.x = value if self.absolute else self.x + value
+            elif axis == "Y" or axis == "y":
+                self.y = value if self.absolute else self.y + value
+            elif axis == "E" or axis == "e":
+                e = self.e
+                if not self.absolute_e:
+                    value += e
+                if value < e:
+                    #a retraction, on its own or wiping along a travel
+                    self.retracted += e - value
+                elif self.retracted and value > e:
+                    self._unretract_by(value - e, words)
+                self.e = value
+            elif axis == "Z" or axis == "z":
+                self.z = value if self.absolute else self.z + value
+            elif axis == "F" or axis == "f":
+                self.feedrate = value
+
+    def _unretract_by(self, extruded, words):
+        if any(word[0] in "XYZxyz" for word in words[1:]):
+            #extruding while moving, whatever was retracted is back
+            self.retracted = 0.0
+        else:
+            self.retracted = max(0.0, self.retracted - extruded)
+
+    def _retract(self, words):
+        #G10 with parameters sets tool offsets or temperatures
+        if len(words) == 1:
+            self.fw_retracted = True
+
+    def _unretract(self, words):
+        self.fw_retracted = False
+
+    def _home(self, words):
+        #bare G28 homes every axis
+        axes = [word[0].lower() for word in words[1:] if word[0] in "XYZxyz"] or "xyz"
+        for axis in axes:
+            setattr(self, axis, 0.0)
+
+    def _absolute(self, words):
+        self.absolute = True
+        self.absolute_e = True
+
+    def _relative(self, words):
+        self.absolute = False
+        self.absolute_e = False
+
+    def _set_position(self, words):
+        for word in words[1:]:
+            if word[0] in "XYZExyze":
+                try:
+                    setattr(self, word[0].lower(), float(word[1:]))
+                except ValueError:
+                    pass
+
+    def _absolute_extrusion(self, words):
+        self.absolute_e = True
+        self.extrusion = "M82"
+
+    def _relative_extrusion(self, words):
+        self.absolute_e = False
+        self.extrusion = "M83"
+
+    def _fan(self, words):
+        self.fan = " ".join(words)
+
+    def _linear_advance(self, words):
+        self.linear_advance = " ".join(words)
+
+    def as_recovery_settings(self):
+        """the subset of the recovery settings that comes from the gcode stream"""
+        return {
+            "last_X": self.x,
+            "last_Y": self.y,
+            "extruder": self.e,
+            "extrusion": self.extrusion,
+            "feedrate": self.feedrate,
+            "last_fan": self.fan,
+            "linear_advance": self.linear_advance,
+            "tool": self.tool,
+            "retracted": self.retracted,
+            "fw_retracted": self.fw_retracted,
+            "tool_e": _with(self.tool_e, self.tool, self.e),
+            "tool_retracted": _with(self.tool_retracted, self.tool, self.retracted),
+        }
+
+
+def _with(values, key, value):
+    values = dict(values)
+    values[key] = value
+    return values
+
+
+class _AxisResolver(object):
+    """resolves one axis position while walking the gcode backwards
+
+    Lines are seen last to first, split into regimes at each G90/G91 (M82/M83
+    for E). regime is True/False when the mode of the regime being walked is
+    known up front, None when its words can only be interpreted once the command
+    that opened the regime is found.
+    """
+
+    def __init__(self, regime):
+        self.value = None
+        self.resolved = False
+        self.regime = regime
+        self._offset = 0.0
+        self._first = None
+        self._total = 0.0
+        self._anchor = None
+
+    def word(self, value):
+        if self.resolved or self._anchor is not None:
+            return
+        if self.regime:
+            self._resolve(value)
+            return
+        if self._first is None:
+            self._first = value
+        self._total += value
+
+    def anchor(self, value):
+        #G92 or G28, absolute no matter what mode the regime is in
+        if self.resolved or self._anchor is not None:
+            return
+        if self.regime is False:
+            self._resolve(value + self._total)
+        else:
+            self._anchor = value
+
+    def mode(self, absolute, earlier=None):
+        """the command that opened the current regime, earlier is the mode before it if known"""
+        if not self.resolved:
+            if absolute:
+                if self._first is not None:
+                    self._resolve(self._first)
+                elif self._anchor is not None:
+                    self._resolve(self._anchor)
+            elif self._anchor is not None:
+                self._resolve(self._anchor + self._total)
+            else:
+                self._offset += self._total
+        self._first = None
+        self._total = 0.0
+        self.regime = earlier
+
+    def finish(self):
+        #the start of the file is an absolute regime anchored at 0
+        self.mode(True)
+        if not self.resolved:
+            self._resolve(0.0)
+
+    def _resolve(self, value):
+        self.value = value + self._offset
+        self.resolved = True
+
+
+def _command_at(data, start, stop):
+    """command word of the line starting at start"""
+    end = start
+    while end < stop and data[end:end + 1] not in (b" ", b"\t", b"\r", b"\n", b";", b""):
+        end += 1
+    return data[start:end].upper()
+
+
+def _last_command(data, stop, prefixes, codes):
+    """(line start, command) of the last line before stop running one of codes, (None, None) if none
+
+    Every code has to start with one of prefixes, each prefix costs one rfind over data.
+    """
+    best = (None, None)
+    for prefix in prefixes:
+        start = data.rfind(b"\n" + prefix, 0, stop)
+        while start >= 0:
+            code = _command_at(data, start + 1, stop)
+            if code in codes:
+                break
+            start = data.rfind(b"\n" + prefix, 0, start)
+        if start >= 0:
+            start += 1
+        elif data[:len(prefix)] == prefix and _command_at(data, 0, stop) in codes:
+            start, code = 0, _command_at(data, 0, stop)
+        else:
+            continue
+        if best[0] is None or start > best[0]:
+            best = (start, code)
+    return best
+
+
+_POSITIONING = (b"G90", b"G91")
+_EXTRUDING = (b"M82", b"M83")
+
+
+def _modes(data, stop):
+    """(absolute, absolute_e, last M82/M83 line start) in effect at stop"""
+    positioning = _last_command(data, stop, (b"G9",), _POSITIONING)
+    extruding = _last_command(data, stop, (b"M8",), _EXTRUDING)
+    absolute = positioning[1] != b"G91"
+    #G90/G91 switch E as well, whichever came last wins
+    if extruding[0] is not None and (positioning[0] is None or extruding[0] > positioning[0]):
+        absolute_e = extruding[1] == b"M82"
+    else:
+        absolute_e = absolute
+    return absolute, absolute_e, extruding[0]
+
+
+def _line_at(data, start, stop):
+    """the line starting at start without its comment, None for no line"""
+    if start is None:
+        return None
+    end = data.find(b"\n", start, stop)
+    line = data[start:stop if end < 0 else end]
+    return line.split(b";")[0].strip().decode("ascii", "replace")
+
+
+#bytes replayed at first when looking for the move that settles a retraction
+_RETRACTION_WINDOW = 4096
+#retraction a replay started with when it depends on what came before
+_UNKNOWN = float("inf")
+
+
+def _tool_segments(data, stop):
+    """[[start, end, tool]] in file order, the ranges before stop each tool was active in"""
+    changes = []
+    start = data.rfind(b"\nT", 0, stop)
+    while start >= 0:
+        code = _command_at(data, start + 1, stop)
+        if code[1:].isdigit():
+            changes.append((start + 1, int(code[1:])))
+        start = data.rfind(b"\nT", 0, start)
+    code = _command_at(data, 0, stop)
+    if code[:1] == b"T" and code[1:].isdigit():
+        changes.append((0, int(code[1:])))
+    segments = [[0, stop, 0]]
+    for start, tool in reversed(changes):
+        #selecting the active tool again changes nothing
+        if tool != segments[-1][2]:
+            segments[-1][1] = start
+            segments.append([start, stop, tool])
+    return segments
+
+
+def _replay_retracted(data, start, end, tool, retracted):
+    """slicer retraction of tool at end, replaying the lines from start on with retracted at start"""
+    state = _walk_back(data, start, position=False)
+    state.tool = tool
+    state.retracted = retracted
+    for line in data[start:end].decode("utf-8", "replace").splitlines():
+        state.process(line)
+    return state.retracted
+
+
+def _settled_retracted(data, start, end, tool):
+    """slicer retraction of tool at end, _UNKNOWN if no move between start and end settles it"""
+    window = _RETRACTION_WINDOW
+    while True:
+        replay = max(start, data.rfind(b"\n", 0, max(start, end - window)) + 1)
+        #an extruding move resets it, unknown stays unknown until one does
+        retracted = _replay_retracted(data, replay, end, tool, _UNKNOWN)
+        if retracted != _UNKNOWN or replay == start:
+            return retracted
+        window *= 4
+
+
+def _segment_retracted(data, segments, i):
+    """slicer retraction of the tool of segments[i] at its end"""
+    tool = segments[i][2]
+    unsettled = []
+    retracted = 0.0
+    for j in range(i, -1, -1):
+        start, end, segment_tool = segments[j]
+        if segment_tool != tool:
+            continue
+        settled = _settled_retracted(data, start, end, tool)
+        if settled != _UNKNOWN:
+            retracted = settled
+            break
+        unsettled.append(j)
+    #the tool started with what it was left with the time before, nothing the first time
+    for j in reversed(unsettled):
+        start, end, _ = segments[j]
+        retracted = _replay_retracted(data, start, end, tool, retracted)
+    return retracted
+
+
+def _fw_retracted(data, stop):
+    """True if the last firmware retraction before stop, a bare G10, was not undone by a G11"""
+    while True:
+        start, code = _last_command(data, stop, (b"G10", b"G11"), (b"G10", b"G11"))
+        if start is None or code == b"G11":
+            return False
+        if len(_line_at(data, start, stop).split()) == 1:
+            return True
+        #G10 with parameters sets tool offsets or temperatures
+        stop = start
+
+
+def reconstruct_retraction(data, filepos, state):
+    """set tool and the retraction fields of state to what they are at filepos in data (bytes or mmap)
+
+    The T lines split the file into the ranges each tool was active in. The
+    slicer retraction of a tool is settled by the last extruding move of its
+    range, only the lines after it are replayed, or the whole range if there is
+    none and the tool kept what it was left with the time before.
+    """
+    segments = _tool_segments(data, filepos)
+    state.tool = segments[-1][2]
+    #the tools put away, as they were left the last time
+    last = dict((tool, i) for i, (_, _, tool) in enumerate(segments))
+    tool_e = {}
+    tool_retracted = {}
+    for tool, i in last.items():
+        if tool == state.tool:
+            continue
+        left = _walk_back(data, segments[i][1], position=False)
+        tool_e[tool] = left.e if left.absolute_e else 0.0
+        tool_retracted[tool] = _segment_retracted(data, segments, i)
+    state.retracted = _segment_retracted(data, segments, len(segments) - 1)
+    state.fw_retracted = _fw_retracted(data, filepos)
+    state.tool_e = tool_e
+    state.tool_retracted = tool_retracted
+
+
+def _walk_back(data, filepos, position=True):
+    """GcodeState with the position, feedrate and modes at filepos, walking the lines only as far as needed
+
+    Without position only E is looked for, X, Y, Z and feedrate are left at their defaults.
+    """
+    absolute, absolute_e, _ = _modes(data, filepos)
+    x, y, z = _AxisResolver(absolute), _AxisResolver(absolute), _AxisResolver(absolute)
+    e = _AxisResolver(absolute_e)
+    xyz = (x, y, z)
+    axes = {b"X": x, b"Y": y, b"Z": z, b"E": e}
+    feedrate = None
+
+    for start, line in reverse_lines(data, filepos):
+        if b";" in line:
+            line = line[:line.index(b";")]
+        words = line.upper().split()
+        if not words:
+            continue
+        code = words[0]
+        if code in (b"G0", b"G1", b"G2", b"G3", b"G00", b"G01", b"G02", b"G03"):
+            for word in words[1:]:
+                letter = word[:1]
+                try:
+                    value = float(word[1:])
+                except ValueError:
+                    continue
+                if letter == b"F":
+                    if feedrate is None:
+                        feedrate = value
+                elif letter in axes:
+                    axes[letter].word(value)
+        elif code == b"G92":
+            for word in words[1:]:
+                if word[:1] in axes:
+                    try:
+                        axes[word[:1]].anchor(float(word[1:]))
+                    except ValueError:
+                        pass
+        elif code == b"G28":
+            homed = [axes[word[:1]] for word in words[1:] if word[:1] in (b"X", b"Y", b"Z")] or xyz
+            for axis in homed:
+                axis.anchor(0.0)
+        elif code in _POSITIONING:
+            earlier, earlier_e, _ = _modes(data, start)
+            for axis in xyz:
+                axis.mode(code == b"G90", earlier)
+            e.mode(code == b"G90", earlier_e)
+        elif code in _EXTRUDING:
+            e.mode(code == b"M82", _modes(data, start)[1])
+        if ((e.resolved or not absolute_e) and
+                (not position or x.resolved and y.resolved and z.resolved and feedrate is not None)):
+            break
+    else:
+        for axis in (x, y, z, e):
+            axis.finish()
+
+    state = GcodeState()
+    if position:
+        state.x, state.y, state.z = x.value, y.value, z.value
+        state.feedrate = feedrate
+    #E only matters with absolute extrusion, recovery never uses it under M83
+    state.e = e.value if absolute_e and e.value is not None else 0.0
+    state.absolute = absolute
+    state.absolute_e = absolute_e
+    return state
+
+
+def reconstruct_state(data, filepos):
+    """rebuild the GcodeState at filepos by walking data (bytes or mmap) backwards
+
+    The G90/G91 and M82/M83 modes, tool, fan, M900 and extrusion commands are
+    looked up directly with rfind, the lines themselves are only walked until
+    position and feedrate are known, and around the last retractions.
+    """
+    state = _walk_back(data, filepos)
+    reconstruct_retraction(data, filepos, state)
+    state.extrusion = _line_at(data, _last_command(data, filepos, (b"M8",), _EXTRUDING)[0], filepos)
+    state.fan = _line_at(data, _last_command(data, filepos, (b"M10",), (b"M106", b"M107"))[0], filepos)
+    state.linear_advance = _line_at(data, _last_command(data, filepos, (b"M9",), (b"M900",))[0], filepos)
+    return state
@@ -0,0 +1,567 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import array
+import bisect
+import hashlib
+import io
+import math
+import mmap
+import multiprocessing
+import os
+
+from .compressed import GzipIndex
+from .gcode import GcodeState, reconstruct_retraction
+from .layers import LayerTable
+from .misc import line_blocks
+from .sidecar import Sidecar
+
+#one snapshot of the modal state every INTERVAL bytes
+INTERVAL = 256 * 1024
+#bytes handed to split() at once while scanning
+_BLOCK = 1024 * 1024
+
+_MOVES = (b"G0", b"G1", b"G2", b"G3", b"G00", b"G01", b"G02", b"G03")
+_MOVE_CODES = frozenset(move.decode("ascii") for move in _MOVES)
+_LAYER_MARKERS = (b";LAYER:", b";LAYER_CHANGE")
+_EXTRUSION_CODES = {None: 0, "M82": 1, "M83": 2}
+_EXTRUSION_NAMES = dict((code, name) for name, code in _EXTRUSION_CODES.items())
+
+#array typecode of every column, in the order they are stored
+_COLUMNS = (
+    ("offset", "q"),
+    ("x", "d"),
+    ("y", "d"),
+    ("z", "d"),
+    ("e", "d"),
+    ("feedrate", "d"),
+    ("absolute", "b"),
+    ("absolute_e", "b"),
+    ("extrusion", "b"),
+    ("fan", "i"),
+    ("linear_advance", "i"),
+    ("tool", "h"),
+    ("layer", "i"),
+    ("retracted", "d"),
+    ("fw_retracted", "b"),
+    ("tools", "i"),
+)
+
+
+class _ChunkState(object):
+    """modal state of one chunk under an assumed mode at the start of the chunk
+
+    A chunk does not know where the axes were when it started, every axis value
+    is kept as value (+ start position while *_rel is True).
+    """
+
+    def __init__(self, absolute):
+        self.x = self.y = self.z = self.e = 0.0
+        self.x_rel = self.y_rel = self.z_rel = self.e_rel = True
+        self.absolute = self.absolute_e = absolute
+
+    def move(self, words):
+        """apply a move, returns its feedrate or None"""
+        feedrate = None
+        for word in words[1:]:
+            axis = word[:1]
+            try:
+                value = float(word[1:])
+            except ValueError:
+                continue
+            if axis == b"X":
+                if self.absolute:
+                    self.x, self.x_rel = value, False
+                else:
+                    self.x += value
+            elif axis == b"Y":
+                if self.absolute:
+                    self.y, self.y_rel = value, False
+                else:
+                    self.y += value
+            elif axis == b"E":
+                if self.absolute_e:
+                    self.e, self.e_rel = value, False
+                else:
+                    self.e += value
+            elif axis == b"Z":
+                if self.absolute:
+                    self.z, self.z_rel = value, False
+                else:
+                    self.z += value
+            elif axis == b"F":
+                feedrate = value
+        return feedrate
+
+    def _set(self, axis, value):
+        name = axis.decode("ascii").lower()
+        setattr(self, name, value)
+        setattr(self, name + "_rel", False)
+
+    def set_position(self, words):
+        for word in words[1:]:
+            if word[:1] in (b"X", b"Y", b"Z", b"E"):
+                try:
+                    self._set(word[:1], float(word[1:]))
+                except ValueError:
+                    pass
+
+    def home(self, words):
+        #bare G28 homes every axis
+        axes = [word[:1] for word in words[1:] if word[:1] in (b"X", b"Y", b"Z")] or (b"X", b"Y", b"Z")
+        for axis in axes:
+            self._set(axis, 0.0)
+
+    def snapshot(self):
+        return (self.x, self.x_rel, self.y, self.y_rel, self.z, self.z_rel,
+                self.e, self.e_rel, self.absolute, self.absolute_e)
+
+    def same(self, other):
+        return self.snapshot() == other.snapshot()
+
+
+def _scan_chunk(job):
+    """worker: scan one chunk of the file, returns partial snapshots at every interval boundary"""
+    path, start, end, interval = job
+    snapshots = []
+    #the two hypotheses for the G90/G91 (and M82/M83) mode the chunk starts in
+    hypotheses = [_ChunkState(True), _ChunkState(False)]
+    #None means "not seen in this chunk, inherit"
+    feedrate = fan = linear_advance = extrusion = tool = None
+    layers = 0
+    next_boundary = ((start + interval - 1) // interval) * interval
+
+    def snapshot(offset):
+        converged = hypotheses[1] if len(hypotheses) > 1 else hypotheses[0]
+        return (offset, hypotheses[0].snapshot(), converged.snapshot(),
+                feedrate, fan, linear_advance, extrusion, tool, layers)
+
+    with io.open(path, "rb") as fh:
+        data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for pos, lines in line_blocks(data, start, end, _BLOCK):
+                for line in lines:
+                    if pos >= next_boundary:
+                        snapshots.append(snapshot(pos))
+                        next_boundary = (pos // interval + 1) * interval
+                        #once both hypotheses agree the chunk start does not matter anymore
+                        if len(hypotheses) > 1 and hypotheses[0].same(hypotheses[1]):
+                            del hypotheses[1]
+                    pos += len(line) + 1
+                    if line.startswith(_LAYER_MARKERS):
+                        layers += 1
+                        continue
+                    if b";" in line:
+                        line = line[:line.index(b";")]
+                    words = line.upper().split()
+                    if not words:
+                        continue
+                    code = words[0]
+                    if code in _MOVES:
+                        for hypothesis in hypotheses:
+                            moved = hypothesis.move(words)
+                        if moved is not None:
+                            feedrate = moved
+                    elif code == b"G92":
+                        for hypothesis in hypotheses:
+                            hypothesis.set_position(words)
+                    elif code == b"G28":
+                        for hypothesis in hypotheses:
+                            hypothesis.home(words)
+                    elif code in (b"G90", b"G91"):
+                        for hypothesis in hypotheses:
+                            hypothesis.absolute = hypothesis.absolute_e = code == b"G90"
+                    elif code in (b"M82", b"M83"):
+                        extrusion = code.decode("ascii")
+                        for hypothesis in hypotheses:
+                            hypothesis.absolute_e = code == b"M82"
+                    elif code in (b"M106", b"M107"):
+                        fan = b" ".join(words).decode("ascii", "replace")
+                    elif code == b"M900":
+                        linear_advance = b" ".join(words).decode("ascii", "replace")
+                    elif code[:1] == b"T" and code[1:].isdigit():
+                        tool = int(code[1:])
+            #state at the end of the chunk for the next one to start from
+            snapshots.append(snapshot(end))
+        finally:
+            data.close()
+    return snapshots
+
+
+def _start(state):
+    """what _estimate_chunk needs of the state it starts from, picklable"""
+    return (state.x, state.y, state.z, state.e, state.feedrate, state.absolute, state.absolute_e,
+            state.tool, state.retracted, state.fw_retracted, state.tool_e, state.tool_retracted)
+
+
+def _estimate_chunk(job):
+    """worker: print time and filament per tool from the start of the chunk to each of its snapshot offsets
+
+    Moves take distance / feedrate, arcs are counted as their chord and
+    acceleration is ignored, the same simplifications OctoPrint's analysis
+    makes, so the ratios of these sums are what matters. Dwells are added,
+    waiting for heaters is not. The retraction state at each offset comes
+    along, it needs every line replayed the same way.
+    """
+    path, offsets, end, start = job
+    state = GcodeState()
+    (state.x, state.y, state.z, state.e, state.feedrate, state.absolute, state.absolute_e,
+     state.tool, state.retracted, state.fw_retracted, state.tool_e, state.tool_retracted) = start
+    seconds = 0.0
+    filament = {}
+    sums = []
+    i = 0
+    with io.open(path, "rb") as fh:
+        data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for pos, lines in line_blocks(data, offsets[0], end, _BLOCK):
+                for line in lines:
+                    if i < len(offsets) and pos == offsets[i]:
+                        sums.append((seconds, dict(filament), _retraction(state)))
+                        i += 1
+                    pos += len(line) + 1
+                    x, y, z, e = state.x, state.y, state.z, state.e
+                    code = state.process(line.decode("ascii", "replace"))
+                    if code is None:
+                        continue
+                    if code in _MOVE_CODES:
+                        distance = math.sqrt((state.x - x) ** 2 + (state.y - y) ** 2 + (state.z - z) ** 2)
+                        extruded = state.e - e
+                        if state.feedrate:
+                            seconds += (distance or abs(extruded)) * 60.0 / state.feedrate
+                        if extruded:
+                            filament[state.tool] = filament.get(state.tool, 0.0) + extruded
+                    elif code == "G4":
+                        for word in line.split()[1:]:
+                            try:
+                                if word[:1] in (b"P", b"p"):
+                                    seconds += float(word[1:]) / 1000.0
+                                elif word[:1] in (b"S", b"s"):
+                                    seconds += float(word[1:])
+                            except ValueError:
+                                pass
+        finally:
+            data.close()
+    #offsets at the very end of the chunk
+    sums.extend((seconds, dict(filament), _retraction(state)) for _ in offsets[i:])
+    sums.append((seconds, filament, _retraction(state)))
+    return sums
+
+
+def _retraction(state):
+    #the tool dicts are replaced, never changed in place
+    return state.retracted, state.fw_retracted, state.tool_e, state.tool_retracted
+
+
+def _chunks(path, size, count):
+    """split the file in count ranges that start and end on line boundaries"""
+    bounds = [0]
+    with io.open(path, "rb") as fh:
+        for i in range(1, count):
+            fh.seek(size * i // count)
+            fh.readline()
+            bounds.append(max(min(fh.tell(), size), bounds[-1]))
+    bounds.append(size)
+    return [(bounds[i], bounds[i + 1]) for i in range(count) if bounds[i + 1] > bounds[i]]
+
+
+class GcodeIndex(Sidecar):
+    """modal state snapshots at regular byte offsets of a gcode file"""
+
+    VERSION = 3
+
+    def __init__(self, path, size, mtime, interval=INTERVAL):
+        super(GcodeIndex, self).__init__(path, size, mtime)
+        self.interval = interval
+        self.strings = []
+        #((tool, e, retracted), ...) of the tools put away, the tools column points in here
+        self.tool_states = []
+        self.columns = dict((name, array.array(typecode)) for name, typecode in _COLUMNS)
+        #print time and filament per tool from the start of the file to every snapshot, and to the end
+        self.time = array.array("d")
+        self.filament = {}
+        self.total_time = 0.0
+        self.total_filament = {}
+
+    @classmethod
+    def build(cls, path, workers=None, interval=INTERVAL):
+        """index path, spread over a process pool of workers (default: one per core)"""
+        stat = os.stat(path)
+        index = cls(path, stat.st_size, stat.st_mtime, interval)
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        jobs = [(path, start, end, interval) for start, end in _chunks(path, stat.st_size, max(workers, 1))]
+        pool = multiprocessing.Pool(min(workers, len(jobs))) if len(jobs) > 1 else None
+        try:
+            run = pool.map if pool is not None else lambda worker, jobs: [worker(job) for job in jobs]
+            index._fix_up(run(_scan_chunk, jobs))
+            #every chunk of the second pass starts at a snapshot, where the state is known
+            index._sum_estimates(run(_estimate_chunk, index._estimate_jobs(len(jobs))))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return index
+
+    def _estimate_jobs(self, count):
+        offsets = self.columns["offset"]
+        starts = sorted(set(len(offsets) * i // count for i in range(count)))
+        jobs = []
+        if not starts:
+            #empty file
+            return jobs
+        with io.open(self.path, "rb") as fh:
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for n, first in enumerate(starts):
+                    last = starts[n + 1] if n + 1 < len(starts) else len(offsets)
+                    end = offsets[last] if last < len(offsets) else self.size
+                    offset, state, _ = self.snapshot(first)
+                    #the first pass cannot follow retractions across chunks, look them up where this one starts
+                    reconstruct_retraction(data, offset, state)
+                    jobs.append((self.path, offsets[first:last].tolist(), end, _start(state)))
+            finally:
+                data.close()
+        return jobs
+
+    def _sum_estimates(self, results):
+        """turn the per chunk sums into sums from the start of the file"""
+        seconds = 0.0
+        filament = {}
+        tools = set()
+        for sums in results:
+            tools.update(*(chunk_filament.keys() for _, chunk_filament, _ in sums))
+        for tool in tools:
+            self.filament[tool] = array.array("d")
+        i = 0
+        for sums in results:
+            for chunk_seconds, chunk_filament, retraction in sums[:-1]:
+                self.time.append(seconds + chunk_seconds)
+                for tool in tools:
+                    self.filament[tool].append(filament.get(tool, 0.0) + chunk_filament.get(tool, 0.0))
+                self._set_retraction(i, *retraction)
+                i += 1
+            chunk_seconds, chunk_filament, _ = sums[-1]
+            seconds += chunk_seconds
+            for tool, extruded in chunk_filament.items():
+                filament[tool] = filament.get(tool, 0.0) + extruded
+        self.total_time = seconds
+        self.total_filament = filament
+
+    def remaining(self, filepos):
+        """(print time, {tool: filament}) from filepos to the end of the file"""
+        i = bisect.bisect_right(self.columns["offset"], filepos) - 1
+        offset, state, _ = self.snapshot(i)
+        #replay the part of the interval before filepos
+        replayed_seconds, replayed_filament, _ = _estimate_chunk((self.path, [offset], filepos, _start(state)))[-1]
+        seconds = self.time[i] + replayed_seconds
+        remaining = {}
+        for tool, total in self.total_filament.items():
+            done = self.filament[tool][i] + replayed_filament.get(tool, 0.0)
+            remaining[tool] = total - done
+        return self.total_time - seconds, remaining
+
+    def _string(self, value):
+        if value is None:
+            return -1
+        if value not in self.strings:
+            self.strings.append(value)
+        return self.strings.index(value)
+
+    def _tools(self, tool_e, tool_retracted):
+        value = tuple((tool, tool_e[tool], tool_retracted.get(tool, 0.0)) for tool in sorted(tool_e))
+        if value not in self.tool_states:
+            self.tool_states.append(value)
+        return self.tool_states.index(value)
+
+    def _fix_up(self, results):
+        """resolve the chunk relative snapshots in file order, each chunk starts where the last one ended"""
+        state = GcodeState()
+        layer = 0
+        columns = self.columns
+        for snapshots in results:
+            start = (state.x, state.y, state.z, state.e, state.absolute, state.absolute_e,
+                     state.feedrate, state.fan, state.linear_advance, state.extrusion, state.tool, layer)
+            for snapshot in snapshots:
+                (offset, absolute_start, relative_start,
+                 feedrate, fan, linear_advance, extrusion, tool, layers) = snapshot
+                x0, y0, z0, e0, absolute0, absolute_e0 = start[:6]
+                xyz = absolute_start if absolute0 else relative_start
+                e_state = absolute_start if absolute_e0 else relative_start
+                resolved = GcodeState()
+                resolved.x = xyz[0] + (x0 if xyz[1] else 0)
+                resolved.y = xyz[2] + (y0 if xyz[3] else 0)
+                resolved.z = xyz[4] + (z0 if xyz[5] else 0)
+                resolved.e = e_state[6] + (e0 if e_state[7] else 0)
+                #each hypothesis carries its own mode, assumed or set in the chunk
+                resolved.absolute = xyz[8]
+                resolved.absolute_e = e_state[9]
+                resolved.feedrate = start[6] if feedrate is None else feedrate
+                resolved.fan = start[7] if fan is None else fan
+                resolved.linear_advance = start[8] if linear_advance is None else linear_advance
+                resolved.extrusion = start[9] if extrusion is None else extrusion
+                resolved.tool = start[10] if tool is None else tool
+                resolved_layer = start[11] + layers
+                if snapshot is snapshots[-1]:
+                    #chunk end, only carried over to the next chunk
+                    state, layer = resolved, resolved_layer
+                    continue
+                if len(columns["offset"]) and columns["offset"][-1] == offset:
+                    continue
+                self._append(offset, resolved, resolved_layer)
+        if not len(columns["offset"]):
+            #empty file
+            self._append(0, GcodeState(), 0)
+
+    def _append(self, offset, state, layer):
+        columns = self.columns
+        columns["offset"].append(offset)
+        columns["x"].append(state.x)
+        columns["y"].append(state.y)
+        columns["z"].append(state.z)
+        columns["e"].append(state.e)
+        columns["feedrate"].append(float("nan") if state.feedrate is None else state.feedrate)
+        columns["absolute"].append(state.absolute)
+        columns["absolute_e"].append(state.absolute_e)
+        columns["extrusion"].append(_EXTRUSION_CODES.get(state.extrusion, 0))
+        columns["fan"].append(self._string(state.fan))
+        columns["linear_advance"].append(self._string(state.linear_advance))
+        columns["tool"].append(state.tool)
+        columns["layer"].append(layer)
+        #set again by _sum_estimates, the chunks of the first pass do not know them
+        columns["retracted"].append(state.retracted)
+        columns["fw_retracted"].append(state.fw_retracted)
+        columns["tools"].append(self._tools(state.tool_e, state.tool_retracted))
+
+    def _set_retraction(self, i, retracted, fw_retracted, tool_e, tool_retracted):
+        columns = self.columns
+        columns["retracted"][i] = retracted
+        columns["fw_retracted"][i] = fw_retracted
+        columns["tools"][i] = self._tools(tool_e, tool_retracted)
+
+    def __len__(self):
+        return len(self.columns["offset"])
+
+    def snapshot(self, i):
+        """(offset, GcodeState, layer) of snapshot i"""
+        columns = self.columns
+        state = GcodeState()
+        state.x = columns["x"][i]
+        state.y = columns["y"][i]
+        state.z = columns["z"][i]
+        state.e = columns["e"][i]
+        feedrate = columns["feedrate"][i]
+        state.feedrate = None if feedrate != feedrate else feedrate
+        state.absolute = bool(columns["absolute"][i])
+        state.absolute_e = bool(columns["absolute_e"][i])
+        state.extrusion = _EXTRUSION_NAMES.get(columns["extrusion"][i])
+        state.fan = self.strings[columns["fan"][i]] if columns["fan"][i] >= 0 else None
+        state.linear_advance = (self.strings[columns["linear_advance"][i]]
+                                if columns["linear_advance"][i] >= 0 else None)
+        state.tool = columns["tool"][i]
+        state.retracted = columns["retracted"][i]
+        state.fw_retracted = bool(columns["fw_retracted"][i])
+        tools = self.tool_states[columns["tools"][i]]
+        state.tool_e = dict((tool, e) for tool, e, _ in tools)
+        state.tool_retracted = dict((tool, retracted) for tool, _, retracted in tools)
+        return columns["offset"][i], state, columns["layer"][i]
+
+    def state_at(self, filepos):
+        """GcodeState at filepos: bisect to the closest snapshot, replay at most one interval"""
+        i = bisect.bisect_right(self.columns["offset"], filepos) - 1
+        offset, state, _ = self.snapshot(i)
+        with io.open(self.path, "rb") as fh:
+            fh.seek(offset)
+            replay = fh.read(filepos - offset)
+        for line in replay.decode("utf-8", "replace").splitlines():
+            state.process(line)
+        return state
+
+    def _header(self):
+        tools = sorted(self.filament)
+        return dict(interval=self.interval, strings=self.strings, tool_states=self.tool_states, tools=tools,
+                    total_time=self.total_time, total_filament=[self.total_filament.get(tool, 0.0) for tool in tools])
+
+    def _write(self, fh):
+        for name, _ in _COLUMNS:
+            self.columns[name].tofile(fh)
+        self.time.tofile(fh)
+        for tool in sorted(self.filament):
+            self.filament[tool].tofile(fh)
+
+    @classmethod
+    def _from_header(cls, header):
+        return cls(header["path"], header["size"], header["mtime"], header["interval"])
+
+    def _read(self, fh, header):
+        self.strings = header["strings"]
+        self.tool_states = header["tool_states"]
+        for name, _ in _COLUMNS:
+            self.columns[name].fromfile(fh, header["count"])
+        self.time.fromfile(fh, header["count"])
+        for tool, total in zip(header["tools"], header["total_filament"]):
+            self.filament[tool] = array.array("d")
+            self.filament[tool].fromfile(fh, header["count"])
+            self.total_filament[tool] = total
+        self.total_time = header["total_time"]
+
+
+class IndexStore(object):
+    """sidecar indexes and layer tables for the files in the local storage, kept in the plugin data folder"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        #layer tables are small and asked for again on every retry, keep them around
+        self._layers = {}
+
+    def _sidecar(self, path, extension):
+        return os.path.join(self.folder, hashlib.sha1(path.encode("utf-8")).hexdigest() + extension)
+
+    def index_path(self, path):
+        return self._sidecar(path, ".idx")
+
+    def _load(self, cls, path, extension):
+        """the sidecar of path if there is one that still matches the file"""
+        sidecar = cls.load(self._sidecar(path, extension))
+        if sidecar is None or sidecar.path != path or not sidecar.matches(path):
+            return None
+        return sidecar
+
+    def _save(self, sidecar, extension):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        sidecar.save(self._sidecar(sidecar.path, extension))
+        return sidecar
+
+    def get(self, path):
+        """the index for path if there is one that still matches the file"""
+        return self._load(GcodeIndex, path, ".idx")
+
+    def build(self, path, workers=None):
+        return self._save(GcodeIndex.build(path, workers=workers), ".idx")
+
+    def layers(self, path):
+        """the layer table for path, built and cached on first use"""
+        table = self._layers.get(path)
+        if table is not None and table.matches(path):
+            return table
+        table = self._load(LayerTable, path, ".layers")
+        if table is None:
+            table = self._save(LayerTable.build(path), ".layers")
+        self._layers[path] = table
+        return table
+
+    def gzip_index(self, path):
+        """access points into the gzip file path, built and saved on first use"""
+        index = self._load(GzipIndex, path, ".gzi")
+        if index is None:
+            index = self._save(GzipIndex.build(path), ".gzi")
+        return index
+
+    def remove(self, path):
+        self._layers.pop(path, None)
+        for extension in (".idx", ".layers", ".gzi"):
+            try:
+                os.remove(self._sidecar(path, extension))
+            except OSError:
+                pass
@@ -0,0 +1,105 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import array
+
+_NAN = float("nan")
+
+
+class InflightRing(object):
+    """file position and modal state of the last commands sent, advanced by the printer's oks
+
+    Every line sent takes the next slot, every "ok" acknowledges the oldest line
+    not acknowledged yet. An ok only means the firmware took the line into its
+    buffer, the planner can still hold planner_depth commands that have not been
+    executed, so the last executed line is taken to be planner_depth before the
+    last acknowledged one. Slots are preallocated, push and ack only assign.
+    """
+
+    def __init__(self, capacity=256, planner_depth=16):
+        self.capacity = max(capacity, 2 * (planner_depth + 1))
+        self.planner_depth = planner_depth
+        size = self.capacity
+        self.filepos = array.array("q", [0]) * size
+        self.x = array.array("d", [0.0]) * size
+        self.y = array.array("d", [0.0]) * size
+        self.z = array.array("d", [0.0]) * size
+        self.e = array.array("d", [0.0]) * size
+        self.feedrate = array.array("d", [0.0]) * size
+        self.tool = array.array("h", [0]) * size
+        self.retracted = array.array("d", [0.0]) * size
+        self.fw_retracted = array.array("b", [0]) * size
+        #references to strings and dicts the state already holds, storing them allocates nothing
+        self.extrusion = [None] * size
+        self.fan = [None] * size
+        self.linear_advance = [None] * size
+        self.tool_e = [None] * size
+        self.tool_retracted = [None] * size
+        self.has_state = False
+        self.sent = 0
+        self.acked = 0
+        self.overruns = 0
+
+    def push(self, filepos, state=None):
+        """record a line that was just sent, with the GcodeState after it if there is one"""
+        i = self.sent % self.capacity
+        self.filepos[i] = filepos
+        if state is not None:
+            self.x[i] = state.x
+            self.y[i] = state.y
+            self.z[i] = state.z
+            self.e[i] = state.e
+            self.feedrate[i] = _NAN if state.feedrate is None else state.feedrate
+            self.tool[i] = state.tool
+            self.retracted[i] = state.retracted
+            self.fw_retracted[i] = state.fw_retracted
+            self.extrusion[i] = state.extrusion
+            self.fan[i] = state.fan
+            self.linear_advance[i] = state.linear_advance
+            self.tool_e[i] = state.tool_e
+            self.tool_retracted[i] = state.tool_retracted
+            self.has_state = True
+        self.sent += 1
+
+    def ack(self):
+        #oks for commands sent before the print started or for resends have nothing to acknowledge
+        if self.acked < self.sent:
+            self.acked += 1
+
+    def executed(self):
+        """slot of the last line the printer has executed, None if there is none yet"""
+        seq = self.acked - 1 - self.planner_depth
+        if seq < 0:
+            return None
+        oldest = self.sent - self.capacity
+        if seq < oldest:
+            #more lines in flight than slots, the oldest one left is the best we have
+            self.overruns += 1
+            seq = oldest
+        return seq % self.capacity
+
+    def in_flight(self):
+        return self.sent - self.acked
+
+    def recovery_settings_at(self, i):
+        """what GcodeState.as_recovery_settings returned after the line in slot i"""
+        feedrate = self.feedrate[i]
+        tool = self.tool[i]
+        tool_e = dict(self.tool_e[i] or {})
+        tool_e[tool] = self.e[i]
+        tool_retracted = dict(self.tool_retracted[i] or {})
+        tool_retracted[tool] = self.retracted[i]
+        return {
+            "last_X": self.x[i],
+            "last_Y": self.y[i],
+            "extruder": self.e[i],
+            "extrusion": self.extrusion[i],
+            "feedrate": None if feedrate != feedrate else feedrate,
+            "last_fan": self.fan[i],
+            "linear_advance": self.linear_advance[i],
+            "tool": tool,
+            "retracted": self.retracted[i],
+            "fw_retracted": bool(self.fw_retracted[i]),
+            "tool_e": tool_e,
+            "tool_retracted": tool_retracted,
+        }
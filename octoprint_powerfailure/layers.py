@@ -0,0 +1,136 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import array
+import bisect
+import io
+import mmap
+import os
+
+from .sidecar import Sidecar
+
+#how many lines after a layer marker to look for the layer height
+_Z_LOOKAHEAD = 50
+
+
+def _move_z(line):
+    """Z of a G0/G1 line, None if it does not move Z"""
+    line = line.split(b";")[0]
+    words = line.split()
+    if not words or words[0] not in (b"G0", b"G1", b"G00", b"G01"):
+        return None
+    for word in words[1:]:
+        if word[:1] == b"Z":
+            try:
+                return float(word[1:])
+            except ValueError:
+                return None
+    return None
+
+
+def _marker_z(data, pos, default):
+    """layer height following the marker at pos, from ;Z: or the first Z move"""
+    for _ in range(_Z_LOOKAHEAD):
+        end = data.find(b"\n", pos)
+        if end < 0:
+            end = len(data)
+        line = data[pos:end].strip()
+        if line.startswith(b";Z:"):
+            try:
+                return float(line[3:])
+            except ValueError:
+                pass
+        z = _move_z(line)
+        if z is not None:
+            return z
+        if end >= len(data):
+            break
+        pos = end + 1
+    return default
+
+
+def _marker_layers(data, offsets, heights):
+    """layer starts from ;LAYER:<n> (Cura) and ;LAYER_CHANGE (PrusaSlicer and friends) comments"""
+    z = 0.0
+    pos = 0 if data[:6] == b";LAYER" else data.find(b"\n;LAYER")
+    while pos >= 0:
+        start = pos if data[pos:pos + 1] == b";" else pos + 1
+        marker = data[start:start + 13]
+        #;LAYER_COUNT and friends are not layer starts
+        if marker.startswith(b";LAYER:") or marker == b";LAYER_CHANGE":
+            z = _marker_z(data, start, z)
+            offsets.append(start)
+            heights.append(z)
+        pos = data.find(b"\n;LAYER", start + 1)
+
+
+def _move_layers(data, offsets, heights):
+    """layer starts from Z moves for files without markers
+
+    A Z move starts a layer when it goes above the last layer and something is
+    extruded before Z moves again, which leaves out z hops.
+    """
+    candidate = None
+    top = None
+    pos = data.find(b"Z")
+    while pos >= 0:
+        start = data.rfind(b"\n", 0, pos) + 1
+        end = data.find(b"\n", pos)
+        if end < 0:
+            end = len(data)
+        z = _move_z(data[start:end])
+        if z is not None:
+            if candidate is not None and data.find(b" E", candidate[2], start) >= 0:
+                offsets.append(candidate[0])
+                heights.append(candidate[1])
+                top = candidate[1]
+            candidate = (start, z, end) if top is None or z > top else None
+        pos = data.find(b"Z", end)
+    if candidate is not None and data.find(b" E", candidate[2]) >= 0:
+        offsets.append(candidate[0])
+        heights.append(candidate[1])
+
+
+class LayerTable(Sidecar):
+    """byte offset and Z height of every layer start of a gcode file"""
+
+    VERSION = 1
+
+    def __init__(self, path, size, mtime):
+        super(LayerTable, self).__init__(path, size, mtime)
+        self.offsets = array.array("q")
+        self.heights = array.array("d")
+
+    @classmethod
+    def build(cls, path):
+        stat = os.stat(path)
+        table = cls(path, stat.st_size, stat.st_mtime)
+        if not stat.st_size:
+            return table
+        with io.open(path, "rb") as fh:
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                _marker_layers(data, table.offsets, table.heights)
+                if not len(table.offsets):
+                    _move_layers(data, table.offsets, table.heights)
+            finally:
+                data.close()
+        return table
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def layer_start(self, filepos, layers_back=0):
+        """(offset, z) of the start of the layer filepos is in, or layers_back layers before it"""
+        i = bisect.bisect_right(self.offsets, filepos) - 1 - layers_back
+        if i < 0:
+            return None
+        return self.offsets[i], self.heights[i]
+
+    def _write(self, fh):
+        self.offsets.tofile(fh)
+        self.heights.tofile(fh)
+
+    def _read(self, fh, header):
+        self.offsets.fromfile(fh, header["count"])
+        self.heights.fromfile(fh, header["count"])
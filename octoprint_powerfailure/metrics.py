@@ -0,0 +1,129 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import bisect
+import time
+import tracemalloc
+
+#monotonic where the interpreter has it, only differences are ever used
+clock = getattr(time, "perf_counter", time.time)
+
+#the sending hook times one line in this many, a power of two
+HOOK_SAMPLE = 16
+HOOK_SAMPLE_MASK = HOOK_SAMPLE - 1
+
+#bucket upper bounds, the last bucket (+Inf) is implicit
+LINE_SECONDS = (1e-6, 2e-6, 5e-6, 1e-5, 2e-5, 5e-5, 1e-4, 1e-3, 1e-2)
+WRITE_SECONDS = (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 0.1, 1.0)
+CONTINUATION_SECONDS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+LAG_BYTES = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram(object):
+    """fixed buckets allocated up front, observe is a bisect and two additions"""
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def as_dict(self):
+        buckets = [[bound, count] for bound, count in zip(self.bounds, self.counts)]
+        buckets.append(["+Inf", self.counts[-1]])
+        return dict(buckets=buckets, sum=self.sum, count=self.count)
+
+
+class Metrics(object):
+    """counters, gauges and histograms of the recovery subsystem
+
+    Updates are not locked, under the GIL an increment racing another one can
+    at worst be lost, which is fine for statistics and keeps the hook cheap.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        #a plain attribute, the one counter bumped for every line sent
+        self.hook_lines = 0
+        self.counters = dict(
+            checkpoints_written=0,
+            checkpoints_skipped=0,
+            #superseded by a newer checkpoint before the writer got to them
+            checkpoints_coalesced=0,
+            checkpoint_bytes_written=0,
+            continuations=0,
+            #power-fail notifications that wrote a checkpoint
+            power_signals=0,
+        )
+        self.gauges = dict(
+            #most memory Python had allocated at once while the recovery job was generated, above where it started
+            continuation_peak_alloc_bytes=0,
+            continuation_bytes=0,
+            checkpoint_write_lag_seconds=0.0,
+        )
+        self.histograms = dict(
+            hook_line_seconds=Histogram(LINE_SECONDS),
+            checkpoint_write_seconds=Histogram(WRITE_SECONDS),
+            checkpoint_filepos_lag_bytes=Histogram(LAG_BYTES),
+            #from capture to on disk, queueing behind a slow write included
+            checkpoint_lag_seconds=Histogram(WRITE_SECONDS),
+            continuation_seconds=Histogram(CONTINUATION_SECONDS),
+            #from a power-fail notification arriving to its checkpoint on disk
+            power_signal_flush_seconds=Histogram(WRITE_SECONDS),
+        )
+
+    def _counters(self):
+        counters = dict(self.counters)
+        counters["hook_lines"] = self.hook_lines
+        return counters
+
+    def as_dict(self):
+        return dict(
+            uptime=time.time() - self.started,
+            counters=self._counters(),
+            gauges=dict(self.gauges),
+            histograms=dict((name, histogram.as_dict()) for name, histogram in self.histograms.items()),
+        )
+
+    def prometheus(self, prefix="octoprint_powerfailure_"):
+        """the Prometheus text exposition format"""
+        lines = []
+        counters = self._counters()
+        for name in sorted(counters):
+            lines.append("# TYPE {0}{1}_total counter".format(prefix, name))
+            lines.append("{0}{1}_total {2}".format(prefix, name, counters[name]))
+        for name in sorted(self.gauges):
+            lines.append("# TYPE {0}{1} gauge".format(prefix, name))
+            lines.append("{0}{1} {2}".format(prefix, name, self.gauges[name]))
+        for name in sorted(self.histograms):
+            histogram = self.histograms[name]
+            lines.append("# TYPE {0}{1} histogram".format(prefix, name))
+            cumulative = 0
+            for bound, count in zip(histogram.bounds + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append('{0}{1}_bucket{{le="{2}"}} {3}'.format(prefix, name, bound, cumulative))
+            lines.append("{0}{1}_sum {2!r}".format(prefix, name, histogram.sum))
+            lines.append("{0}{1}_count {2}".format(prefix, name, histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+def peak_allocated(function, *args):
+    """(function(*args), peak bytes allocated while it ran)
+
+    Measured with tracemalloc, allocations of the other threads in that time
+    count as well. The peak is None if tracemalloc was already tracing for
+    someone else, whose numbers starting and stopping it would reset.
+    """
+    if tracemalloc.is_tracing():
+        return function(*args), None
+    tracemalloc.start()
+    try:
+        result = function(*args)
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
@@ -1,3 +1,4 @@
+import mmap
 import os
 
 
@@ -8,34 +9,75 @@ def sanitize_number(number):
         return number
 
 
-def reverse_readlines(filename, stop, buf_size=8192):
-    """a generator that returns the lines of a file in reverse order"""
-    with open(filename) as fh:
-        segment = None
-        offset = 0
-        fh.seek(stop)
-        file_size = remaining_size = fh.tell()
-        while remaining_size > 0:
-            offset = min(file_size, offset + buf_size)
-            fh.seek(file_size - offset)
-            buffer = fh.read(min(remaining_size, buf_size))
-            remaining_size -= buf_size
-            lines = buffer.split('\n')
-            # the first line of the buffer is probably not a complete line so
-            # we'll save it and append it to the last line of the next buffer
-            # we read
-            if segment is not None:
-                # if the previous chunk starts right from the beginning of line
-                # do not concact the segment to the last line of new chunk
-                # instead, yield the segment first
-                if buffer[-1] is not '\n':
-                    lines[-1] += segment
+def reverse_lines(data, stop):
+    """yield (offset, line) for the non empty lines of a bytes like buffer before stop, last line first"""
+    end = stop
+    while end > 0:
+        start = data.rfind(b"\n", 0, end) + 1
+        if start < end:
+            yield start, data[start:end]
+        end = start - 1
+
+
+def line_blocks(data, start, end, block=1024 * 1024):
+    """yield (offset, lines) for the whole lines of a bytes like buffer from start to end, without the newlines
+
+    Splitting a block at a time is much cheaper than a find() per line, the
+    caller adds len(line) + 1 to the offset for every line it walks.
+    """
+    pos = start
+    while pos < end:
+        block_end = data.rfind(b"\n", pos, min(pos + block, end)) + 1
+        if block_end <= pos:
+            #a single line longer than a block
+            block_end = data.find(b"\n", pos, end) + 1 or end
+        lines = data[pos:block_end].split(b"\n")
+        if not lines[-1]:
+            lines.pop()
+        yield pos, lines
+        pos = block_end
+
+
+def reverse_readlines(filename, stop):
+    """a generator that returns the lines of a file before stop in reverse order"""
+    with open(filename, "rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return
+        data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for _, line in reverse_lines(data, min(stop, len(data))):
+                yield line.decode("utf-8", "replace").rstrip("\r")
+        finally:
+            data.close()
+
+
+def copy_from_offset(src_fd, dst_fd, offset, buf_size=1024 * 1024):
+    """copy src_fd from offset to its end onto dst_fd, never holding more than buf_size in memory"""
+    remaining = os.fstat(src_fd).st_size - offset
+    #let the kernel move the data when it can, copy_file_range first, then sendfile
+    for name in ("copy_file_range", "sendfile"):
+        kernel_copy = getattr(os, name, None)
+        if kernel_copy is None:
+            continue
+        try:
+            while remaining > 0:
+                if name == "copy_file_range":
+                    copied = kernel_copy(src_fd, dst_fd, min(remaining, buf_size), offset)
                 else:
-                    yield segment
-            segment = lines[0]
-            for index in range(len(lines) - 1, 0, -1):
-                if len(lines[index]):
-                    yield lines[index]
-        # Don't yield None if the file was empty
-        if segment is not None:
-            yield segment
+                    copied = kernel_copy(dst_fd, src_fd, offset, min(remaining, buf_size))
+                if copied == 0:
+                    return
+                offset += copied
+                remaining -= copied
+            return
+        except OSError:
+            #not supported for this pair of files, carry on from where we are
+            continue
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    while remaining > 0:
+        chunk = os.read(src_fd, min(remaining, buf_size))
+        if not chunk:
+            return
+        remaining -= len(chunk)
+        while chunk:
+            chunk = chunk[os.write(dst_fd, chunk):]
@@ -0,0 +1,107 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import errno
+import os
+import socket
+import stat
+import threading
+
+from .metrics import clock
+
+#first word of a notification, NUT's notify types and two of our own
+FAIL = frozenset(("ONBATT", "LOWBATT", "FSD", "SHUTDOWN", "POWERFAIL"))
+RESTORED = frozenset(("ONLINE", "POWEROK"))
+
+
+def supported():
+    return hasattr(socket, "AF_UNIX")
+
+
+def _remove_socket(path):
+    """unlink path if it is a socket, False if something else is there"""
+    try:
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            return False
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return True
+
+
+class PowerSignalListener(threading.Thread):
+    """receives power notifications on a Unix datagram socket
+
+    One datagram per notification, its first word says what happened: the
+    notify types of NUT's upsmon (ONBATT, LOWBATT, FSD, SHUTDOWN, ONLINE),
+    POWERFAIL or POWEROK. on_notify is called on this thread with ("fail" or
+    "restored", the word, the clock when it arrived). Anything else is ignored.
+    notify sends to the socket, which is all a signal handler has to do.
+    """
+
+    def __init__(self, path, on_notify):
+        super(PowerSignalListener, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.on_notify = on_notify
+        self.received = 0
+        self._sock = None
+        self._sender = None
+        self._stopped = False
+
+    def open(self):
+        #a socket left behind by a crash is ours to replace, a misconfigured path to a file is not
+        if not _remove_socket(self.path):
+            raise OSError(errno.EEXIST, "Not a socket, leaving it alone", self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        #the UPS daemon usually runs as another user of the same group
+        os.chmod(self.path, 0o660)
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sender.setblocking(False)
+        return self
+
+    def notify(self, word):
+        """send word to the socket, never blocks and never raises"""
+        try:
+            self._sender.sendto(word.encode("ascii"), self.path)
+        except (socket.error, AttributeError):
+            pass
+
+    def stop(self):
+        self._stopped = True
+        #wakes recv up
+        self.notify("STOP")
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+        for sock in (self._sock, self._sender):
+            if sock is not None:
+                sock.close()
+        self._sock = self._sender = None
+        try:
+            _remove_socket(self.path)
+        except OSError:
+            pass
+
+    def run(self):
+        while not self._stopped:
+            try:
+                data = self._sock.recv(256)
+            except socket.error:
+                if self._stopped:
+                    break
+                raise
+            received = clock()
+            if self._stopped:
+                break
+            words = data.decode("ascii", "replace").split()
+            word = words[0].upper() if words else ""
+            if word in FAIL:
+                state = "fail"
+            elif word in RESTORED:
+                state = "restored"
+            else:
+                continue
+            self.received += 1
+            self.on_notify(state, word, received)
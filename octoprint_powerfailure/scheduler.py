@@ -0,0 +1,69 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+
+from .metrics import clock
+
+
+class CheckpointScheduler(threading.Thread):
+    """runs the checkpoint callback when the print has made progress
+
+    The thread sleeps until something wakes it up: a byte budget sent to the
+    printer, an explicit request (Z change, tool change) or the poll interval
+    running out. Writes are capped to max_rate per second, a request that comes
+    in too early is deferred rather than dropped. The callback returns True when
+    it actually wrote a checkpoint, skipped checkpoints do not use up the budget.
+    """
+
+    def __init__(self, callback, interval, min_bytes=4096, max_rate=5.0):
+        super(CheckpointScheduler, self).__init__()
+        self.daemon = True
+        self.callback = callback
+        self.interval = interval
+        self.min_bytes = min_bytes
+        self.min_period = 1.0 / max_rate if max_rate > 0 else 0
+        self.written = 0
+        self.skipped = 0
+        self._bytes = 0
+        #on the monotonic clock, the wall clock steps when NTP syncs after the Pi boots
+        self._last_write = clock() - self.min_period
+        self._last_key = None
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+
+    def progress(self, nbytes):
+        """called for every line sent to the printer, cheap on purpose"""
+        self._bytes += nbytes
+        if self._bytes >= self.min_bytes:
+            self._bytes = 0
+            self._wake.set()
+
+    def request(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+
+    def unchanged(self, key):
+        """True if key matches what the last checkpoint wrote"""
+        return key == self._last_key
+
+    def mark_written(self, key):
+        self._last_key = key
+
+    def run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.interval)
+            if self._stopped.is_set():
+                break
+            self._wake.clear()
+            delay = self._last_write + self.min_period - clock()
+            if delay > 0 and self._stopped.wait(delay):
+                break
+            if self.callback():
+                self.written += 1
+                self._last_write = clock()
+            else:
+                self.skipped += 1
@@ -0,0 +1,138 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+
+from .checkpoint import CheckpointStore
+from .metrics import clock
+from .scheduler import CheckpointScheduler
+from .writer import CheckpointWriter
+
+
+class CheckpointService(object):
+    """the checkpoint store, its writer thread and the scheduler of the print in progress
+
+    open and close bracket the plugin's lifetime, start and stop every print.
+    All of them can be called any number of times and in any state: start
+    stops the scheduler of a print that never ended, stop and close do nothing
+    when there is nothing to stop, so every event handler can just call them.
+
+    With a safety_interval the checkpoints the scheduler takes are only held in
+    memory, the newest one is written every safety_interval seconds and when
+    persist is called, on a power-fail notification. Setting safety_interval
+    to None writes every checkpoint again.
+    """
+
+    def __init__(self, path, logger, on_written=None):
+        self.path = path
+        self.store = None
+        self.writer = None
+        self.scheduler = None
+        self.safety_interval = None
+        #newest checkpoint not handed to the writer yet
+        self.held = None
+        self._persisted = clock()
+        self._logger = logger
+        self._on_written = on_written
+        self._lock = threading.RLock()
+
+    def open(self):
+        with self._lock:
+            if self.store is None:
+                self.store = CheckpointStore(self.path).open()
+                self.writer = CheckpointWriter(self._write, on_written=self._on_written)
+                self.writer.start()
+        return self
+
+    def _write(self, payload):
+        try:
+            self.store.write(payload)
+        except Exception:
+            self._logger.exception("Could not write the checkpoint")
+            raise
+
+    def submit(self, payload, flush=True):
+        """hand payload to the writer, or hold it, True if it superseded one still waiting"""
+        writer = self.writer
+        if writer is None:
+            self._logger.warning("Checkpoint service is closed, checkpoint dropped")
+            return False
+        with self._lock:
+            superseded = self.held is not None
+            if not flush and self.safety_interval is not None:
+                self.held = payload
+                return superseded
+            self.held = None
+            self._persisted = clock()
+        superseded = writer.submit(payload) or superseded
+        if flush:
+            writer.flush()
+        return superseded
+
+    def read(self):
+        """payload of the newest checkpoint, with everything submitted before on disk, None once closed"""
+        with self._lock:
+            if self.store is None:
+                return None
+            self.writer.flush()
+            return self.store.read()
+
+    def persist(self, timeout=None):
+        """write the held checkpoint and wait until everything submitted is on disk, False on timeout"""
+        self.release()
+        writer = self.writer
+        return writer.flush(timeout) if writer is not None else False
+
+    def release(self):
+        """hand the held checkpoint to the writer without waiting for it, True if there was one"""
+        with self._lock:
+            payload, self.held = self.held, None
+            if payload is None or self.writer is None:
+                return False
+            self._persisted = clock()
+            self.writer.submit(payload)
+            return True
+
+    def _capture(self, callback):
+        written = callback()
+        interval = self.safety_interval
+        if self.held is not None and (interval is None or clock() - self._persisted >= interval):
+            self.release()
+        return written
+
+    def lag(self):
+        return self.writer.lag() if self.writer is not None else 0.0
+
+    def start(self, callback, interval, min_bytes, max_rate, safety_interval=None):
+        self.stop()
+        with self._lock:
+            self.safety_interval = safety_interval
+            self._persisted = clock()
+            self.scheduler = CheckpointScheduler(lambda: self._capture(callback), interval,
+                                                 min_bytes=min_bytes, max_rate=max_rate)
+            self.scheduler.start()
+
+    def stop(self):
+        """stop the scheduler and wait for a checkpoint it is taking, so none lands after the final one"""
+        #not joined under the lock, the scheduler takes it to hand over checkpoints
+        scheduler = self.scheduler
+        if scheduler is not None:
+            scheduler.stop()
+            if scheduler.is_alive() and scheduler is not threading.current_thread():
+                scheduler.join()
+        #nothing held is lost when the print ends
+        self.release()
+
+    def close(self, timeout=5.0):
+        """stop everything and close the store, False if the writer could not flush within timeout"""
+        self.stop()
+        with self._lock:
+            self.scheduler = None
+            flushed = True
+            if self.writer is not None:
+                flushed = self.writer.stop(timeout)
+                self.writer = None
+            if self.store is not None:
+                self.store.close()
+                self.store = None
+        return flushed
@@ -0,0 +1,67 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import io
+import json
+import os
+
+
+class Sidecar(object):
+    """data derived from a file, saved as a json header line followed by the subclass' columns
+
+    The header records the size and mtime of the file it was built from, an
+    old sidecar is told apart with matches. Subclasses set VERSION, write and
+    read their columns in _write and _read and add header fields in _header.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, size, mtime):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+
+    def matches(self, path):
+        """True if path is still the file this was built from"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return stat.st_size == self.size and stat.st_mtime == self.mtime
+
+    def _header(self):
+        return {}
+
+    def _write(self, fh):
+        raise NotImplementedError()
+
+    def _read(self, fh, header):
+        raise NotImplementedError()
+
+    @classmethod
+    def _from_header(cls, header):
+        return cls(header["path"], header["size"], header["mtime"])
+
+    def save(self, sidecar_path):
+        header = dict(version=self.VERSION, path=self.path, size=self.size, mtime=self.mtime, count=len(self))
+        header.update(self._header())
+        #written aside and renamed, a reader never sees half a file
+        scratch = sidecar_path + ".tmp"
+        with io.open(scratch, "wb") as fh:
+            fh.write(json.dumps(header).encode("utf-8") + b"\n")
+            self._write(fh)
+        os.rename(scratch, sidecar_path)
+
+    @classmethod
+    def load(cls, sidecar_path):
+        """what is stored in sidecar_path, None if it is missing, truncated or from another version"""
+        try:
+            with io.open(sidecar_path, "rb") as fh:
+                header = json.loads(fh.readline().decode("utf-8"))
+                if header.get("version") != cls.VERSION:
+                    return None
+                sidecar = cls._from_header(header)
+                sidecar._read(fh, header)
+        except (IOError, OSError, ValueError, EOFError, KeyError):
+            return None
+        return sidecar
@@ -0,0 +1,67 @@
+/*
+ * Shows the state of the recovery job (plugin messages of type recovery) and
+ * recovery gcode blocks refused on save (type settings)
+ */
+$(function() {
+    function PowerFailureViewModel(parameters) {
+        var self = this;
+        self.notice = undefined;
+
+        self.show = function(options) {
+            //one notice for the recovery, each state replaces the previous one
+            if (self.notice !== undefined) {
+                self.notice.remove();
+            }
+            self.notice = new PNotify($.extend({title: gettext("Power Failure Recovery")}, options));
+        };
+
+        self.recoveryText = function(data) {
+            var path = _.escape(data.path);
+            switch (data.state) {
+                case "preparing":
+                    return {text: _.sprintf(gettext("Preparing the recovery of %(path)s"), {path: path}), type: "info", hide: false};
+                case "ready":
+                    return {text: _.sprintf(gettext("Recovery job %(path)s is ready"), {path: path}), type: "info"};
+                case "selected":
+                    return {text: data.auto
+                                ? _.sprintf(gettext("%(path)s is selected and starts as soon as the printer is ready"), {path: path})
+                                : _.sprintf(gettext("%(path)s is selected, start it with Print once the printer is ready"), {path: path}),
+                            type: "success", hide: false};
+                case "waiting":
+                    return {text: _.sprintf(gettext("%(path)s resumes from the recovery point as soon as the printer is ready"), {path: path}),
+                            type: "success", hide: false};
+                case "started":
+                    return {text: _.sprintf(gettext("Recovery of %(path)s started"), {path: path}), type: "success"};
+                case "failed":
+                    return {text: _.sprintf(gettext("Cannot recover: %(error)s"), {error: _.escape(data.error)}), type: "error", hide: false};
+            }
+        };
+
+        self.onDataUpdaterPluginMessage = function(plugin, data) {
+            if (plugin !== "powerfailure") {
+                return;
+            }
+            if (data.type === "recovery") {
+                var options = self.recoveryText(data);
+                if (options !== undefined) {
+                    self.show(options);
+                }
+            } else if (data.type === "settings" && data.state === "invalid") {
+                //its own notice, it must not replace the recovery state
+                new PNotify({
+                    title: gettext("Recovery gcode not saved"),
+                    text: _.sprintf(gettext("%(key)s was not saved and the previous block is still in use: %(error)s"),
+                                    {key: _.escape(data.key), error: _.escape(data.error)}),
+                    type: "error",
+                    hide: false
+                });
+            }
+        };
+    }
+
+    OCTOPRINT_VIEWMODELS.push({
+        construct: PowerFailureViewModel,
+        dependencies: [],
+        elements: []
+    });
+});
@@ -0,0 +1,107 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import collections
+import io
+import mmap
+import threading
+
+from .gcode import GcodeState, reconstruct_state
+
+
+class AsyncTracker(threading.Thread):
+    """keeps a GcodeState up to date off the printer communication thread
+
+    The sending hook only appends (filepos, line) to a deque, a worker drains it
+    in batches. When more than max_pending lines are waiting the overflow policy
+    applies: "block" makes the hook wait for the worker (bounded memory, the
+    state stays exact), "resync" drops the backlog and has the worker rebuild the
+    state from the file at the current position instead.
+
+    Readers only ever look at snapshot, a (filepos, recovery settings) tuple
+    the worker replaces as a whole after every batch, so the position and the
+    state read together always belong together. state and filepos are the
+    worker's own and move on while it drains.
+    """
+
+    def __init__(self, path=None, max_pending=4096, batch=64, overflow="block"):
+        super(AsyncTracker, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.max_pending = max_pending
+        self.batch = batch
+        self.overflow = overflow
+        self.state = GcodeState()
+        #file position the state corresponds to
+        self.filepos = 0
+        self.snapshot = (0, self.state.as_recovery_settings())
+        self.processed = 0
+        self.overflows = 0
+        self.resyncs = 0
+        self._pending = collections.deque()
+        self._wake = threading.Event()
+        self._drained = threading.Event()
+        self._stopped = False
+        self._resync_at = None
+
+    def push(self, filepos, line):
+        """called from the sending hook, O(1) unless the queue is full"""
+        pending = self._pending
+        if len(pending) >= self.max_pending:
+            self.overflows += 1
+            if self.overflow == "resync" and filepos is not None:
+                pending.clear()
+                self._resync_at = filepos
+                self._wake.set()
+                return
+            while len(pending) >= self.max_pending and not self._stopped:
+                self._drained.clear()
+                self._wake.set()
+                self._drained.wait(0.05)
+        pending.append((filepos, line))
+        if len(pending) >= self.batch:
+            self._wake.set()
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def _resync(self, filepos):
+        with io.open(self.path, "rb") as fh:
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self.state = reconstruct_state(data, filepos)
+            finally:
+                data.close()
+        self.filepos = filepos
+        self.resyncs += 1
+        self._publish()
+
+    def _publish(self):
+        self.snapshot = (self.filepos, self.state.as_recovery_settings())
+
+    def run(self):
+        pending = self._pending
+        while not self._stopped:
+            self._wake.wait(0.05)
+            self._wake.clear()
+            if self._resync_at is not None:
+                resync_at, self._resync_at = self._resync_at, None
+                self._resync(resync_at)
+            batch = 0
+            while pending:
+                #popleft is atomic, the hook can keep appending while we drain
+                filepos, line = pending.popleft()
+                if self._resync_at is not None:
+                    break
+                self.state.process(line)
+                if filepos is not None:
+                    self.filepos = filepos
+                self.processed += 1
+                batch += 1
+                if batch == self.batch:
+                    self._publish()
+                    batch = 0
+            if batch:
+                self._publish()
+            self._drained.set()
@@ -0,0 +1,115 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+
+from .metrics import clock
+
+
+class CheckpointWriter(threading.Thread):
+    """persists checkpoints on its own thread, only ever the newest one
+
+    submit hands over a packed checkpoint and returns at once, so a slow msync
+    on an SD card never holds up the thread capturing the state. A checkpoint
+    submitted while the previous one is still being written replaces whatever
+    was waiting, the superseded one is counted as coalesced and never written.
+    flush blocks until everything submitted so far is on disk.
+    """
+
+    def __init__(self, write, on_written=None):
+        super(CheckpointWriter, self).__init__()
+        self.daemon = True
+        self.write = write
+        #called with (seconds writing, seconds from submit to on disk) after every write
+        self.on_written = on_written
+        self.written = 0
+        self.coalesced = 0
+        self.failed = 0
+        self._cond = threading.Condition()
+        self._pending = None
+        self._pending_since = None
+        self._writing_since = None
+        self._submitted = 0
+        self._done = 0
+        self._stopped = False
+
+    def submit(self, payload):
+        """queue payload to be written, True if it superseded one still waiting"""
+        with self._cond:
+            superseded = self._pending is not None
+            if superseded:
+                self.coalesced += 1
+            else:
+                self._pending_since = clock()
+            self._pending = payload
+            self._submitted += 1
+            self._cond.notify_all()
+        return superseded
+
+    def lag(self):
+        """seconds the oldest checkpoint not on disk yet has been waiting, 0 when there is none"""
+        with self._cond:
+            since = self._writing_since if self._writing_since is not None else self._pending_since
+        return 0.0 if since is None else clock() - since
+
+    def flush(self, timeout=None):
+        """wait until everything submitted so far is written, False on timeout"""
+        if not self.is_alive():
+            #nothing would ever write it, do it here
+            self._write_pending()
+        with self._cond:
+            target = self._submitted
+            deadline = None if timeout is None else clock() + timeout
+            while self._done < target:
+                remaining = None if deadline is None else deadline - clock()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self, timeout=None):
+        """flush and end the thread"""
+        flushed = self.flush(timeout)
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout)
+        return flushed
+
+    def _write_pending(self):
+        with self._cond:
+            payload, since, seq = self._pending, self._pending_since, self._submitted
+            if payload is None:
+                return
+            self._pending = None
+            self._pending_since = None
+            self._writing_since = since
+        start = clock()
+        try:
+            self.write(payload)
+            self.written += 1
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            end = clock()
+            with self._cond:
+                self._writing_since = None
+                self._done = max(self._done, seq)
+                self._cond.notify_all()
+        if self.on_written is not None:
+            self.on_written(end - start, end - since)
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._stopped:
+                    self._cond.wait()
+                if self._pending is None:
+                    break
+            try:
+                self._write_pending()
+            except Exception:
+                #counted in failed and logged by write, the next checkpoint gets its own chance
+                pass